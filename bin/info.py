@@ -4,7 +4,8 @@
     report information from the redux database
 
   Usage:
-    -s <snp>  show information about a snp by name or position
+    -s <snp> [<snp> ...]  show information about snps by name or position
+    -d  list kits that were not stored because they duplicate another kit
 
   Copyright:
     For free distribution under the terms of the
@@ -14,7 +15,14 @@
   Jef Treece, 21 Feb 2018
 """
 
-import sqlite3, yaml, sys, time, argparse
+import yaml, sys, os, time, argparse
+
+# the name lookups are shared with the loader in src; names.py only needs
+# sqlite, so REDUX_PATH and the loader's dependencies aren't needed here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from names import resolve_names, get_duplicate_kits
+from db import db_manager
 
 t0 = time.time()
 
@@ -34,20 +42,21 @@ def trace (level, msg, stream=sys.stderr):
 DEBUG=config['verbosity']
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-s', '--snp', nargs=1)
+parser.add_argument('-s', '--snp', nargs='+')
 parser.add_argument('-k', '--kit', nargs=1)
+parser.add_argument('-d', '--duplicates', action='store_true')
 args = parser.parse_args()
 
 
-# create a sqlite database, cursor, and tables
-dbconn = sqlite3.connect(config['DB_FILE'])
+# a read-only connection to the database; this script doesn't change it
+dbconn = db_manager(config['DB_FILE']).acquire()
 dbcurs = dbconn.cursor()
 
 
 # STATS1 in redux.bash
 def stats1():
     c1 = dbconn.cursor()
-    c = c1.execute('select id, coverage1, coverage2, nranges from bedstats')
+    c = c1.execute('select pID, coverage1, coverage2, nranges from bedstats')
     for row in c:
         print(row[1], row[2], row[3])
 
@@ -55,7 +64,7 @@ def stats1():
 # STATS2 in redux.bash
 def stats2():
     c1 = dbconn.cursor()
-    c = c1.execute('select id, ny, nv, ns, ni from vcfstats')
+    c = c1.execute('select pID, ny, nv, ns, ni from vcfstats')
     for row in c:
         print(row[1], row[2], row[3], 0,0,0, row[4], 0,0)
 
@@ -88,27 +97,32 @@ def listkit(kit):
         print('{:<10}{:10s}{:58s}'.format(row[0], row[1], row[2][:58]))
 
 
-# print info about a snp by name or addr
-def querysnp(snp):
+# list out kits whose data is the same as another kit's
+def listduplicates():
+    print('{:10s}{:10s}{:10s}{:10s}'.format('kitID','pID','copy of','pID'))
+    for row in get_duplicate_kits(dbconn):
+        print('{:10s}{:<10}{:10s}{:<10}'.format(*row))
+
+
+# print info about snps by name or addr
+def querysnps(snps):
+    # names and pos.ref.alt are looked up all at once
+    found, unresolved = resolve_names(dbconn, 'variant', snps)
+    trace(2, 'not found by name or pos.ref.alt: {}'.format(unresolved))
+    for snp in snps:
+        querysnp(snp, found.get(snp, []))
+
+# print info about a snp, given the variant ids its name resolved to
+def querysnp(snp, vids):
     trace(2, 'looking for details about {}...'.format(snp))
     c1 = dbconn.cursor()
-    ids = set()
-    try:
-        pos,ref,alt = snp.split('.')
-        c1.execute('''select v.id from variants v
-                 inner join alleles a on a.id=v.anc
-                 inner join alleles b on b.id=v.der
-                 where v.pos=? and a.allele=? and b.allele=?''',
-                 (pos,ref,alt))
-    except:
+    ids = set(vids)
+    if len(snp.split('.')) != 3:
         c1.execute('''select v.id from variants v where pos=?
                            union
                       select v.id from variants v where id=?''', (snp,snp))
-    for row in c1:
-        ids.add(row[0])
-    c1 = c1.execute('select vid from snpnames where snpname=?', (snp.upper(),))
-    for row in c1:
-        ids.add(row[0])
+        for row in c1:
+            ids.add(row[0])
 
     poss = set()
     nams = set()
@@ -153,11 +167,14 @@ def querysnp(snp):
 
 
 if args.snp:
-    querysnp(args.snp[0])
+    querysnps(args.snp)
 
 if args.kit:
     listkit(args.kit[0])
 
+if args.duplicates:
+    listduplicates()
+
 dbconn.commit()
 dbcurs.close()
 trace(1, 'done at {:.2f} seconds'.format(time.time() - t0))
@@ -161,6 +161,11 @@ import argparse
 from time import time
 from collections import defaultdict
 
+# shared with the loader: finds the BED and VCF, even in a zip inside the zip
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from archive import KitArchive
+
 # default - how verbose - the higher the number, the more chatty
 DEBUG = 0
 
@@ -362,9 +367,6 @@ def extract_zips(unzip_dir, files):
     # all of the file names we could parse
     fname_dict = {}
 
-    bed_re = re.compile(r'(\b(?:\w*[^_/])?regions(?:\[\d\])?\.bed)')
-    vcf_re = re.compile(r'(\b(?:\w*[^_/])?variants(?:\[\d\])?\.vcf)')
-    zip_re = re.compile(r'(\b(?:\w*[^_/])?bigy.*\.zip)')
     mgroup = []
     for md,fnames in mdict.items():
         if md in rename_dict:
@@ -439,11 +441,6 @@ def extract_zips(unzip_dir, files):
 
     zipcount = 0
 
-    # keep track of what needs to be cleaned up
-    emptydirs = []
-
-    import zipfile
-
     for fname in fname_dict:
         kitnumber, kitname = fname_dict[fname]
         if kitnumber == None:
@@ -455,83 +452,40 @@ def extract_zips(unzip_dir, files):
             if os.path.isfile(vcffile) and os.path.isfile(bedfile):
                 trace(1, '%s-%s already exists and keep flag - skipping' % (kitname, kitnumber))
                 continue
+        # find the BED and VCF, which may be in a zip inside the zip
         try:
-            zf = zipfile.ZipFile(fname)
+            zf = KitArchive(fname)
         except:
             trace (0, 'WARN: not a zip file: {} from {}'.format(fname, os.getcwd()))
             continue
-        listfiles = zf.namelist()
-        bedfile = vcffile = zipfname = None
-        for ff in listfiles:
-            dirname, basename = os.path.split(ff)
-            if bed_re.search(basename):
-                bedfile = ff
-            elif vcf_re.search(basename):
-                vcffile = ff
-            elif zip_re.search(basename):
-                zipfname = ff
-            if dirname and (dirname not in emptydirs):
-                emptydirs.append(dirname)
-        if (not bedfile) or (not vcffile):
-            if not zipfname:
+        base = '%s-%s' % (kitname, kitnumber)
+        fpath = os.path.join(unzip_dir, '%s')
+        trace (3, fpath % base)
+        with zf:
+            if (not zf.bed) or (not zf.vcf):
                 trace(0, 'WARN: missing data in '+fname)
                 continue
-            else:
+            if vars(namespace)['rename']:
                 try:
-                    zf.extractall(unzip_dir, [zipfname,])
-                    emptydirs.append(os.path.join(unzip_dir, zipfname))
-                    bedfile = 'regions.bed'
-                    vcffile = 'variants.vcf'
-                    zf = zipfile.ZipFile(os.path.join(unzip_dir, zipfname))
+                    os.link(fname, (fpath % base)+'.zip')
+                    trace(1, 'ln {} {}.zip'.format(fname,(fpath % base)))
                 except:
-                    trace(0, 'WARN: missing data in '+fname)
+                    shutil.copy2(fname, (fpath % base)+'.zip')
+                    trace(1, 'cp -p {} {}.zip'.format(fname,(fpath % base)))
+            else:
+                # stream the data files straight to their final names
+                try:
+                    with zf.open_bed() as src, open((fpath % base)+'.bed', 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    with zf.open_vcf() as src, open((fpath % base)+'.vcf', 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                except RuntimeError:
+                    trace(0, 'WARN: {} would not extract - encrypted?'.format(base))
                     continue
-        try:
-            zf.extractall(unzip_dir, [bedfile, vcffile])
-        except RuntimeError:
-            trace(0, 'WARN: {} would not extract - encrypted?'.format(base))
-        base = '%s-%s' % (kitname, kitnumber)
-
-        fpath = os.path.join(unzip_dir, '%s')
-        trace (3, fpath % base)
-        if vars(namespace)['rename']:
-            try:
-                os.link(fname, (fpath % base)+'.zip')
-                trace(1, 'ln {} {}.zip'.format(fname,(fpath % base)))
-            except:
-                shutil.copy2(fname, (fpath % base)+'.zip')
-                trace(1, 'cp -p {} {}.zip'.format(fname,(fpath % base)))
-            emptydirs.append(fpath % bedfile)
-            emptydirs.append(fpath % vcffile)
-        else:
-            try:
-                os.rename(fpath % bedfile, (fpath % base)+'.bed')
-                os.rename(fpath % vcffile, (fpath % base)+'.vcf')
-            except:
-                trace(0, 'WARN: could not identify VCF and/or BED file for '+base)
         zipcount += 1
 
     trace (0, '%d new files extracted' % zipcount)
 
-    # clean up any empty dirs unzip created
-    if emptydirs:
-        trace (3, 'Trying to remove droppings:')
-        for dir in emptydirs:
-            if os.path.isfile(dir):
-                os.unlink(dir)
-        for dir in emptydirs:
-            if os.path.isfile(dir):
-                continue
-            try:
-                dp = os.path.join(unzip_dir, dir)
-                os.removedirs(dp)
-                trace (3, '  {0}'.format(dp))
-            except FileNotFoundError:
-                pass
-            except:
-                trace (3, '  W! could not remove {0}'.format(dp))
-                pass
-
     # list of file names we unzipped
     files = os.listdir(unzip_dir)
     return files
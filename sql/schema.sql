@@ -128,7 +128,7 @@ create table lab(
     unique(labNm)
     );
 
-/* the ranges (min,max) as reported in BED files */
+/* the ranges (min,max) of age.bed */
 drop table if exists bedranges;
 create table bedranges(
     ID INTEGER PRIMARY KEY,
@@ -141,50 +141,120 @@ create unique index rangeuniq on bedranges(minaddr, maxaddr);
 --create index rangeidx2 on bedranges(minaddr);
 
 /* ranges covered by tests as reported in the individual's BED file */
+/* clustered on the kit, so a kit's ranges are read in order in one scan */
 drop table if exists bed;
 create table bed(
     pID INTEGER REFERENCES dataset(ID),
-    bID INTEGER REFERENCES bedranges(ID)
+    minaddr INTEGER,
+    maxaddr INTEGER,
+    PRIMARY KEY(pID, minaddr, maxaddr)
+    ) WITHOUT ROWID;
+
+/* alternative to bed: all of a kit's ranges, merged and sorted, in one row */
+/* ranges holds (minaddr,maxaddr) pairs as little-endian int32 values */
+/* used when config bed_storage is blob */
+drop table if exists bedblob;
+create table bedblob(
+    pID INTEGER PRIMARY KEY,   -- DNAID of the kit
+    nranges INTEGER,           -- number of (minaddr,maxaddr) pairs
+    ranges BLOB
     );
-create index bedidx1 on bed(pID);
-create index bedidx2 on bed(bID);
 
 /* calls reported by the individual's VCF file */
+/* clustered on the kit; vcfidx1 has all of the columns, so lookups by */
+/* variant are also answered without going back to the table */
 drop table if exists vcfcalls;
 create table vcfcalls(
     pID INTEGER REFERENCES dataset(ID),
     vID INTEGER REFERENCES variants(ID),
-    callinfo INTEGER   --some info about this call packed into an int
-    );
-create index vcfidx1 on vcfcalls(vID);
-create index vcfpid2 on vcfcalls(pID);
+    callinfo INTEGER,  --some info about this call packed into an int
+    PRIMARY KEY(pID, vID)
+    ) WITHOUT ROWID;
+create index vcfidx1 on vcfcalls(vID, pID, callinfo);
 
 /* per-kit call statistics */
 drop table if exists vcfstats;
 create table vcfstats(
     pID INTEGER REFERENCES dataset(ID),
-    ny INTEGER,
-    nv INTEGER,
-    ns INTEGER,
-    ni INTEGER,
-    nr INTEGER
+    ny INTEGER,                -- calls in the VCF that were accounted for
+    nv INTEGER,                -- of those, calls that PASS
+    ns INTEGER,                -- of those, SNPs
+    ni INTEGER,                -- of those, indels
+    nr INTEGER,                -- calls stored in vcfcalls
+    nc INTEGER,                -- calls counted but not stored (call_filter)
+    nd INTEGER                 -- calls dropped without counting (call_filter)
 );
 
 /* per-kit BED coverage statistics */
 drop table if exists bedstats;
 create table bedstats(
-    pID INTEGER REFERENCES dataset(ID),
-    coverage1 INTEGER,
-    coverage2 INTEGER,
-    nranges INTEGER
+    pID INTEGER PRIMARY KEY REFERENCES dataset(ID),
+    coverage1 INTEGER,         -- positions covered by the kit's ranges
+    coverage2 INTEGER,         -- of those, positions in the age.bed ranges
+    nranges INTEGER            -- ranges in the BED file
 );
 
+/* where each kit's calls are in the call store file (see callstore.py) */
+drop table if exists callstore;
+create table callstore(
+    pID INTEGER PRIMARY KEY,   -- DNAID of the data set, as in vcfcalls
+    offset INTEGER,            -- byte offset of the kit's block in the file
+    ncalls INTEGER             -- number of calls in the block
+    );
+
+/* kits called derived for and covering each variant (see bitmaps.py) */
+/* derived and covered are zlib-compressed bitmaps with bit pID per kit */
+drop table if exists kitbitmaps;
+create table kitbitmaps(
+    vID INTEGER PRIMARY KEY,   -- ID of the variant
+    derived BLOB,              -- kits with a derived call for the variant
+    covered BLOB               -- kits whose BED ranges cover the variant
+    );
+
+/* the kits that are in kitbitmaps; bits of other kits are ignored */
+drop table if exists kitbitmapkits;
+create table kitbitmapkits(
+    pID INTEGER PRIMARY KEY    -- DNAID of the data set, as in vcfcalls
+    );
+
+/* load journal: what was loaded into vcfcalls and bed for each data set */
+/* used to skip unchanged kits and to reload changed or failed ones */
+drop table if exists loadjournal;
+create table loadjournal(
+    pID INTEGER PRIMARY KEY,   -- DNAID of the data set, as in vcfcalls
+    fileNm TEXT,               -- the zip file that was loaded
+    fileSize INTEGER,          -- size of the zip file in bytes
+    fileMtime REAL,            -- modification time of the zip file
+    hash TEXT,                 -- md5 of the zip file contents
+    parserVer INTEGER,         -- version of the kit parser that was used
+    nranges INTEGER,           -- number of rows stored in bed
+    ncalls INTEGER,            -- number of rows stored in vcfcalls
+    status TEXT,               -- 'loaded', 'duplicate', 'excluded' or 'failed'
+    loadDt TEXT,               -- when the load was done
+    dataHash TEXT,             -- md5 of the BED and VCF data in the zip
+    copyOf INTEGER,            -- for a duplicate, pID that has the same data
+    selection TEXT             -- for an excluded kit, the load_select criteria
+    );
+
+/* the SNP definitions file last applied to snpnames for each build */
+/* populate_SNPs compares against this to apply only what changed */
+drop table if exists snpsnapshot;
+create table snpsnapshot(
+    buildID INTEGER PRIMARY KEY,  -- build the definitions are for
+    fileNm TEXT,                  -- SNP definitions file, e.g. snps_hg38.csv
+    hash TEXT,                    -- md5 of the file when it was applied
+    nrows INTEGER,                -- distinct definitions in the file
+    refreshDt TEXT                -- when it was applied
+    );
+
 /* info about this entire data set or run */
 drop table if exists meta;
 create table meta(
     descr TEXT,
     val TEXT
     );
+/* layout of the tables, see migrate_schema in lib.py */
+insert into meta(descr,val) values('schema_version','2');
 
 /* table for STR definitions */
 drop table if exists strs;
@@ -204,6 +274,8 @@ create table strcalls(
     );
 
 /* list of all variants known for this computation */
+/* the UNIQUE index has the ID too, so lookups by position don't need the */
+/* table; the table itself stays in ID order for joins from vcfcalls */
 drop table if exists variants;
 create table variants(
     ID INTEGER PRIMARY KEY,
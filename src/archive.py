@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Copyright (c) 2018 the Authors
+#
+# Purpose: find and read the BED and VCF files inside kit zip archives
+#
+# Usage:
+#   import as a library; or
+#   run script as a command with zip file names to list what it finds
+#
+# Info:
+#   FTDNA zips sometimes hold the data files directly and sometimes hold
+#   another zip (a zip inside a zip) that holds them. KitArchive walks nested
+#   zips in memory, so the data files can be streamed without extracting
+#   anything to disk. This module doesn't depend on config.yaml, so the
+#   utilities in bin can use it too.
+#
+
+import gzip, hashlib, io, os, re, sys, zipfile
+
+# file names of the BED and VCF files inside a kit archive
+bed_re = re.compile(r'(\b(?:\w*[^_/])?regions(?:\[\d\])?\.bed)')
+vcf_re = re.compile(r'(\b(?:\w*[^_/])?variants(?:\[\d\])?\.vcf)')
+# file names of gVCF files, which have the coverage as well as the calls
+gvcf_re = re.compile(r'\.g\.?vcf(?:\.gz)?$', re.IGNORECASE)
+
+
+# Procedure: walk_zip
+# Purpose: iterate over the files in a zip, including files in nested zips
+# Input:
+#   zf, an open zipfile.ZipFile
+#   maxdepth (optional), how many levels of nested zips to descend into
+# Returns:
+#   a generator of (ZipFile, ZipInfo) pairs, one for each file; the ZipFile is
+#   the archive that directly contains the file
+# Info:
+#   The files of a zip are produced before the files of any zips it contains,
+#   so shallower files come first. A nested zip is read into memory only when
+#   the walk gets to it.
+def walk_zip(zf, maxdepth=2):
+    nested = []
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        if info.filename.lower().endswith('.zip'):
+            nested.append(info)
+        else:
+            yield zf, info
+    if maxdepth <= 0:
+        return
+    for info in nested:
+        try:
+            with zf.open(info) as member:
+                inner = zipfile.ZipFile(io.BytesIO(member.read()))
+        except (zipfile.BadZipFile, RuntimeError):
+            # not really a zip, or encrypted
+            continue
+        yield from walk_zip(inner, maxdepth-1)
+
+
+# Class: KitArchive
+# Purpose: locate the BED and VCF files of one kit's zip archive
+# Input:
+#   fname, path to the zip file
+# Info:
+#   bed and vcf are (ZipFile, ZipInfo) pairs, or None if the archive doesn't
+#   have that file. The first matching file is used, searching the outer zip
+#   before any nested zips. Use as a context manager so the zip is closed.
+#   An archive without an FTDNA VCF may have a gVCF (possibly gzipped)
+#   instead; then vcf is the gVCF and gvcf is True. A gVCF doesn't need a BED.
+#   A kit parser that reads only part of a large file, such as the chrY of a
+#   whole-genome VCF, sets quick_hash; then data_md5 uses the CRC-32 and size
+#   that the zip has for each file, instead of reading all of the file.
+# Examples:
+#   with KitArchive('bigy-Treece-N4826.zip') as ka:
+#       if ka.bed and ka.vcf:
+#           with ka.open_bed() as bedf:
+#               for line in bedf: ...
+class KitArchive(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.zf = zipfile.ZipFile(fname)
+        self.bed = self.vcf = None
+        self.quick_hash = False
+        gvcf = None
+        for member in walk_zip(self.zf):
+            basename = os.path.basename(member[1].filename)
+            if not self.bed and bed_re.search(basename):
+                self.bed = member
+            elif not self.vcf and vcf_re.search(basename):
+                self.vcf = member
+            elif not gvcf and gvcf_re.search(basename):
+                gvcf = member
+            if self.bed and self.vcf:
+                break
+        self.gvcf = not self.vcf and gvcf is not None
+        if self.gvcf:
+            self.vcf = gvcf
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        self.zf.close()
+    def find(self, regex):
+        'the first (ZipFile, ZipInfo) pair whose file name matches regex'
+        for member in walk_zip(self.zf):
+            if regex.search(os.path.basename(member[1].filename)):
+                return member
+        return None
+    def nested(self):
+        'True if the data files came from a zip inside the zip'
+        return any([m and m[0] is not self.zf for m in (self.bed, self.vcf)])
+    def open_bed(self):
+        'binary file object for reading the BED file'
+        return self.bed[0].open(self.bed[1])
+    def open_vcf(self):
+        'binary file object for reading the VCF file, uncompressed'
+        f = self.vcf[0].open(self.vcf[1])
+        if self.vcf[1].filename.lower().endswith('.gz'):
+            return gzip.GzipFile(fileobj=f)
+        return f
+    def data_md5(self):
+        'md5 of the BED followed by the VCF, the same however they were zipped'
+        md5hash = hashlib.md5()
+        for member, opener in ((self.bed, self.open_bed),
+                               (self.vcf, self.open_vcf)):
+            if not member:
+                continue
+            if self.quick_hash:
+                md5hash.update('{:08x}:{}\n'.format(member[1].CRC,
+                                       member[1].file_size).encode())
+                continue
+            with opener() as f:
+                for chunk in iter(lambda: f.read(1<<20), b''):
+                    md5hash.update(chunk)
+        return md5hash.hexdigest()
+
+
+# test framework
+if __name__=='__main__':
+    for fname in sys.argv[1:]:
+        with KitArchive(fname) as ka:
+            print(fname)
+            for label, member in (('bed', ka.bed), ('vcf', ka.vcf)):
+                print('  {}: {}'.format(label, member and member[1].filename))
+            if ka.nested():
+                print('  (nested zip)')
+            if ka.gvcf:
+                print('  (gVCF)')
+            if ka.vcf and (ka.bed or ka.gvcf):
+                print('  data md5: {}'.format(ka.data_md5()))
@@ -14,7 +14,10 @@
 #
 from collections import defaultdict
 import sys, yaml, time, os
-from lib import Trace, unpack_call
+import numpy as np
+from lib import Trace, unpack_calls, get_BED_stats, get_call_store, \
+                get_kit_ranges, get_age_ranges, json_list
+from db import db_manager
 from profile import profile
 
 # read the config file
@@ -37,39 +40,17 @@ trace = Trace(config['verbosity'])
 #   total sum of coverage (sum of bed ranges)
 #   total sum of coverage that is within the agebed ranges
 # Info:
-#   This is not done in the "brute force" way because it can be compute
-#   intensive to search the list for every range.
+#   The loader records both sums in bedstats. For a kit without a bedstats
+#   row, they are calculated from the kit's ranges but not stored, so this
+#   works on a read-only connection; filling in bedstats is the loader's job.
 @profile
 def get_kit_coverage(dbo, pid):
-    br = dbo.dc.execute('''select 1,minaddr from bedranges r
-                           inner join bed b on b.bid=r.id and b.pid=?
-                                union
-                           select 1,maxaddr from bedranges r
-                           inner join bed b on b.bid=r.id and b.pid=?
-                                union
-                           select 2,minaddr from bedranges b, agebed a
-                           where a.bID=b.id
-                                union
-                           select 2,maxaddr from bedranges b, agebed a
-                           where a.bID=b.id
-                           order by 2,1''', (pid,pid))
-    ids = {1:0, 2:1}
-    accum1 = 0
-    toggles = [False, False]
-    post = None
-    for r in br:
-        toggles[ids[r[0]]] ^= True
-        if post and (toggles[0] ^ toggles[1]):
-            accum1 += r[1]-post
-            post = None
-        elif toggles[0] & toggles[1]:
-            post = r[1]
-    if post:
-        accum1 += r[1]-post
-    accum2 = dbo.dc.execute('''select sum(maxaddr-minaddr) from bedranges r
-                           inner join bed b on r.id=b.bid and b.pid=?''',
-                        (pid,)).fetchone()[0]
-    return accum2, accum1
+    row = dbo.execute('''select coverage1, coverage2 from bedstats
+                         where pID=?''', (pid,)).fetchone()
+    if row:
+        return row[0], row[1]
+    stats = get_BED_stats(get_kit_ranges(dbo, pid), get_age_ranges(dbo))
+    return stats[0], stats[1]
 
 # values that may be returned by in_range
 RANGE_VALS = 'nc', 'cbl', 'cbh', 'cblh', 'cov'
@@ -145,16 +126,14 @@ def in_range(v_vect, ranges, spans):
 def get_variant_defs(db, vids):
     dc = db.cursor()
 
-    # for query efficiency, put the variants of interest into a tmp table
-    dc.execute('drop table if exists tmpt')
-    dc.execute('create temporary table tmpt(id integer)')
-    dc.executemany('insert into tmpt values(?)', [(v,) for v in vids])
+    # the variants of interest, joined as a table in the queries
+    vidlist = json_list(vids)
 
     # gather snp names
     snpnames = defaultdict(list)
     dc.execute('''select v.id,s.snpname from variants v
                   inner join snpnames s on s.vid=v.id
-                  inner join tmpt t on t.id=v.id''')
+                  inner join json_each(?) t on t.value=v.id''', (vidlist,))
     for vid,snpname in dc:
         snpnames[vid].append(snpname)
 
@@ -163,7 +142,7 @@ def get_variant_defs(db, vids):
     dc.execute('''select v.id,v.pos,aa.allele,ab.allele from variants v
                   inner join alleles aa on v.anc=aa.id
                   inner join alleles ab on v.der=ab.id
-                  inner join tmpt t on t.id=v.id''')
+                  inner join json_each(?) t on t.value=v.id''', (vidlist,))
     for vid,pos,ref,alt in dc:
         if snpnames[vid]:
             alias='/'.join(snpnames[vid])
@@ -225,29 +204,31 @@ def get_kit_ids(db, pids):
 def get_variant_array(db, ppl=None, SNPonly=False, ageonly=False):
     # FIXME: handle multiple calls at a given pos for a given person?
     # FIXME: downstream analysis may need additional info in return tuple
-    # FIXME: merge identical indels here?
-    # FIXME: performance - probably does a scan of vcfcalls
+    # identical indels are merged when kits are loaded (normalize_indels)
+    # FIXME: performance - probably does a scan of vcfcalls (see call_store)
     c1 = db.cursor()
-    c1.execute('drop table if exists tmpt')
-    c1.execute('create temporary table tmpt(id integer)')
 
-    # form a table with the people of interest so we can join with it
+    # form a list of the people of interest so we can join with it
+    excl = set([p for (p,) in c1.execute('select pid from exclude_kits')])
     if ppl:
-        c1.executemany('insert into tmpt values(?)', [(p,) for p in ppl])
-        c1.execute('''delete from tmpt
-                      where id in (select * from exclude_kits)''')
+        pids = [p for p in ppl if p not in excl]
     else:
-        c1.execute('''insert into tmpt
-                      select a.pid from analysis_kits a
-                      where not exists (select 1 from exclude_kits e
-                      where e.pid=a.pid)''')
-    trace(5, 'len(tmpt): {}'.format(
-                 c1.execute('select count(*) from tmpt').fetchone()[0]))
-
-    c1.execute('''select c.vid,c.pid,c.callinfo from vcfcalls c
-                  inner join tmpt t on c.pid=t.id
-                  where not exists (select 1 from exclude_variants e
-                          where e.vid=c.vid)''')
+        pids = [p for (p,) in c1.execute('select pid from analysis_kits')
+                    if p not in excl]
+    trace(5, 'len(pids): {}'.format(len(pids)))
+
+    # the calls come from the call store if it has all of the kits
+    store = get_call_store(db)
+    rows = store and store.rows(pids)
+    if rows is None:
+        c1.execute('''select c.vid,c.pid,c.callinfo from vcfcalls c
+                      inner join json_each(?) t on c.pid=t.value
+                      where not exists (select 1 from exclude_variants e
+                              where e.vid=c.vid)''', (json_list(pids),))
+        rows = np.array(c1.fetchall(), dtype=np.int64).reshape(-1,3)
+    else:
+        excl = [v for (v,) in c1.execute('select vid from exclude_variants')]
+        rows = rows[~np.isin(rows[:,0], excl)]
 
     # refpos processing
     #
@@ -275,23 +256,24 @@ def get_variant_array(db, ppl=None, SNPonly=False, ageonly=False):
     for pp in ppl:
         arr[pp] = defaultdict()
 
-    for (v,p,c) in c1:
-        passfail, gt, q1, q2, numcalls, passrate = unpack_call(c)
+    # decode all of the callinfo in one pass
+    calls = unpack_calls(rows[:,2])
+    for v,p,passfail,gt,numcalls in zip(rows[:,0].tolist(),
+                                        rows[:,1].tolist(),
+                                        calls['passfail'].tolist(),
+                                        calls['gt'].tolist(),
+                                        calls['nreads'].tolist()):
         # handle refpos variants
-        try:
+        if v in refpos:
             # swap variant and call's genotype; if we find the variant in the
             # refpos dict (queried above), the meaning of the call needs to be
             # swapped (0/0 becomes 1/1 and 1/1 becomes 0/0)
             v = refpos[v]
             gt = {0:1, 1:0, 2:2, 3:3}[gt]
-        except:
-            pass
         if passfail and numcalls > 1:
             arr[p][v] = (True, gt)
         var.add(v)
 
-    c1.execute('drop table tmpt')
-
     if ageonly or SNPonly:
         vdefs = get_variant_defs(db, var)
         # varpos tuple (pos, span, vid)
@@ -329,18 +311,15 @@ def get_variant_array(db, ppl=None, SNPonly=False, ageonly=False):
 def get_variant_csv(db, ppl):
     trace(2, 'get_variant_csv at {}'.format(time.clock()))
     # people of interest
-    dc = db.cursor()
-    dc.execute('drop table if exists tmpp')
-    dc.execute('create temporary table tmpp(pid integer)')
-    dc.executemany('insert into tmpp(pid) values(?)', [(p,) for p in ppl])
+    pidlist = json_list(ppl)
 
     # get variants in ascending order of number of calls across kits
     vc = db.cursor()
     vc.execute('''select v.id,v.anc,v.der,count(c.pid)
                   from variants v
                   inner join vcfcalls c on c.vid = v.id
-                  inner join tmpp t on t.pid = c.pid
-                  group by 1,2,3 order by 4''')
+                  inner join json_each(?) t on t.value = c.pid
+                  group by 1,2,3 order by 4''', (pidlist,))
 
     # variant list is used more than once, so make a list
     # keep only variants that have at least two call entries across all ppl
@@ -349,19 +328,17 @@ def get_variant_csv(db, ppl):
 
     cdict = get_kit_coverages(db, ppl, vl)
     tc = db.cursor()
-    tc.execute('drop table if exists tmpv')
-    tc.execute('create temporary table tmpv(vid integer)')
-    tc.executemany('insert into tmpv(vid) values(?)', [(v,) for v in vl])
     tc.execute('''select v.id,v.pos,a.allele,b.allele from variants v
                   inner join alleles a on a.id=v.anc
                   inner join alleles b on b.id=v.der
-                  inner join tmpv t on t.vid=v.id''')
+                  inner join json_each(?) t on t.value=v.id''',
+               (json_list(vl),))
     vlist=list([(v[0],'{}.{}.{}'.format(v[1],v[2],v[3])) for v in tc])
 
     # get all calls appearing in vcfcalls
     arr, pl, vlfull = get_variant_array(db, ppl)
     tc.execute('''select d.dnaid,d.kitid from dataset d
-                  inner join tmpp t on t.pid=d.dnaid''')
+                  inner join json_each(?) t on t.value=d.dnaid''', (pidlist,))
     klist = list([(k[0],k[1]) for k in tc])
 
     trace(2, 'write csv file at {}'.format(time.clock()))
@@ -440,35 +417,26 @@ def get_call_coverage(dbo, pid, vids, spans=None):
     # FIXME maybe more efficient to pass positions instead of ids
     # FIXME maybe calculate spans from variants instead of passing it in
     dc = dbo.cursor()
-    dc.execute('drop table if exists tmpt')
-    dc.execute('create table tmpt (vid integer)')
     trace(3, 'get_call_coverage: vids:{}...'.format(vids[:10]))
     if spans:
         trace(3, 'get_call_coverage: spans:{}...'.format(spans[:10]))
-    dc.executemany('insert into tmpt values(?)', [(a,) for a in vids])
     # get list of variants of interest ordered by position
     calls = dc.execute('''select v.id, v.pos from variants v
-                          inner join tmpt t on t.vid=v.id
-                          order by 2''')
+                          inner join json_each(?) t on t.value=v.id
+                          order by 2''', (json_list(vids),))
     # form a list of positions of interest
     xl = list([(v[0],v[1]) for v in calls])
     iv = [v[0] for v in xl]
     pv = [v[1] for v in xl]
     trace(500, '{} calls: {}...'.format(len(pv), pv[:20]))
     # get the ordered list of ranges of interest
-    rc = dbo.cursor()
-    ranges = rc.execute('''select minaddr,maxaddr from bedranges r
-                           inner join bed b on b.bID=r.id
-                           where b.pid=?
-                           order by 1''', (pid,))
-    rv = [v for v in ranges]
+    rv = get_kit_ranges(dbo, pid).tolist()
     if len(rv) == 0:
         return []
     trace(500, '{} ranges: {}...'.format(len(rv), rv[:20]))
     # calculate coverage vector
     coverage = in_range(pv, rv, spans)
     dc.close()
-    rc.close()
     return iv, coverage
 
 # Procedure: get_kit_coverages
@@ -481,23 +449,22 @@ def get_call_coverage(dbo, pid, vids, spans=None):
 #   2d dictionary indexed by pid,vid with False if vid not covered
 # Info:
 #   determines indels and snps in the list of variants and calls
-#   get_call_coverage for each person in the list
+#   get_call_coverage for each person in the list. The kits are spread over
+#   the read-only connections of db_manager (see db_readers in config.yaml),
+#   which only see what has been committed.
 @profile
 def get_kit_coverages(db, pids, vids):
 
     # these are the variants to inspect
-    c = db.cursor()
-    c.execute('drop table if exists tmpt')
-    c.execute('create table tmpt(vid integer)')
-    c.executemany('insert into tmpt(vid) values(?)', [(v,) for v in vids])
+    vidlist = json_list(vids)
 
     c = db.cursor()
     c.execute('''select distinct v.id,max(length(a.allele),length(b.allele))
                  from variants v
                  inner join alleles a on a.id=v.anc
                  inner join alleles b on b.id=v.der
-                 inner join tmpt c on c.vid=v.id
-                 where length(a.allele)>1 or length(b.allele)>1''')
+                 inner join json_each(?) c on c.value=v.id
+                 where length(a.allele)>1 or length(b.allele)>1''', (vidlist,))
     indels = [t for t in c]
     indel_ids = list([t[0] for t in indels])
     spans = list([int(t[1]) for t in indels])
@@ -507,43 +474,44 @@ def get_kit_coverages(db, pids, vids):
                  from variants v
                  inner join alleles a on a.id=v.anc
                  inner join alleles b on b.id=v.der
-                 inner join tmpt c on c.vid=v.id
-                 where length(a.allele)=1 and length(b.allele)=1''')
+                 inner join json_each(?) c on c.value=v.id
+                 where length(a.allele)=1 and length(b.allele)=1''', (vidlist,))
     snps = [t for t in c]
     snp_ids = list([t[0] for t in snps])
 
-    cdict = {}
-    trace(1, 'calculate coverages')
-    for pid in pids:
-        cdict[pid] = defaultdict()
-    for pid in pids:
+    # coverage of one kit, on one of the readers
+    def kit_coverage(dbo, pid):
+        kcov = defaultdict()
         # get indel coverage for a kit
         trace(3, 'indels for kit {} at {}...'.format(pid,time.clock()))
         trace(4, 'get_call_coverage(db, {}, {}, {})'.format(pid,[(i[0],i[1]) for i in enumerate(indel_ids)][:50],[(i[0],i[1]) for i in enumerate(spans)][:50]))
-        iv,cv = get_call_coverage(db, pid, indel_ids, spans)
+        iv,cv = get_call_coverage(dbo, pid, indel_ids, spans)
         trace(5, 'indels:{}..., coverage:{}...'.format([(i[0],i[1]) for i in enumerate(iv)][:50], [(i[0],i[1]) for i in enumerate(cv)][:50]))
         # store coverage information
         for cov,vid in zip(cv, iv):
             if cov != RANGE_COV:
-                cdict[pid][vid] = cov
+                kcov[vid] = cov
         # get snp coverage for a kit
         trace(3, 'snps for kit {} at {}...'.format(pid,time.clock()))
         trace(4, 'get_call_coverage(db, {}, {})'.format(pid,snp_ids))
-        iv,cv = get_call_coverage(db, pid, snp_ids)
+        iv,cv = get_call_coverage(dbo, pid, snp_ids)
         trace(5, 'snps:{}..., coverage:{}...'.format(iv[:5], cv[:5]))
         # store "not-covered" since it's sparse
         for cov,vid in zip(cv, iv):
             if cov != RANGE_COV:
-                cdict[pid][vid] = cov
-    return cdict
+                kcov[vid] = cov
+        return kcov
+
+    trace(1, 'calculate coverages')
+    pids = list(pids)
+    return dict(zip(pids, db_manager(db.dbfname).map(kit_coverage, pids)))
 
 # test framework
 if __name__=='__main__':
-    from db import DB
     from subprocess import call
     t0 = time.time()
     # smoke test DB __init__
-    db = DB(drop=False)
+    db = db_manager().writer()
     # smoke test trace() and get_analysis_ids()
     trace(0, 'test message should display to stdout')
     ids = get_analysis_ids(db)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Copyright (c) 2018 the Authors
+#
+# Purpose: bitmaps of the kits that are derived for and cover each variant
+#
+# Usage:
+#   import as a library
+#
+# Info:
+#   Clade detection is set algebra over which kits have which variants. A
+#   KitSet is a set of kits (pIDs) kept as a bitmap, bit pID of an array of
+#   64-bit words, so intersections, unions, differences and counts are a few
+#   numpy operations however many kits there are. KitBitmaps is an index with
+#   two KitSets for each variant: the kits that are called derived for it,
+#   and the kits whose BED ranges cover it. The index is persisted in the
+#   kitbitmaps table, one row per variant with each bitmap zlib-compressed,
+#   and kitbitmapkits lists the kits that are in it. Bits of kits that aren't
+#   in kitbitmapkits are ignored, so a kit is taken out of the index by
+#   deleting its kitbitmapkits row, and its bits are cleared the next time
+#   the index is updated.
+#
+
+import zlib
+import numpy as np
+
+# number of 1 bits in each byte value
+POPCOUNT8 = np.array([bin(b).count('1') for b in range(256)], dtype=np.int64)
+
+
+# Class: KitSet
+# Purpose: a set of kit pIDs as a bitmap
+# Input:
+#   words (optional), a uint64 array with bit pID set for each kit in the set
+# Info:
+#   The operators are those of python sets: & | ^ - <= >= ==, and len() is
+#   the number of kits. Bitmaps of different lengths can be combined; the
+#   missing words are zeroes.
+# Examples:
+#   a = KitSet.from_pids([3, 17, 200])
+#   if (a & b) == a: ...        # every kit in a is in b
+#   len(covered - derived)      # kits called ancestral or not called
+class KitSet(object):
+    def __init__(self, words=None):
+        if words is None:
+            words = np.zeros(0, dtype=np.uint64)
+        self.words = words
+
+    # Method: from_pids
+    # Purpose: make a KitSet with the kits in a list of pIDs
+    @classmethod
+    def from_pids(cls, pids, nwords=0):
+        pids = np.asarray(pids, dtype=np.int64)
+        if len(pids):
+            nwords = max(nwords, int(pids.max()) // 64 + 1)
+        words = np.zeros(nwords, dtype=np.uint64)
+        np.bitwise_or.at(words, pids // 64,
+                         np.left_shift(np.uint64(1), (pids % 64).astype(np.uint64)))
+        return cls(words)
+
+    # Method: from_bytes
+    # Purpose: make a KitSet from the bytes made by to_bytes
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls()
+        return cls(np.frombuffer(zlib.decompress(data), dtype='<u8').copy())
+
+    # Method: to_bytes
+    # Purpose: the bitmap as compressed bytes, for storing in a blob
+    # Info:
+    #   Trailing zero words are dropped; the runs of zero bits of a sparse
+    #   bitmap and the runs of one bits of a dense one compress to very little.
+    def to_bytes(self):
+        words = self.words[:self.nwords()]
+        return zlib.compress(words.astype('<u8').tobytes())
+
+    # Method: nwords
+    # Purpose: the number of words up to and including the last one in use
+    def nwords(self):
+        used = np.flatnonzero(self.words)
+        return int(used[-1]) + 1 if len(used) else 0
+
+    # Method: pids
+    # Purpose: the pIDs of the kits in the set, in increasing order
+    def pids(self):
+        bits = np.unpackbits(self.words.astype('<u8').view(np.uint8),
+                             bitorder='little')
+        return np.flatnonzero(bits)
+
+    # words of two KitSets, padded to the same length
+    def _pair(self, other):
+        a, b = self.words, other.words
+        if len(a) < len(b):
+            a = np.concatenate([a, np.zeros(len(b) - len(a), dtype=np.uint64)])
+        elif len(b) < len(a):
+            b = np.concatenate([b, np.zeros(len(a) - len(b), dtype=np.uint64)])
+        return a, b
+
+    def __and__(self, other):
+        n = min(len(self.words), len(other.words))
+        return KitSet(self.words[:n] & other.words[:n])
+    def __or__(self, other):
+        a, b = self._pair(other)
+        return KitSet(a | b)
+    def __xor__(self, other):
+        a, b = self._pair(other)
+        return KitSet(a ^ b)
+    def __sub__(self, other):
+        'and-not: the kits in self that are not in other'
+        a, b = self._pair(other)
+        return KitSet((a & ~b)[:len(self.words)])
+    def __eq__(self, other):
+        a, b = self._pair(other)
+        return bool(np.array_equal(a, b))
+    def __ne__(self, other):
+        return not self == other
+    def __le__(self, other):
+        'every kit in self is in other'
+        a, b = self._pair(other)
+        return not np.any(a & ~b)
+    def __ge__(self, other):
+        return other <= self
+    def __len__(self):
+        return int(POPCOUNT8[self.words.view(np.uint8)].sum())
+    def __bool__(self):
+        return bool(np.any(self.words))
+    def __contains__(self, pid):
+        word = pid // 64
+        return word < len(self.words) and \
+            bool((int(self.words[word]) >> (pid % 64)) & 1)
+    def __iter__(self):
+        return iter(self.pids().tolist())
+    def __repr__(self):
+        return 'KitSet({})'.format(self.pids().tolist())
+    def issubset(self, other):
+        return self <= other
+    def issuperset(self, other):
+        return other <= self
+    def isdisjoint(self, other):
+        return not (self & other)
+
+
+# Procedure: covered_mask
+# Purpose: find which variant positions a kit's ranges cover
+# Input:
+#   ranges, sorted, non-overlapping (minaddr,maxaddr) ranges (merge_ranges)
+#   pos, an array of variant positions, in any order
+#   span, an array of the number of positions each variant takes up
+# Returns:
+#   a bool array, True where the variant is inside a range
+# Info:
+#   BED ranges are zero-based, so (5,10) covers positions 6 to 10. A variant
+#   that runs past the end of its range isn't covered.
+def covered_mask(ranges, pos, span):
+    if len(ranges) == 0:
+        return np.zeros(len(pos), dtype=bool)
+    ii = np.searchsorted(ranges[:,0] + 1, pos, side='right') - 1
+    return (ii >= 0) & (pos + span - 1 <= ranges[np.maximum(ii, 0), 1])
+
+
+# Class: KitBitmaps
+# Purpose: read and update the derived and covered bitmaps of the variants
+# Input:
+#   dbo, a database object, which has the kitbitmaps and kitbitmapkits tables
+#   get_ranges, a function (dbo, pid) that gives a kit's sorted, merged BED
+#     ranges
+#   is_derived, a function (callinfo array) that gives True for derived calls
+# Examples:
+#   bm = KitBitmaps(db, get_ranges, is_derived)
+#   derived, covered = bm.get(vid)
+#   negative = covered - derived
+class KitBitmaps(object):
+    def __init__(self, dbo, get_ranges, is_derived):
+        self.dbo = dbo
+        self.get_ranges = get_ranges
+        self.is_derived = is_derived
+
+    # Method: kits
+    # Purpose: the KitSet of the kits that are in the index
+    def kits(self):
+        return KitSet.from_pids([p for (p,) in self.dbo.execute(
+                                     'select pID from kitbitmapkits')])
+
+    # Method: get
+    # Purpose: get the bitmaps of a variant
+    # Returns:
+    #   (derived, covered) KitSets; both are empty if the variant isn't in
+    #   the index
+    def get(self, vid):
+        return self.get_many([vid]).get(vid, (KitSet(), KitSet()))
+
+    # Method: get_many
+    # Purpose: get the bitmaps of a list of variants
+    # Returns:
+    #   a dictionary of vID: (derived, covered) for the variants in the index
+    def get_many(self, vids):
+        kits = self.kits()
+        bitmaps = {}
+        vids = list(vids)
+        for ii in range(0, len(vids), 500):
+            chunk = vids[ii:ii+500]
+            for vid, derived, covered in self.dbo.execute(
+                    '''select vID, derived, covered from kitbitmaps
+                       where vID in ({})'''.format(','.join('?'*len(chunk))),
+                    chunk):
+                bitmaps[vid] = (KitSet.from_bytes(derived) & kits,
+                                KitSet.from_bytes(covered) & kits)
+        return bitmaps
+
+    # Method: update
+    # Purpose: bring the index up to date with the kits that are loaded
+    # Input:
+    #   chunksize (optional), how many variants to work on at a time
+    # Returns: the number of kits that were added to the index
+    # Info:
+    #   A kit is loaded if it has a vcfstats row. The bits of loaded kits that
+    #   aren't in the index yet are set, and those of kits that were taken
+    #   out are cleared. New variants also get the bits of the kits that were
+    #   already in the index. Kits are added a chunk of variants at a time, so
+    #   only one chunk's bitmaps are uncompressed at once; the kits' ranges
+    #   and derived calls are kept in memory.
+    def update(self, chunksize=1<<16):
+        dc = self.dbo.cursor()
+        indexed = set([p for (p,) in dc.execute('select pID from kitbitmapkits')])
+        loaded = set([p for (p,) in dc.execute('select pID from vcfstats')])
+        add = sorted(loaded - indexed)
+        keep = sorted(loaded & indexed)
+        rows = dc.execute('''select v.id, v.pos,
+                                 max(length(a.allele),length(b.allele)),
+                                 k.vID is not null
+                             from variants v
+                             inner join alleles a on a.id=v.anc
+                             inner join alleles b on b.id=v.der
+                             left join kitbitmaps k on k.vID=v.id
+                             order by v.id''').fetchall()
+        var = np.array(rows, dtype=np.int64).reshape(-1,4)
+        new = var[:,3] == 0
+        if not add and not new.any() and len(keep) == len(indexed):
+            return 0
+
+        # what's needed of each kit: its ranges and derived vIDs
+        ranges = {}
+        derived = []
+        for pid in add:
+            ranges[pid] = self.get_ranges(self.dbo, pid)
+            calls = np.array(dc.execute('''select vID, callinfo from vcfcalls
+                                           where pID=?''', (pid,)).fetchall(),
+                             dtype=np.int64).reshape(-1,2)
+            calls = calls[self.is_derived(calls[:,1]), 0]
+            derived.append(np.stack([calls, np.full(len(calls), pid)], axis=1))
+        if new.any() and keep:
+            newvids = var[new,0]
+            for pid in keep:
+                ranges[pid] = self.get_ranges(self.dbo, pid)
+            calls = np.array(dc.execute('''select vID, pID, callinfo from vcfcalls
+                                           where vID between ? and ?''',
+                                        (int(newvids.min()), int(newvids.max()))
+                                        ).fetchall(), dtype=np.int64).reshape(-1,3)
+            calls = calls[np.isin(calls[:,0], newvids) &
+                          np.isin(calls[:,1], keep) & self.is_derived(calls[:,2])]
+            derived.append(calls[:,:2])
+        derived = np.concatenate(derived) if derived else np.zeros((0,2), np.int64)
+        derived = derived[np.argsort(derived[:,0], kind='stable')]
+
+        nwords = max(loaded | indexed | set([0])) // 64 + 1
+        keepmask = KitSet.from_pids(keep, nwords).words
+        one = np.uint64(1)
+        for isnew, kits in ((False, add), (True, add + keep)):
+            part = var[new == isnew]
+            for ii in range(0, len(part), chunksize):
+                vids, pos, span = part[ii:ii+chunksize,:3].T
+                dwords = np.zeros((len(vids), nwords), dtype=np.uint64)
+                cwords = np.zeros((len(vids), nwords), dtype=np.uint64)
+                if not isnew:
+                    old = dict([(v, (d, c)) for (v, d, c) in dc.execute(
+                        '''select vID, derived, covered from kitbitmaps
+                           where vID between ? and ?''',
+                        (int(vids.min()), int(vids.max())))])
+                    for jj, vid in enumerate(vids.tolist()):
+                        for words, data in zip((dwords, cwords), old[vid]):
+                            bits = KitSet.from_bytes(data).words[:nwords]
+                            words[jj,:len(bits)] = bits & keepmask[:len(bits)]
+                for pid in kits:
+                    cov = covered_mask(ranges[pid], pos, span)
+                    cwords[cov, pid // 64] |= one << np.uint64(pid % 64)
+                lo, hi = np.searchsorted(derived[:,0], [vids.min(), vids.max()+1])
+                calls = derived[lo:hi]
+                jj = np.searchsorted(vids, calls[:,0])
+                hit = (jj < len(vids)) & \
+                      (vids[np.minimum(jj, len(vids)-1)] == calls[:,0])
+                pids = calls[hit,1].astype(np.uint64)
+                np.bitwise_or.at(dwords, (jj[hit], (pids // 64).astype(np.int64)),
+                                 one << (pids % np.uint64(64)))
+                dc.executemany('''insert or replace into
+                                  kitbitmaps(vID, derived, covered)
+                                  values(?,?,?)''',
+                               [(v, KitSet(d).to_bytes(), KitSet(c).to_bytes())
+                                for v, d, c in zip(vids.tolist(), dwords, cwords)])
+        dc.executemany('delete from kitbitmapkits where pID=?',
+                       [(p,) for p in indexed - loaded])
+        dc.executemany('insert into kitbitmapkits(pID) values(?)',
+                       [(p,) for p in add])
+        return len(add)
+
+    # Method: rebuild
+    # Purpose: make the index again from all of the loaded kits
+    def rebuild(self):
+        self.dbo.execute('delete from kitbitmaps')
+        self.dbo.execute('delete from kitbitmapkits')
+        n = self.update()
+        self.dbo.commit()
+        return n
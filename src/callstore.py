@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Copyright (c) 2018 the Authors
+#
+# Purpose: keep each kit's calls as arrays in a memory-mapped file
+#
+# Usage:
+#   import as a library
+#
+# Info:
+#   vcfcalls is the system of record. The call store is a copy of it that
+#   can be read a kit at a time as numpy arrays, without a query or a python
+#   tuple per call. Each kit's calls are one block in the store file: the
+#   vIDs as little-endian int32, sorted, then the callinfo of each as int64.
+#   The callstore table has the offset of each kit's block, so a block is
+#   stored in the same transaction as the kit's vcfcalls rows. Blocks are
+#   only ever appended; a reloaded kit gets a new block and the old one is
+#   left unused until the store is rebuilt.
+#
+
+import os
+import numpy as np
+
+
+# Class: CallStore
+# Purpose: read and write the kit blocks of a call store file
+# Input:
+#   dbo, a database object, which has the callstore table
+#   fname, path to the store file
+# Examples:
+#   store = CallStore(db, 'callstore.bin')
+#   vids, callinfo = store.calls(pid)
+class CallStore(object):
+    def __init__(self, dbo, fname):
+        self.dbo = dbo
+        self.fname = fname
+        self.mm = None
+
+    # Method: append
+    # Purpose: store the calls of a kit, replacing what was stored before
+    # Input:
+    #   pid, a person ID
+    #   vids, the variant IDs of the kit's calls
+    #   callinfo, the packed callinfo of each call
+    # Info:
+    #   The calls are sorted by vID; calls of the same variant stay in the
+    #   order given. Blocks start on 8-byte boundaries, so both arrays of a
+    #   block are aligned.
+    def append(self, pid, vids, callinfo):
+        vids = np.asarray(vids, dtype=np.int64)
+        order = np.argsort(vids, kind='stable')
+        vids = vids[order].astype('<i4')
+        callinfo = np.asarray(callinfo, dtype=np.int64)[order].astype('<i8')
+        with open(self.fname, 'ab') as f:
+            offset = f.tell()
+            f.write(bytes(-offset % 8))
+            offset += -offset % 8
+            f.write(vids.tobytes())
+            f.write(bytes(-vids.nbytes % 8))
+            f.write(callinfo.tobytes())
+        self.dbo.execute('''insert or replace into callstore(pID,offset,ncalls)
+                            values(?,?,?)''', (pid, offset, len(vids)))
+        self.mm = None
+        return len(vids)
+
+    # Method: calls
+    # Purpose: get the calls of a kit
+    # Returns:
+    #   (vids, callinfo) arrays that are views of the mapped file, or None if
+    #   the kit isn't in the store
+    def calls(self, pid):
+        row = self.dbo.execute('''select offset, ncalls from callstore
+                                  where pID=?''', (pid,)).fetchone()
+        if not row:
+            return None
+        offset, n = row
+        if n == 0:
+            return np.zeros(0, dtype='<i4'), np.zeros(0, dtype='<i8')
+        if self.mm is None or len(self.mm) < offset + 12*n:
+            self.mm = np.memmap(self.fname, dtype=np.uint8, mode='r')
+        vids = self.mm[offset:offset+4*n].view('<i4')
+        offset += 4*n + (-4*n % 8)
+        return vids, self.mm[offset:offset+8*n].view('<i8')
+
+    # Method: rows
+    # Purpose: get the calls of a list of kits as (vid, pid, callinfo) rows
+    # Returns:
+    #   an int64 array with a row for each call, or None if a kit that has
+    #   calls in vcfcalls isn't in the store
+    def rows(self, pids):
+        blocks = []
+        for pid in pids:
+            calls = self.calls(pid)
+            if calls is None:
+                if self.dbo.execute('select 1 from vcfcalls where pID=? limit 1',
+                                    (pid,)).fetchone():
+                    return None
+                continue
+            block = np.empty((len(calls[0]), 3), dtype=np.int64)
+            block[:,0], block[:,1], block[:,2] = calls[0], pid, calls[1]
+            blocks.append(block)
+        if not blocks:
+            return np.zeros((0,3), dtype=np.int64)
+        return np.concatenate(blocks)
+
+    # Method: rebuild
+    # Purpose: write the store again from vcfcalls
+    # Info:
+    #   This is how a store is made for kits that were loaded before the
+    #   store was turned on, and it also drops the unused blocks.
+    def rebuild(self):
+        self.dbo.execute('delete from callstore')
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+        self.mm = None
+        pids = [p for (p,) in self.dbo.execute(
+                    'select distinct pID from vcfcalls order by 1')]
+        for pid in pids:
+            rows = self.dbo.execute('''select vID, callinfo from vcfcalls
+                                       where pID=? order by vID''',
+                                    (pid,)).fetchall()
+            rows = np.array(rows, dtype=np.int64).reshape(-1,2)
+            self.append(pid, rows[:,0], rows[:,1])
+        self.dbo.commit()
+        return len(pids)
@@ -6,26 +6,51 @@
 # Purpose: low level interface to the data layer for DNA analysis
 #
 
-import os, sqlite3, yaml
+import os, queue, sqlite3, threading, yaml
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from urllib.request import pathname2url
 
 REDUX_CONF = 'config.yaml'
 config = yaml.load(open(REDUX_CONF))
 
 
+# Class: DB
+# Purpose: a connection to the database
+# Input:
+#   dbfname (optional), the database file
+#   drop (optional), remove the file first, for a new database
+#   fastload (optional), don't wait for writes to reach the disk
+#   readonly (optional), open the file read-only (a mode=ro URI)
+# Info:
+#   Every connection gets the db_pragmas from config.yaml. Connections can
+#   be used from any thread, though only by one thread at a time. A
+#   read-only connection is in autocommit mode, so it doesn't hold on to a
+#   read transaction, and it sees what the writer has committed. Use
+#   db_manager to get connections rather than opening them directly.
 class DB(sqlite3.Connection):
 
-    def __init__(self, dbfname=config['DB_FILE'], drop=True, fastload=False):
+    def __init__(self, dbfname=config['DB_FILE'], drop=True, fastload=False,
+                 readonly=False):
         self.dbfname = dbfname
-        # just remove the file, which is often faster than dropping big tables
-        if drop and os.path.exists(dbfname):
-            os.unlink(dbfname)
-        sqlite3.Connection.__init__(self, database=dbfname)
+        self.readonly = readonly
+        if readonly:
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(dbfname)))
+            sqlite3.Connection.__init__(self, database=uri, uri=True,
+                                        isolation_level=None,
+                                        check_same_thread=False)
+        else:
+            # just remove the file, which is often faster than dropping big tables
+            if drop and os.path.exists(dbfname):
+                os.unlink(dbfname)
+            sqlite3.Connection.__init__(self, database=dbfname,
+                                        check_same_thread=False)
+        for pragma, val in config['db_pragmas'].items():
+            self.execute('PRAGMA {}={}'.format(pragma, val))
         if fastload:
-            # these options may improve load performance
-            # affect whether or not to wait for data write to disk
+            # don't wait for data writes to get to the disk; the database is
+            # not locked for exclusive use, so the readers still work
             self.execute('PRAGMA synchronous=OFF')
-            # force single-user for slightly better performance
-            self.execute('PRAGMA locking_mode=EXCLUSIVE')
 
     def run_sql_file(self, FILE):
         with open(FILE,'r') as fh:
@@ -34,9 +59,187 @@ class DB(sqlite3.Connection):
     def create_schema(self, schemafile='schema.sql'):
         self.run_sql_file(os.path.join(config['REDUX_SQL'],schemafile))
 
+    # Method: bulk_load
+    # Purpose: context manager for loading large amounts of data
+    # Input:
+    #   tables (optional), names of the tables that will be loaded; all tables
+    #     if not given
+    # Info:
+    #   Secondary indexes on the tables are dropped on entry and re-created
+    #   from their saved definitions on exit, followed by ANALYZE and PRAGMA
+    #   optimize. Indexes that enforce uniqueness are left in place, since
+    #   loaders rely on them for "insert or ignore". The bulk_load_pragmas from
+    #   config.yaml are in effect while loading, and restored afterwards.
+    #   Work is committed on exit, or rolled back if the block raised.
+    @contextmanager
+    def bulk_load(self, tables=None):
+        self.commit()
+        sql = '''select name, tbl_name, sql from sqlite_master
+                 where type='index' and sql is not null
+                 and sql not like 'create unique%'
+              '''
+        indexes = [r for r in self.execute(sql)
+                       if tables is None or r[1] in tables]
+        for name, tbl, isql in indexes:
+            self.execute('drop index {}'.format(name))
+        saved = {}
+        for pragma, val in config['bulk_load_pragmas'].items():
+            saved[pragma] = self.execute('PRAGMA {}'.format(pragma)).fetchone()[0]
+            self.execute('PRAGMA {}={}'.format(pragma, val))
+        try:
+            yield self
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        finally:
+            for name, tbl, isql in indexes:
+                self.execute(isql)
+            for tbl in set([r[1] for r in indexes]):
+                self.execute('analyze {}'.format(tbl))
+            self.execute('PRAGMA optimize')
+            self.commit()
+            for pragma, val in saved.items():
+                self.execute('PRAGMA {}={}'.format(pragma, val))
+
+
+# Class: DBManager
+# Purpose: share one read-write connection and a pool of read-only ones
+# Input:
+#   dbfname (optional), the database file
+#   nreaders (optional), the most read-only connections to have open;
+#     config db_readers by default, where 0 means one per CPU
+# Info:
+#   The database is in WAL mode (see schema.sql), so the readers don't block
+#   the writer or each other, and a query can be spread over the readers by
+#   map. Connections are opened when they're first needed. A manager can be
+#   handed to a worker process (it pickles without its connections), and
+#   one that's used in a forked process opens its own connections there.
+# Examples:
+#   db = db_manager().writer()
+#   with db_manager().reader() as dbo:
+#       dbo.execute(...)
+#   covs = db_manager().map(get_coverage, pids)
+class DBManager(object):
+    def __init__(self, dbfname=config['DB_FILE'], nreaders=None):
+        self.dbfname = dbfname
+        if nreaders is None:
+            nreaders = config['db_readers']
+        self.nreaders = nreaders or os.cpu_count()
+        self.reset()
+
+    # Method: reset
+    # Purpose: forget the connections, e.g. those of a parent process
+    def reset(self):
+        self.pid = os.getpid()
+        self.rw = None
+        self.idle = queue.LifoQueue()
+        self.nopen = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'dbfname': self.dbfname, 'nreaders': self.nreaders}
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+    # connections aren't shared with a forked process
+    def check_pid(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    # Method: writer
+    # Purpose: get the read-write connection
+    # Input:
+    #   drop (optional), start over with a new database file
+    #   fastload (optional), as for DB
+    def writer(self, drop=False, fastload=False):
+        self.check_pid()
+        with self.lock:
+            if drop:
+                self.close_all()
+            if self.rw is None:
+                self.rw = DB(self.dbfname, drop=drop, fastload=fastload)
+            elif fastload:
+                self.rw.execute('PRAGMA synchronous=OFF')
+        return self.rw
+
+    # Method: acquire
+    # Purpose: take a read-only connection from the pool
+    # Info:
+    #   If all nreaders connections are in use, this waits for one to be
+    #   released.
+    def acquire(self):
+        self.check_pid()
+        with self.lock:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                if self.nopen < self.nreaders:
+                    self.nopen += 1
+                    return DB(self.dbfname, drop=False, readonly=True)
+        return self.idle.get()
+
+    # Method: release
+    # Purpose: give a read-only connection back to the pool
+    def release(self, dbo):
+        self.idle.put(dbo)
+
+    # Method: reader
+    # Purpose: context manager for borrowing a read-only connection
+    @contextmanager
+    def reader(self):
+        dbo = self.acquire()
+        try:
+            yield dbo
+        finally:
+            self.release(dbo)
+
+    # Method: map
+    # Purpose: call func(dbo, item) for each item, spread over the readers
+    # Returns: the list of results, in the order of items
+    # Info:
+    #   The calls run in threads, each with a read-only connection; sqlite
+    #   releases the GIL while it works on a query. Readers only see what has
+    #   been committed.
+    def map(self, func, items):
+        def run(item):
+            with self.reader() as dbo:
+                return func(dbo, item)
+        items = list(items)
+        if self.nreaders < 2 or len(items) < 2:
+            return [run(item) for item in items]
+        with ThreadPool(min(self.nreaders, len(items))) as pool:
+            return pool.map(run, items)
+
+    # Method: close_all
+    # Purpose: close the writer and the readers that aren't in use
+    def close_all(self):
+        if self.rw is not None:
+            self.rw.close()
+            self.rw = None
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+            self.nopen -= 1
+
+
+# the managers of this process, by database file
+managers = {}
+
+# Procedure: db_manager
+# Purpose: get the shared connection manager for a database file
+# Input:
+#   dbfname (optional), the database file; DB_FILE by default
+# Returns: a DBManager, the same one each time for the same file
+def db_manager(dbfname=None):
+    key = os.path.abspath(dbfname or config['DB_FILE'])
+    if key not in managers:
+        managers[key] = DBManager(dbfname or config['DB_FILE'])
+    return managers[key]
+
 
 # test framework
 if __name__=='__main__':
-    db = DB()
+    db = db_manager().writer(drop=True)
     db.create_schema()
     db.commit()
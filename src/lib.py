@@ -14,17 +14,21 @@
 #   config.yaml is read for configuration settings
 #
 
-import os, yaml, shutil, re, csv, zipfile, subprocess
-from db import DB
+import os, yaml, shutil, re, csv, zipfile, subprocess, glob
+from db import db_manager
+from archive import KitArchive
+from names import json_list, get_build_byname, resolve_names, \
+                  get_duplicate_kits
+from callstore import CallStore
+from bitmaps import KitBitmaps
 import time
 import sys
 import hashlib
+import array, collections, itertools, multiprocessing
+import fnmatch, gzip, sqlite3, struct
+import numpy as np
 import requests, json
 import urllib, time
-try:
-    import pyfaidx
-except:
-    print('WARNING: refpos detection depends on pyfaidx module - not found')
 
 
 # read the config file
@@ -79,6 +83,10 @@ class Trace(DisplayMsg):
 
 trace = Trace(config['verbosity'])
 
+# version of the kit parser (KitData); bump this when the parsed output
+# changes, so populate_from_dataset reloads kits parsed by an older version
+KIT_PARSER_VERSION = 1
+
 # Procedure: md5
 # Purpose: return a md5 hash of a given object as a string signature
 def md5(obj):
@@ -86,6 +94,15 @@ def md5(obj):
     md5hash.update(str(obj).encode('utf-8'))
     return md5hash.hexdigest()
 
+# Procedure: file_md5
+# Purpose: return a md5 hash of a file's contents as a string signature
+def file_md5(fname):
+    md5hash = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            md5hash.update(chunk)
+    return md5hash.hexdigest()
+
 # Procedure: data_path
 # Purpose: return a path to a file or directory in the configured data dir
 def data_path(fname):
@@ -127,17 +144,106 @@ def extract_zipdir():
     for ff in fnames:
         trace (40, ff)
 
+# symbolic ALT alleles of gVCF reference blocks, and header lines that mark
+# a VCF file as a gVCF
+GVCF_ALTS = ('<NON_REF>', '<*>')
+GVCF_HEADERS = ('##GVCFBlock', '##ALT=<ID=NON_REF', '##ALT=<ID=*')
+
+# Procedure: gvcf_callable
+# Purpose: decide if a gVCF record or block counts as coverage
+# Input:
+#   filt, the FILTER of the record
+#   sample, a dictionary of the sample's FORMAT fields
+# Returns: True if the record passed the filters and has a good enough GQ
+def gvcf_callable(filt, sample):
+    try:
+        gq = int(sample.get('GQ') or 0)
+    except ValueError:
+        gq = 0
+    return filt in ('PASS', '.') and gq >= config['gvcf_min_gq']
+
 # Procedure: getVCFvariants
-# Input: an opened VCF file object
+# Input:
+#   FILE, an opened VCF file object (text or binary, e.g. from a zip file)
+#   minpassrate (optional), fraction of reads needed to report an allele
+#   ranges (optional), a list that gVCF coverage is added to
 # Purpose: parse the vcf file for data to store in the database
-def getVCFvariants(FILE):
-    from subprocess import Popen, PIPE, STDOUT
-    cmd = os.path.join(config['REDUX_ENV'], 'getVCFvariants.sh')
-    p = Popen([cmd, '-'], stdout=PIPE, stdin=PIPE, stderr=STDOUT)    
-    p_stdout = p.communicate(input=FILE.read())[0]
-    output = p_stdout.decode('utf-8')
-    # trace(1, 'command output: {}'.format(output))
-    return output
+# Returns:
+#   a generator of typed tuples, one per allele call:
+#   (pos, ref, alt, passfail, q1, q2, nreads, passrate, gt)
+# Info:
+#   The file is read one line at a time, so memory use does not depend on the
+#   size of the VCF. This replaces getVCFvariants.sh, and it keeps the same
+#   output: q1 and q2 are the BQ and MQ values in INFO, nreads is DP and
+#   passrate is the allele's share of DP taken from AD. INFO and FORMAT fields
+#   are looked up by key, not by position. A multi-allelic ALT is split into
+#   one tuple per alternative allele, and an allele is dropped if no more than
+#   minpassrate of the reads are called for it.
+#
+#   A gVCF also has reference blocks, with a symbolic ALT (<NON_REF> or <*>)
+#   and the end of the block in INFO END. These are not calls, and symbolic
+#   alleles are never reported. With ranges, the callable blocks and the
+#   callable records of a gVCF (see gvcf_callable) are added to ranges as
+#   (minaddr,maxaddr) rows like those of an FTDNA BED file, joining ranges
+#   that touch or overlap as they're added. In a gVCF, a call that wasn't
+#   filtered (FILTER .) is a PASS call.
+#
+#   The GT is given with its alleles in numeric order and unphased, e.g. 0/1
+#   for 1|0, so it can be looked up with gt_code. A record whose GT has no
+#   called allele (. or ./.) is not a call and is skipped.
+def getVCFvariants(FILE, minpassrate=0.1, ranges=None):
+    def add_range(minaddr, maxaddr):
+        if ranges and minaddr <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], maxaddr)
+        else:
+            ranges.append([minaddr, maxaddr])
+    gvcf = False
+    for line in FILE:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if line.startswith('#'):
+            if line.startswith(GVCF_HEADERS):
+                gvcf = True
+            continue
+        fields = line.split()
+        if len(fields) < 10:
+            continue
+        try:
+            info = dict([kv.partition('=')[::2] for kv in fields[7].split(';')])
+            sample = dict(zip(fields[8].split(':'), fields[9].split(':')))
+            pos = int(fields[1])
+            alts = fields[4].split(',')
+            if alts[0] in GVCF_ALTS:
+                gvcf = True
+                if ranges is not None and gvcf_callable(fields[6], sample):
+                    add_range(pos-1, int(info.get('END') or pos))
+                continue
+            q1 = float(info.get('BQ') or 0)
+            q2 = float(info.get('MQ') or 0)
+            nreads = int(sample['DP'])
+            depths = [int(x) for x in sample['AD'].split(',')]
+        except (KeyError, ValueError):
+            trace(1, 'skipping unparsable VCF line: {}'.format(line[:70]))
+            continue
+        if nreads <= 0:
+            continue
+        if gvcf and ranges is not None and gvcf_callable(fields[6], sample):
+            add_range(pos-1, pos-1+len(fields[3]))
+        # AD lists the ref depth first when there's more than one value
+        if len(depths) > 1:
+            depths = depths[1:]
+        passfail = 'PASS' if fields[6] == 'PASS' or \
+                                 (gvcf and fields[6] == '.') else 'FAIL'
+        # the GT alleles in order, so 1|0 is 0/1; without any, it's no call
+        gt = sample.get('GT', '.').replace('|', '/').split('/')
+        if all([a == '.' for a in gt]):
+            continue
+        gt = '/'.join(sorted(gt, key=lambda a: int(a) if a.isdigit() else 1<<30))
+        for alt, depth in zip(alts, depths):
+            passrate = depth / nreads
+            if passrate > minpassrate and not alt.startswith('<'):
+                yield (pos, fields[3], alt, passfail, q1, q2, nreads, passrate,
+                       gt)
 
 # Procedure: readHg19Vcf
 # Input: a VCF file name
@@ -201,8 +307,7 @@ def populate_age(dbo):
 def populate_refpos(dbo):
     trace(1, 'populate refpos table')
     fname =data_path(os.path.join('cache', 'refpos-detect.out'))
-    if not os.path.exists(fname):
-        calculate_refpos()
+    calculate_refpos()
     with open(fname) as refposfile:
         cf = csv.reader(refposfile)
         snps = []
@@ -210,15 +315,18 @@ def populate_refpos(dbo):
             if row[0].startswith('#'):
                 continue
             try:
-                snps.append(row[0])
+                # lines are: name ('pos', 'anc', 'der')
+                snps.append(row[0].split()[0])
             except:
                 trace(0, 'failed on row of refpos.txt:{}'.format(row))
+        vids, unresolved = resolve_names(dbo, 'snp', snps)
+        if unresolved:
+            trace(1, '{} refpos SNPs not found: {}...'.format(len(unresolved),
+                                                            unresolved[:10]))
         dc = dbo.cursor()
         dc.execute('delete from refpos')
-        for snpname in snps:
-           dc.execute('''insert or ignore into refpos
-                       select vid from snpnames where snpname=?''',
-                       (snpname,))
+        dc.executemany('insert or ignore into refpos values(?)',
+                           [(vid,) for snp in snps for vid in vids.get(snp,[])])
 
         # make sure there's a swapped variant
         dc.execute('''insert or ignore into variants(pos,anc,der,buildid)
@@ -244,13 +352,13 @@ def populate_analysis_kits(dbo):
                 kitids.append(row[0])
             except:
                 trace(0, 'failed on row of kits.txt:{}'.format(row))
+        pids, unresolved = resolve_names(dbo, 'kit', kitids)
+        if unresolved:
+            trace(1, 'kits in kits.txt not found: {}'.format(unresolved))
         dc = dbo.cursor()
         dc.execute('delete from analysis_kits')
-        for kit in kitids:
-           dc.execute('''insert into analysis_kits
-                       select d.DNAID from dataset d
-                       where d.kitID like ?''',
-                       (kit,))
+        dc.executemany('insert into analysis_kits values(?)',
+                           [(pid,) for kit in kitids for pid in pids.get(kit,[])])
 
     return
 
@@ -331,18 +439,23 @@ def populate_excludes(dbo):
         dc = dbo.cursor()
         dc.execute('delete from exclude_variants')
         dc.execute('delete from exclude_kits')
+        pids, unresolved = resolve_names(dbo, 'kit', kitids)
         for kit in kitids:
             trace(1, 'ignoring kit {} due to {}'.format(kit, fname))
-            dc.execute('''insert into exclude_kits
-                       select d.DNAID from dataset d
-                       where d.kitID like ?''',
-                       (kit,))
-        for build,vname in varnames:
-            vid = get_variant_id(dbo, build, vname, insert_notfound=True)
-            trace(1, 'ignoring variant {} (id={}) due to {}'.format(
-                vname, vid, fname))
-            dc.execute('insert or ignore into exclude_variants values(?)',
-                           (vid,))
+            dc.executemany('insert into exclude_kits values(?)',
+                               [(pid,) for pid in pids.get(kit,[])])
+        for build in set([b for b,v in varnames]):
+            vnames = [v for b,v in varnames if b == build]
+            vids, notfound = resolve_names(dbo, 'variant', vnames, build,
+                                               insert_notfound=True)
+            unresolved += notfound
+            for vname in vnames:
+                trace(1, 'ignoring variant {} (id={}) due to {}'.format(
+                    vname, vids.get(vname), fname))
+                dc.executemany('insert or ignore into exclude_variants values(?)',
+                                   [(vid,) for vid in vids.get(vname,[])])
+        if unresolved:
+            trace(0, 'not found in {}: {}'.format(fname, unresolved))
 
     # FIXME - excluding a refpos needs to have the evil twin excluded too
     return
@@ -384,19 +497,65 @@ def populate_STRs(dbo, ordering=None):
         for tup in enumerate(strdefs):
             dc.execute('insert or ignore into strs(ordering,strname) values(?,?)', tup)
 
-# Procedure: get_kits
+# Procedure: iter_json_records
+# Purpose: read the records of a JSON array one at a time
+# Input:
+#   fileobj, a text file object positioned at the start of a JSON array
+#   object_hook (optional), passed to the JSON decoder
+#   chunksize (optional), how much of the file to read at a time
+# Returns:
+#   a generator of the decoded array elements
+# Info:
+#   Only the current record and one chunk of the file are held in memory,
+#   instead of the whole decoded array.
+def iter_json_records(fileobj, object_hook=None, chunksize=1<<16):
+    decoder = json.JSONDecoder(object_hook=object_hook)
+    # skip any white space before the array
+    buf = ''
+    for more in iter(lambda: fileobj.read(chunksize), ''):
+        buf = more.lstrip()
+        if buf:
+            break
+    if not buf.startswith('['):
+        raise ValueError('expected a JSON array')
+    buf = buf[1:]
+    eof = False
+    while True:
+        buf = buf.lstrip()
+        if buf.startswith(','):
+            buf = buf[1:].lstrip()
+        if buf.startswith(']'):
+            return
+        try:
+            rec, end = decoder.raw_decode(buf)
+        except ValueError:
+            end = None
+        # the record continues past what we've read so far; a number that
+        # ends the buffer may also go on in the next chunk
+        if end is None or (end == len(buf) and not eof):
+            if eof:
+                raise ValueError('the JSON array is not complete')
+            more = fileobj.read(chunksize)
+            eof = not more
+            buf += more
+            continue
+        yield rec
+        buf = buf[end:]
+
+# Procedure: iter_kits
 # Purpose: pull information about the kits from the web api of haplogroup-r
 # Input:
 #   fromweb: if True, try to refresh from the web; else, prefer cached
 # Returns:
-#   js, a json object with all of the metadata records
+#   a generator of the metadata records, one dictionary per kit
 # Info:
 #   haplogroup-r provides an api to get metadata about kits stored there.  This
-#   procedure calls that API and returns the JSON record.  To avoid making too
+#   procedure calls that API and saves the JSON it returns. To avoid making too
 #   many repeated calls to the API when testing and developing, the json record
 #   is cached on disk. When the API parameter is empty, satisfy the request
-#   from the cached copy.
-def get_kits (fromweb=True):
+#   from the cached copy. The response is streamed to the cache file and the
+#   records are read back one at a time, so the whole set is never in memory.
+def iter_kits (fromweb=True):
     # if pulling from the web, where to get the result
     API = 'http://haplogroup-r.org/api/v1/uploads.php'
     qry = 'format=json'
@@ -413,134 +572,128 @@ def get_kits (fromweb=True):
         if not d['surname']:
             d['surname'] = 'Unknown'
         if not d['normalOrig']:
-            d['origin'] = 'Unknown'
+            d['normalOrig'] = 'Unknown'
         return d
 
-    if not fromweb:
+    if not fromweb and os.path.exists(fname):
+        trace(1, 'reading kit info from {}'.format(fname))
+    else:
+        if not fromweb:
+            trace(0, 'no cached {} - trying web'.format(fname))
         try:
-            trace(1, 'reading kit info from {}'.format(fname))
-            js = json.load(open(fname), object_hook=null_hook)
-            return js
+            trace(1, 'reading kit info from the web')
+            url = '?'.join([API, qry])
+            res = requests.get(url, stream=True)
+            res.raise_for_status()
+            with open(fname+'.tmp', 'wb') as f:
+                for chunk in res.iter_content(1<<16):
+                    f.write(chunk)
+            os.replace(fname+'.tmp', fname)
         except:
-            trace(0, 'no cached {} - trying web'.format(fname))
+            trace(0, 'Failed to pull kit metadata from {}'.format(API))
+            raise # fixme - what to do on error?
+    with open(fname) as f:
+        for rec in iter_json_records(f, object_hook=null_hook):
+            yield rec
 
-    try:
-        trace(1, 'reading kit info from the web')
-        url = '?'.join([API, qry])
-        res = requests.get(url)
-        js = res.json()
-        open(fname,'w').write(json.dumps(js))
-        js = json.load(open(fname), object_hook=null_hook)
-        return js
-    except:
-        trace(0, 'Failed to pull kit metadata from {}'.format(API))
-        raise # fixme - what to do on error?
+# Procedure: get_kits
+# Purpose: pull information about the kits from the web api of haplogroup-r
+# Input:
+#   fromweb: if True, try to refresh from the web; else, prefer cached
+# Returns:
+#   js, a list with all of the metadata records
+# Info:
+#   see iter_kits
+def get_kits (fromweb=True):
+    return list(iter_kits(fromweb))
 
 # Procedure: update_metadata
 # Purpose: update the kit information in the database
 # Input:
 #   db, a database object
-#   js, a json object that comes from the Haplogroup-R DW API
+#   js, an iterable of json records from the Haplogroup-R DW API
 # Returns: nothing - only updates the database tables dataset, person, etc
 # Info:
 #   this procedure doesn't load any data; it just updates the metadata for the
 #   available kits contained in the json record
+#   Only kits that are new, or whose uploaded or updated time differs from
+#   what is in dataset, are written. Country, lab, etc are looked up (and added
+#   if needed) by their unique keys, and remembered for the next record. A
+#   changed kit keeps its DNAID, so what was loaded for it stays attached. A
+#   kit whose build, lab, test type, etc is missing is skipped. If a kit is
+#   listed more than once, the first one is used.
 def update_metadata(db, js):
     dc = db.cursor()
     blds = {'b38': 'hg38', 'b19': 'hg19', 'b37': 'hg19'}
-    rows = [(
-        # fields that go into dataset table directly
-        jr['kitId'].strip(), jr['uploaded'], jr['dataFile'], jr['long'],
-        jr['lat'], jr['otherInfo'], jr['origFileName'], jr['birthYear'],
-        jr['approxHg'],
-        # need inserting into their own tables
-        jr['country'], jr['normalOrig'], jr['lab'], blds[jr['build']],
-        jr['surname'], jr['testType'], jr['isNGS'])
-        for jr in js
-        ]
-    trace(3, 'first row out of {}:{}'.format(len(rows),rows[0]))
-    trace(1, '{} unique kit ids'.format(len(set([v['kitId'] for v in js]))))
-    trace(1, '{} null surname'.format(
-        len([v['surname'] for v in js if v['surname'] == 'Unknown'])))
-
-    # populate the dependency tables
-    # (testtype,isNGS) goes into testtypes
-    tups = [y for y in set([(r[-2],r[-1]) for r in rows])]
-    dc.executemany('insert or ignore into testtype(testNm,isNGS) values(?,?)', tups)
-
-    # (surname+kitId+build) goes into person
-    # fixme: we need a DNA-to-person mapping. This is a big kludge
-    tups = [y for y in set([(r[-3],r[0],r[-4]) for r in rows])]
-    dc.executemany('insert or ignore into person(surname,firstname,middlename) values(?,?,?)',
-                          tups)
-    trace(3, 'people: {}...'.format(tups[:10]))
-
-    for tbl,val,idx in (('country','country',-7),
-                        ('surname', 'surname',-3),
-                        ('origin', 'origin',-6),
-                        ('lab', 'labNm',-5),
-                        ('build', 'buildNm',-4)):
-        tups = [(y,) for y in set([v[idx] for v in rows])]
-        trace(3, 'first tuple to insert into {}: {}'.format(tbl, tups[0]))
-        dc.executemany('insert or ignore into {}({}) values(?)'.format(tbl,val),
-                              tups)
-
-    # create temporary table, where columns correspond to values above
-    dc.execute('''create temporary table tmpt(
-           a TEXT, b TEXT, c TEXT, d TEXT,
-           e TEXT, f TEXT, g TEXT, h TEXT,
-           i TEXT,
-           j TEXT, k TEXT, l TEXT, m TEXT,
-           n TEXT, o TEXT, p TEXT)''')
-    dc.executemany('''INSERT INTO tmpt(a,b,c,d,e,f,g,h,i,j,k,l,m,n,o,p)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', rows)
-    trace(2, 'done preparing tables')
-    dc.execute('''
-        INSERT or ignore INTO dataset(kitId, importDt, fileNm, lng,
-            lat, otherInfo, origFileNm, birthYr,
-            approxHg,
-            countryID, normalOrigID, labID, buildID, testTypeID, DNAID, surnameID)
-        SELECT a, b, c, d,
-            e, f, g, h,
-            i,
-            cn.id, oc.id, ln.id, bn.id, tt.id, pn.id, sn.id
-        FROM tmpt
-        INNER JOIN country cn ON tmpt.j = cn.country
-        INNER JOIN origin oc ON tmpt.k = oc.origin
-        INNER JOIN lab ln ON tmpt.l = ln.labNm
-        INNER JOIN build bn ON tmpt.m = bn.buildNm
-        INNER JOIN surname sn ON tmpt.n = sn.surname
-        INNER JOIN person pn ON
-            (tmpt.n = pn.surname or (tmpt.n is NULL and pn.surname is NULL)) AND
-            (tmpt.a = pn.firstname or (tmpt.a is NULL and pn.firstname is NULL)) AND
-            (tmpt.m = pn.middlename or (tmpt.m is NULL and pn.middlename is NULL))
-        INNER JOIN testtype tt ON tmpt.o = tt.testNm and tmpt.p = tt.isNGS''')
-    trace(1, '{} rows inserted into dataset'.format(dc.execute('select count(*) from dataset').fetchone()[0]))
-    dc.execute('drop table tmpt')
+    known = dict([(k, (u, d)) for (k, u, d) in
+                      dc.execute('select kitId, importDt, updated from dataset')])
+
+    # get the id of a row in a lookup table, adding the row if needed
+    ids = {}
+    def lookup(tbl, cols, vals):
+        if None in vals:
+            return None
+        key = (tbl,) + tuple(vals)
+        if key not in ids:
+            dc.execute('insert or ignore into {}({}) values({})'.format(
+                tbl, ','.join(cols), ','.join('?'*len(cols))), vals)
+            dc.execute('select id from {} where {}'.format(
+                tbl, ' and '.join([c+'=?' for c in cols])), vals)
+            ids[key] = dc.fetchone()[0]
+        return ids[key]
+
+    counts = collections.Counter()
+    seen = set()
+    for jr in js:
+        kit = jr['kitId'].strip()
+        stamp = (jr['uploaded'], jr.get('updated'))
+        if kit in seen:
+            counts['duplicate'] += 1
+            continue
+        seen.add(kit)
+        if known.get(kit) == stamp:
+            counts['unchanged'] += 1
+            continue
+        build = blds.get(jr['build'])
+        fks = (lookup('country', ('country',), (jr['country'],)),
+               lookup('origin', ('origin',), (jr['normalOrig'],)),
+               lookup('lab', ('labNm',), (jr['lab'],)),
+               lookup('build', ('buildNm',), (build,)),
+               lookup('testtype', ('testNm','isNGS'),
+                          (jr['testType'], jr['isNGS'])),
+               lookup('surname', ('surname',), (jr['surname'],)))
+        # fixme: we need a DNA-to-person mapping. This is a big kludge
+        # (surname+kitId+build) goes into person
+        pid = lookup('person', ('surname','firstName','middleName'),
+                         (jr['surname'], kit, build))
+        if None in fks or pid is None:
+            trace(2, 'skipping kit {}: missing metadata'.format(kit))
+            counts['skipped'] += 1
+            continue
+        vals = (jr['uploaded'], jr.get('updated'), jr['dataFile'], jr['long'],
+                jr['lat'], jr['otherInfo'], jr['origFileName'],
+                jr['birthYear'], jr['approxHg']) + fks
+        if kit in known:
+            dc.execute('''update dataset set importDt=?, updated=?, fileNm=?,
+                lng=?, lat=?, otherInfo=?, origFileNm=?, birthYr=?, approxHg=?,
+                countryID=?, normalOrigID=?, labID=?, buildID=?, testTypeID=?,
+                surnameID=?
+                where kitId=?''', vals + (kit,))
+            counts['updated'] += 1
+        else:
+            dc.execute('''insert into dataset(importDt, updated, fileNm, lng,
+                lat, otherInfo, origFileNm, birthYr, approxHg,
+                countryID, normalOrigID, labID, buildID, testTypeID,
+                surnameID, kitId, DNAID)
+                values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                vals + (kit, pid))
+            counts['new'] += 1
+    trace(1, 'kit metadata: {} new, {} updated, {} unchanged, {} skipped, '
+             '{} duplicates'.format(counts['new'], counts['updated'],
+                                    counts['unchanged'], counts['skipped'],
+                                    counts['duplicate']))
     return
 
-# Procedure: get_build_byname
-# Purpose: get build identifier by its name; creates new entry if needed
-# Input:
-#   db, a database object
-#   buildname, optional name of build, e.g. 'hg38'
-# Info:
-#   known aliases are reduced to one entry
-def get_build_byname(db, buildname='hg38'):
-    if buildname.lower().strip() in ('hg19', 'grch37', 'b19', 'b37'):
-        buildname = 'hg19'
-    elif buildname.lower().strip() in ('hg38', 'grch38', 'b38'):
-        buildname = 'hg38'
-    dc = db.cursor()
-    dc.execute('select id from build where buildNm=?', (buildname,))
-    bid = None
-    for bid, in dc:
-        continue
-    if not bid:
-        dc.execute('insert into build(buildNm) values (?)', (buildname,))
-        bid = dc.lastrowid
-    return bid
-
 # Procedure: populate_contigs
 # Purpose: load data into the contig table
 # Input: a database object
@@ -566,50 +719,119 @@ def populate_contigs(db):
 #   stores the latest data. It can also store the most-recent cached data
 #   without calling the web API
 def populate_fileinfo(dbo, fromweb=True):
-    js = get_kits(fromweb)
+    js = iter_kits(fromweb)
     trace(3, 'updating the kit metadata in the db')
-    update_metadata(dbo, js)
+    with dbo.bulk_load(('dataset', 'testtype', 'person', 'country', 'surname',
+                        'origin', 'lab', 'build')):
+        update_metadata(dbo, js)
+
 
+# Procedure: fasta_bases
+# Purpose: look up the reference bases at a set of positions
+# Input:
+#   fname, an uncompressed FASTA file holding one sequence (e.g. chrY)
+#   pos, an array of 1-based positions
+# Returns:
+#   a uint8 array of upper-case base characters, 0 where pos is out of range
+# Info:
+#   The file is memory-mapped and all of the positions are gathered at once.
+#   Lines of sequence are assumed to all be the width of the first one, as in
+#   the reference files from nih.gov and as required by samtools faidx.
+def fasta_bases(fname, pos):
+    seq = np.memmap(fname, dtype=np.uint8, mode='r')
+    with open(fname, 'rb') as f:
+        start = len(f.readline())
+        line = f.readline()
+    width = len(line.rstrip(b'\r\n'))
+    pos = np.asarray(pos, dtype=np.int64) - 1
+    offs = start + pos + (pos // width) * (len(line) - width)
+    ok = (pos >= 0) & (offs < len(seq))
+    bases = np.zeros(len(pos), dtype=np.uint8)
+    bases[ok] = seq[offs[ok]]
+    bases[np.isin(bases, np.frombuffer(b'\r\n>', dtype=np.uint8))] = 0
+    lower = (bases >= ord('a')) & (bases <= ord('z'))
+    bases[lower] -= ord('a') - ord('A')
+    return bases
+
+# Procedure: normalize_indel
+# Purpose: left-align and trim one indel against the reference sequence
+# Input:
+#   pos, ref, alt, the indel as in the VCF
+#   context, the reference bases just before pos, ending at pos-1
+# Returns:
+#   the normalized (pos, ref, alt), or None if more context is needed
+# Info:
+#   Common trailing bases are trimmed, and the indel is shifted left by
+#   adding the reference base before it, for as long as that changes
+#   nothing; then common leading bases are trimmed, keeping one. The
+#   indel is left where it is when the context has a base that isn't ACGT.
+def normalize_indel(pos, ref, alt, context):
+    start = pos - len(context)
+    npos, nref, nalt = pos, ref, alt
+    while True:
+        if nref and nalt and nref[-1] == nalt[-1]:
+            nref, nalt = nref[:-1], nalt[:-1]
+        elif not nref or not nalt:
+            if npos - 1 < start:
+                return None
+            base = context[npos-1-start]
+            if base not in 'ACGT':
+                return pos, ref, alt
+            nref, nalt, npos = base + nref, base + nalt, npos - 1
+        else:
+            break
+    while len(nref) > 1 and len(nalt) > 1 and nref[0] == nalt[0]:
+        nref, nalt, npos = nref[1:], nalt[1:], npos + 1
+    return npos, nref, nalt
 
 # WORK IN PROGRESS
 # Procedure: calculate_refpos
 # Purpose: calculate snps that are reference-positive out of named snps
+# Input:
+#   force (optional), recalculate even if the inputs haven't changed
 # Info:
 #   determine refpos snps automatically
 #   https://www.ncbi.nlm.nih.gov/assembly/GCA_000001405.27
-def calculate_refpos():
-    trace(1, 'calculating refpos')
-
-    fname = get_FASTA_fromweb(config['ref_fasta_hg38'])
-
-    # assumes format for firs line is >seqname bla bla bla
-    seqname = open(fname).read(100).split()[0][1:]
-    ref = pyfaidx.Fasta(fname)
-
-    # helper: return False if SNP definition's anc != reference genome's value
-    def check(snpname):
-        a1 = snpdict[snpname][1]
-        a2 = str(ref.faidx.fetch(seqname, int(snpdict[snpname][0]),
-                               int(snpdict[snpname][0]))).upper()
-        if a1 != a2:
-            return False
-        return True
+#   A SNP is reference-positive if its ancestral allele isn't the base in the
+#   reference genome. The first line of refpos-detect.out records the md5 of
+#   the FASTA and the SNP definitions it was computed from, and the file is
+#   only recomputed when one of them changes.
+def calculate_refpos(force=False):
+    refpos = data_path(os.path.join('cache', 'refpos-detect.out'))
+    snpdef = data_path(os.path.join('cache', config['b38_snp_file']))
+    try:
+        fname = get_FASTA_fromweb(config['ref_fasta_hg38'])
+    except Exception:
+        trace(0, 'failed to get the reference FASTA; refpos not calculated')
+        return
+    key = '# fasta:{} snps:{}\n'.format(file_md5(fname), file_md5(snpdef))
+    if not force and os.path.exists(refpos):
+        with open(refpos) as fn:
+            if fn.readline() == key:
+                trace(1, 'refpos is up to date')
+                return
 
+    trace(1, 'calculating refpos')
     snpdict = {}
-    snpdef = data_path(os.path.join('cache', config['b38_snp_file']))
     with open(snpdef) as snpfile:
         c = csv.DictReader(snpfile)
         for line in c:
             snpdict[line['Name']] = (line['start'],line['allele_anc'],
                 line['allele_der'])
+    snps = list(snpdict)
+    defs = [snpdict[snp] for snp in snps]
+    pos = np.array([int(d[0]) for d in defs], dtype=np.int64)
+    # ancestral allele as a character; -1 for anything not a single base
+    anc = np.array([ord(d[1]) if len(d[1]) == 1 else -1 for d in defs],
+                       dtype=np.int16)
+    indel = np.array([d[1] in ('ins','del') for d in defs], dtype=bool)
+    mismatch = anc != fasta_bases(fname, pos)
 
     # write out the detected refpos along with its definition
-    refpos = data_path(os.path.join('cache', 'refpos-detect.out'))
     with open(refpos, 'w') as fn:
-        for snp in snpdict:
-            if (snpdict[snp][1] not in ('ins','del')) and \
-              (not check(str(snp))) and (int(snpdict[snp][0]) > 1):
-                 fn.write('{} {}\n'.format(snp, snpdict[snp]))
+        fn.write(key)
+        for ii in np.flatnonzero(mismatch & ~indel & (pos > 1)):
+            fn.write('{} {}\n'.format(snps[ii], defs[ii]))
     return
 
 
@@ -704,39 +926,716 @@ def get_FASTA_fromweb(url=None):
         trace(1, 'retrieving {}')
         urllib.request.urlretrieve(url, fname)
 
+    # only decompress if we don't already have an up to date copy
     if fname.endswith('.gz'):
-        try:
-            subprocess.run(['gzip', '-d', '-f', '-k', fname])
-        # subprocess.run is a relatively new interface in subprocess
-        except AttributeError:
-            subprocess.call(['gzip', '-d', '-f', '-k', fname])
+        if not os.path.exists(fname[:-3]) or \
+              os.path.getmtime(fname[:-3]) < os.path.getmtime(fname):
+            try:
+                subprocess.run(['gzip', '-d', '-f', '-k', fname])
+            # subprocess.run is a relatively new interface in subprocess
+            except AttributeError:
+                subprocess.call(['gzip', '-d', '-f', '-k', fname])
         fname = fname[:-3]
 
     return fname
 
 
-# Procedure: populate_snps
+# Procedure: sort_SNPdefs
+# Purpose: write a normalized, sorted copy of a SNP definitions file
+# Input:
+#   fname, a SNP definitions csv file from ybrowse.org
+#   outfname, the file to write
+# Returns: the number of distinct definitions written
+# Info:
+#   Each line of the output is pos, anc, der and name separated by tabs. The
+#   system sort utility does the sorting, so the whole file never has to be in
+#   memory. LC_ALL=C sorts by byte value, which for UTF-8 is the same order
+#   as python string comparison, so diff_SNPdefs can merge two such files.
+def sort_SNPdefs(fname, outfname):
+    env = dict(os.environ, LC_ALL='C')
+    with open(outfname, 'w') as outf:
+        proc = subprocess.Popen(['sort', '-u'], stdin=subprocess.PIPE,
+                                stdout=outf, env=env, universal_newlines=True)
+        with open(fname) as snpfile:
+            for rec in csv.DictReader(snpfile):
+                proc.stdin.write('\t'.join((rec['start'].strip(),
+                                    rec['allele_anc'].strip(),
+                                    rec['allele_der'].strip(),
+                                    rec['Name'].strip()))+'\n')
+        proc.stdin.close()
+        if proc.wait():
+            raise OSError('sort failed on {}'.format(fname))
+    with open(outfname) as outf:
+        return sum(1 for line in outf)
+
+# Procedure: diff_SNPdefs
+# Purpose: compare two sorted SNP definition files (see sort_SNPdefs)
+# Input:
+#   oldfname, definitions that were applied before
+#   newfname, definitions to apply now
+# Returns:
+#   a generator of (op, rec) tuples, where op is '+' for a definition that is
+#   only in newfname, '-' for one only in oldfname, and rec is a dict with the
+#   same keys updatesnps uses
+# Info:
+#   This is a single merge pass over the two files. A renamed SNP shows up as
+#   a '-' and a '+' for the same (pos, anc, der).
+def diff_SNPdefs(oldfname, newfname):
+    def rec(line):
+        return dict(zip(('start', 'allele_anc', 'allele_der', 'Name'),
+                        line.split('\t')))
+    with open(oldfname) as oldf, open(newfname) as newf:
+        o = oldf.readline().rstrip('\n')
+        n = newf.readline().rstrip('\n')
+        while o or n:
+            if o and (not n or o < n):
+                yield '-', rec(o)
+                o = oldf.readline().rstrip('\n')
+            elif n and (not o or n < o):
+                yield '+', rec(n)
+                n = newf.readline().rstrip('\n')
+            else:
+                o = oldf.readline().rstrip('\n')
+                n = newf.readline().rstrip('\n')
+
+# Procedure: deletesnps
+# Purpose: remove SNP names from the database
+# Input:
+#   db, a database object
+#   snp_reference, an iterable of dicts with the same keys updatesnps uses
+#   buildname (optional), the build the definitions are for
+# Info:
+#   Only the snpnames entry goes away. The variant stays, since kit calls
+#   and other tables may refer to it.
+def deletesnps(db, snp_reference, buildname='hg38'):
+    bid = get_build_byname(db, buildname)
+    db.executemany('''delete from snpnames where snpname=? and vID in
+                      (select v.id from variants v
+                       inner join alleles a on a.id=v.anc
+                       inner join alleles d on d.id=v.der
+                       where v.buildID=? and v.pos=? and
+                             a.allele=? and d.allele=?)''',
+                   ((rec['Name'], bid, rec['start'], rec['allele_anc'],
+                         rec['allele_der']) for rec in snp_reference))
+    return
+
+# Procedure: refresh_SNPdefs
+# Purpose: bring the SNP definitions for a build up to date with a file
+# Input:
+#   dbo, a database object
+#   fname, a SNP definitions csv file from ybrowse.org
+#   buildname, the build the definitions are for
+# Info:
+#   Nothing is done if the file's md5 matches the one last applied, as
+#   recorded in snpsnapshot. A sorted copy of each applied file is kept next
+#   to it in the cache, named by its md5. With snp_refresh: delta and a sorted
+#   copy of the last file, only the definitions that differ are applied;
+#   otherwise the whole file is loaded with updatesnps.
+def refresh_SNPdefs(dbo, fname, buildname):
+    if not os.path.exists(fname):
+        trace(0, 'SNP definitions {} not found'.format(fname))
+        return
+    bid = get_build_byname(dbo, buildname)
+    fhash = file_md5(fname)
+    last = dbo.execute('select hash from snpsnapshot where buildID=?',
+                           (bid,)).fetchone()
+    if last and last[0] == fhash:
+        trace(1, 'SNP definitions for {} are up to date'.format(buildname))
+        return
+    snapfmt = fname + '.{}.sorted'
+    newsnap = snapfmt.format(fhash)
+    nrows = sort_SNPdefs(fname, newsnap)
+    if last and config['snp_refresh'] == 'delta' and \
+           os.path.exists(snapfmt.format(last[0])):
+        added = []
+        removed = []
+        for op, rec in diff_SNPdefs(snapfmt.format(last[0]), newsnap):
+            if op == '+':
+                added.append(rec)
+            else:
+                removed.append(rec)
+        keys = set([(r['start'],r['allele_anc'],r['allele_der']) for r in added])
+        renamed = len([r for r in removed
+                          if (r['start'],r['allele_anc'],r['allele_der']) in keys])
+        trace(1, '{}: {} SNP definitions added, {} removed, {} renamed'.format(
+            buildname, len(added)-renamed, len(removed)-renamed, renamed))
+        deletesnps(dbo, removed, buildname)
+        updatesnps(dbo, added, buildname)
+    else:
+        with dbo.bulk_load(('alleles', 'variants', 'snpnames')):
+            with open(fname) as snpfile:
+                updatesnps(dbo, csv.DictReader(snpfile), buildname)
+    dbo.execute('''insert or replace into
+                     snpsnapshot(buildID,fileNm,hash,nrows,refreshDt)
+                     values(?,?,?,?,datetime('now'))''',
+                (bid, os.path.basename(fname), fhash, nrows))
+    dbo.commit()
+    # only the sorted copy of what was just applied is needed from now on
+    for oldsnap in glob.glob(snapfmt.format('*')):
+        if oldsnap != newsnap:
+            os.unlink(oldsnap)
+    return
+
+# Procedure: populate_SNPs
 # Purpose: populate SNP definitions in the database
 # Input:
 #   dbo, a database object
 #   maxage (optional), maximum age of data files pulled from web
 # Info:
-#   refresh from web if we have is older than maxage (in days)
+#   refresh from web if we have is older than maxage (in days), then apply
+#   any changes in the files to the database (see refresh_SNPdefs)
 def populate_SNPs(dbo, maxage=config['max_snpdef_age']):
-    # don't update if nothing changed
-    if not config['drop_tables'] or not get_SNPdefs_fromweb(dbo, maxage=maxage):
-        return
+    get_SNPdefs_fromweb(dbo, maxage=maxage)
     # update known snps for hg19 and hg38
     cachedir = os.path.join(config['REDUX_DATA'], 'cache')
-    with open(os.path.join(cachedir, config['b37_snp_file'])) as snpfile:
-        snp_reference = csv.DictReader(snpfile)
-        updatesnps(dbo, snp_reference, 'hg19')
-    with open(os.path.join(cachedir, config['b38_snp_file'])) as snpfile:
-        snp_reference = csv.DictReader(snpfile)
-        updatesnps(dbo, snp_reference, 'hg38')
+    refresh_SNPdefs(dbo, os.path.join(cachedir, config['b37_snp_file']), 'hg19')
+    refresh_SNPdefs(dbo, os.path.join(cachedir, config['b38_snp_file']), 'hg38')
     return
 
 
+# Class: IDResolver
+# Purpose: in-memory cache of allele and variant IDs for loading
+# Input:
+#   dbo, a database object
+# Info:
+#   The cache is primed once from the alleles table, and from the variants of
+#   a build the first time that build is used. It maps allele text and
+#   (pos,anc,der) variant tuples to integer IDs. Keys that are not yet in
+#   the database are given the next free IDs and inserted in one
+#   executemany, so calls can be stored as plain integer rows without temp
+#   tables or joins on strings.
+#
+#   The resolver assumes it is the only writer of these two tables while
+#   it's in use. If the database work is rolled back, call rollback() so the
+#   IDs handed out since the last release() are forgotten.
+class IDResolver(object):
+    def __init__(self, dbo):
+        self.dbo = dbo
+        dc = dbo.cursor()
+        self.alleles = dict([(a,i) for (i,a) in
+                                 dc.execute('select id,allele from alleles')])
+        # variants are cached per build as they're needed
+        self.variants = {}
+        self.nextid = {}
+        for tbl in ('alleles', 'variants'):
+            self.nextid[tbl] = dc.execute(
+                'select coalesce(max(id),0)+1 from {}'.format(tbl)).fetchone()[0]
+        # (cache,key) pairs added since the last release()
+        self.pending = []
+        trace(3, 'resolver: {} alleles'.format(len(self.alleles)))
+
+    # Method: intern
+    # Purpose: get IDs for keys, inserting any keys that are not in the cache
+    # Input:
+    #   cache, one of the dictionaries of this class
+    #   keys, a list of keys (allele text or tuples)
+    #   tbl, the table for new keys
+    #   insert, sql statement that inserts a row of (id,)+key(+extra)
+    #   extra, optional tuple of values to append to each row
+    # Returns: list of IDs corresponding to keys
+    def intern(self, cache, keys, tbl, insert, extra=()):
+        new = sorted(set([k for k in keys if k not in cache]))
+        if new:
+            rows = []
+            for k in new:
+                cache[k] = self.nextid[tbl]
+                self.pending.append((cache,k))
+                if isinstance(k, tuple):
+                    rows.append((self.nextid[tbl],)+k+extra)
+                else:
+                    rows.append((self.nextid[tbl],k)+extra)
+                self.nextid[tbl] += 1
+            self.dbo.executemany(insert, rows)
+        return [cache[k] for k in keys]
+
+    # Method: allele_ids
+    # Purpose: return the IDs for a list of allele strings
+    def allele_ids(self, alleles):
+        return self.intern(self.alleles, alleles, 'alleles',
+                           'insert into alleles(id,allele) values(?,?)')
+
+    # Method: variant_ids
+    # Purpose: return the IDs for vectors of positions and anc, der allele IDs
+    def variant_ids(self, bid, pos, anc, der):
+        if bid not in self.variants:
+            self.variants[bid] = dict([((p,a,d),i) for (i,p,a,d) in
+                self.dbo.execute('''select id,pos,anc,der from variants
+                                    where buildID=?''', (bid,))])
+            trace(3, 'resolver: {} variants in build {}'.format(
+                len(self.variants[bid]), bid))
+        return self.intern(self.variants[bid], list(zip(pos, anc, der)),
+                           'variants', '''insert into
+                           variants(id,pos,anc,der,buildID)
+                           values(?,?,?,?,?)''', (bid,))
+
+    # Method: release
+    # Purpose: keep the IDs handed out so far (the database work is kept)
+    def release(self):
+        self.pending = []
+
+    # Method: rollback
+    # Purpose: forget the IDs handed out since the last release()
+    def rollback(self):
+        for cache,k in self.pending:
+            del cache[k]
+        self.pending = []
+
+# Class: KitData
+# Purpose: compact arrays of the BED and VCF data parsed from one kit
+# Info:
+#   Parsing a kit does not touch the database, so it can be done in a worker
+#   process and the (small, picklable) arrays handed to the database writer.
+#     ranges: int32 array of (minaddr,maxaddr) rows from the BED file
+#     alleles: list of allele strings; ref and alt are indexes into this list
+#     pos, ref, alt: int32 arrays with one entry per call in the VCF file
+#     callinfo: int64 array of packed call information (see pack_call)
+#     refcall: bool array, True for a PASS 0/0 call without a derived allele
+#     filesize, filemtime, filehash: the zip file the kit came from, if any
+#     datahash: md5 of the BED and VCF data, if read from a zip
+#   save and load write and read the parsed arrays as a .npz file, see
+#   kit_cache_path.
+#   selected is False for a kit that load_select rejected; a rejected kit
+#   has only the zip file information.
+class KitData(object):
+    def __init__(self):
+        self.filesize = self.filemtime = self.filehash = None
+        self.datahash = None
+        self.selected = True
+        self.ranges = np.zeros((0,2), dtype=np.int32)
+        self.alleles = []
+        self.pos = np.zeros(0, dtype=np.int32)
+        self.ref = np.zeros(0, dtype=np.int32)
+        self.alt = np.zeros(0, dtype=np.int32)
+        self.callinfo = np.zeros(0, dtype=np.int64)
+        self.refcall = np.zeros(0, dtype=bool)
+
+    # Method: read_BED
+    # Purpose: read the ranges from an open FTDNA BED file
+    # Returns: False if the file could not be parsed
+    def read_BED(self, fileobj):
+        ranges = array.array('i')
+        line = ''
+        try:
+            for line in fileobj:
+                ychr, minr, maxr = line.split()
+                ranges.extend((int(minr), int(maxr)))
+        except ValueError:
+            trace(0, 'FAILED on BED file at {}'.format(line[:70]))
+            return False
+        self.ranges = np.array(ranges, dtype=np.int32).reshape(-1,2)
+        return True
+
+    # Method: read_VCF
+    # Purpose: read the calls from an open VCF file (see getVCFvariants)
+    # Info:
+    #   The coverage of a gVCF replaces any ranges read from a BED file.
+    def read_VCF(self, fileobj):
+        codes = {}
+        pos, ref, alt = array.array('i'), array.array('i'), array.array('i')
+        callinfo = array.array('q')
+        refcall = array.array('b')
+        blocks = []
+        for t in getVCFvariants(fileobj, ranges=blocks):
+            pos.append(t[0])
+            ref.append(codes.setdefault(t[1], len(codes)))
+            alt.append(codes.setdefault(t[2], len(codes)))
+            callinfo.append(pack_call(t))
+            refcall.append(t[3] == 'PASS' and t[8] == '0/0' and t[2] == '.')
+        self.alleles = list(codes)
+        self.pos = np.array(pos, dtype=np.int32)
+        self.ref = np.array(ref, dtype=np.int32)
+        self.alt = np.array(alt, dtype=np.int32)
+        self.callinfo = np.array(callinfo, dtype=np.int64)
+        self.refcall = np.array(refcall, dtype=bool)
+        if blocks:
+            self.ranges = np.array(blocks, dtype=np.int32).reshape(-1,2)
+        trace(5, 'parsed vcf: {} calls'.format(len(self.pos)))
+
+    # Method: has_derived
+    # Purpose: check if the kit has a derived call at any of a set of targets
+    # Input:
+    #   targets, a dictionary of position -> set of derived alleles
+    # Info:
+    #   A derived call is a PASS call of a derived allele that isn't 0/0, the
+    #   same test as scan_VCF_targets.
+    def has_derived(self, targets):
+        calls = unpack_calls(self.callinfo)
+        hits = np.isin(self.pos, list(targets)) & calls['passfail'] & \
+                   (calls['gt'] != CALLINFO_GT['0/0'])
+        for ii in np.flatnonzero(hits):
+            if self.alleles[self.alt[ii]] in targets[int(self.pos[ii])]:
+                return True
+        return False
+
+    # Method: normalize_indels
+    # Purpose: left-align and trim the indels against the reference sequence
+    # Input:
+    #   fasta, an uncompressed FASTA file of the reference (e.g. chrY)
+    #   window (optional), how many bases before each indel to read at first
+    # Returns: the number of calls that were changed
+    # Info:
+    #   Equivalent indels that the variant caller wrote differently end up
+    #   with the same pos, ref and alt, and so with the same variant ID. An
+    #   indel whose ref doesn't match the reference is left alone. The bases
+    #   around all of the indels are gathered at once; an indel that needs
+    #   more than window bases of context is looked up again by itself.
+    def normalize_indels(self, fasta, window=64):
+        acgt = set('ACGT')
+        lens = np.array([len(a) if a and set(a) <= acgt else 0
+                            for a in self.alleles] or [0])
+        lref, lalt = lens[self.ref], lens[self.alt]
+        idx = np.flatnonzero((lref > 0) & (lalt > 0) & (lref != lalt))
+        if len(idx) == 0:
+            return 0
+        offs = np.arange(-window, int(lref[idx].max()))
+        bases = fasta_bases(fasta, (self.pos[idx,None] + offs).ravel())
+        rows = bases.reshape(len(idx), len(offs))
+        codes = dict([(a,ii) for (ii,a) in enumerate(self.alleles)])
+        nchanged = 0
+        for ii, row in zip(idx, rows):
+            pos = int(self.pos[ii])
+            ref, alt = self.alleles[self.ref[ii]], self.alleles[self.alt[ii]]
+            row = row.tobytes().decode('latin-1')
+            if row[window:window+len(ref)] != ref:
+                continue
+            norm = normalize_indel(pos, ref, alt, row[:window])
+            wide = window
+            while norm is None and wide < pos - 1:
+                wide = min(wide * 16, pos - 1)
+                context = fasta_bases(fasta, np.arange(pos-wide, pos))
+                norm = normalize_indel(pos, ref, alt,
+                                       context.tobytes().decode('latin-1'))
+            if norm is None or norm == (pos, ref, alt):
+                continue
+            self.pos[ii] = norm[0]
+            self.ref[ii] = codes.setdefault(norm[1], len(codes))
+            self.alt[ii] = codes.setdefault(norm[2], len(codes))
+            nchanged += 1
+        self.alleles = list(codes)
+        trace(5, 'normalized {} indels'.format(nchanged))
+        return nchanged
+
+    # Method: save
+    # Purpose: write the parsed arrays to a .npz file
+    # Info:
+    #   The file is written under a temporary name and then renamed, so a
+    #   reader never sees a partly written file.
+    def save(self, fname):
+        tmpname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.savez(f, ranges=self.ranges, alleles=np.array(self.alleles, dtype=str),
+                     pos=self.pos, ref=self.ref, alt=self.alt,
+                     callinfo=self.callinfo, refcall=self.refcall,
+                     datahash=np.array(self.datahash or '', dtype=str))
+        os.replace(tmpname, fname)
+
+    # Method: load
+    # Purpose: read the parsed arrays from a file written by save
+    def load(self, fname):
+        with np.load(fname) as npz:
+            self.ranges = npz['ranges']
+            self.alleles = npz['alleles'].tolist()
+            self.pos = npz['pos']
+            self.ref = npz['ref']
+            self.alt = npz['alt']
+            self.callinfo = npz['callinfo']
+            self.refcall = npz['refcall']
+            self.datahash = str(npz['datahash']) or None
+
+# Procedure: store_BED_ranges
+# Purpose: store the BED ranges of a kit
+# Input:
+#   dbo, a database object
+#   pid, a database person ID
+#   ranges, a (minaddr,maxaddr) int array, e.g. KitData.ranges
+# Returns: the number of ranges stored
+# Info:
+#   A range that's in the BED file more than once is stored once. The rows
+#   are inserted in key order, which is the order of the bed table.
+def store_BED_ranges(dbo, pid, ranges):
+    trace(500, '{} ranges for pID {}'.format(len(ranges), pid))
+    ranges = np.unique(np.asarray(ranges).reshape(-1,2), axis=0)
+    dbo.executemany('insert into bed(pID, minaddr, maxaddr) values(?,?,?)',
+                        [(pid, lo, hi) for (lo, hi) in ranges.tolist()])
+    return len(ranges)
+
+# Procedure: merge_ranges
+# Purpose: sort a set of ranges and merge the ones that overlap
+# Input:
+#   ranges, an int array of (minaddr,maxaddr) rows
+# Returns:
+#   an int32 array of sorted, non-overlapping (minaddr,maxaddr) rows
+# Info:
+#   Ranges that only touch end to end, e.g. (1,5) and (5,9), are not merged,
+#   so the range ends reported by in_range don't change.
+def merge_ranges(ranges):
+    ranges = np.asarray(ranges, dtype=np.int32).reshape(-1,2)
+    if len(ranges) == 0:
+        return ranges
+    r = ranges[np.argsort(ranges[:,0], kind='stable')]
+    ends = np.maximum.accumulate(r[:,1])
+    first = np.ones(len(r), dtype=bool)
+    first[1:] = r[1:,0] >= ends[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(r) - 1)
+    return np.stack([r[first,0], ends[last]], axis=1)
+
+# Procedure: range_overlap
+# Purpose: count the positions that are covered by two sets of ranges
+# Input:
+#   r1, r2, sorted, non-overlapping (minaddr,maxaddr) ranges (merge_ranges)
+# Returns: the number of positions in both r1 and r2
+def range_overlap(r1, r2):
+    r1 = np.asarray(r1).tolist()
+    r2 = np.asarray(r2).tolist()
+    ii = jj = total = 0
+    while ii < len(r1) and jj < len(r2):
+        lo = max(r1[ii][0], r2[jj][0])
+        hi = min(r1[ii][1], r2[jj][1])
+        if hi > lo:
+            total += hi - lo
+        if r1[ii][1] < r2[jj][1]:
+            ii += 1
+        else:
+            jj += 1
+    return total
+
+# Procedure: store_BED_blob
+# Purpose: store the BED ranges of a kit as a single packed blob
+# Input:
+#   dbo, a database object
+#   pid, a database person ID
+#   ranges, a (minaddr,maxaddr) int array, e.g. KitData.ranges
+# Returns: the number of (merged) ranges stored
+# Info:
+#   This is the bed_storage: blob alternative to store_BED_ranges. The kit's
+#   ranges are merged and sorted, then stored in bedblob as little-endian
+#   int32 pairs, so get_kit_ranges can read them back with one row fetch.
+def store_BED_blob(dbo, pid, ranges):
+    merged = merge_ranges(ranges)
+    dbo.execute('insert or replace into bedblob(pID,nranges,ranges) values(?,?,?)',
+                    (pid, len(merged), merged.astype('<i4').tobytes()))
+    return len(merged)
+
+# Procedure: get_kit_ranges
+# Purpose: get the BED ranges of a kit
+# Input:
+#   dbo, a database object
+#   pid, a person ID
+# Returns:
+#   an int32 array of (minaddr,maxaddr) rows sorted on minaddr
+# Info:
+#   Kits loaded with bed_storage: blob have their ranges in a single bedblob
+#   row, which is read without copying; otherwise the ranges are read from
+#   the bed table.
+def get_kit_ranges(dbo, pid):
+    row = dbo.execute('select ranges from bedblob where pID=?',
+                          (pid,)).fetchone()
+    if row:
+        return np.frombuffer(row[0], dtype='<i4').reshape(-1,2)
+    rc = dbo.execute('''select minaddr,maxaddr from bed where pID=?
+                         order by 1''', (pid,))
+    return np.array(rc.fetchall(), dtype=np.int32).reshape(-1,2)
+
+# Procedure: get_age_ranges
+# Purpose: get the age.bed ranges that are loaded in agebed
+# Input:
+#   dbo, a database object
+# Returns:
+#   sorted, merged (minaddr,maxaddr) ranges, as returned by merge_ranges
+def get_age_ranges(dbo):
+    return merge_ranges(dbo.execute('''select minaddr,maxaddr from bedranges b
+                                     inner join agebed a on a.bID=b.id''').fetchall())
+
+# Procedure: get_BED_stats
+# Purpose: calculate a kit's coverage statistics
+# Input:
+#   ranges, a (minaddr,maxaddr) int array, e.g. KitData.ranges
+#   ageranges, the result of get_age_ranges
+# Returns: (coverage1, coverage2, nranges)
+# Info:
+#   coverage1 is the number of positions covered by the kit's ranges, and
+#   coverage2 is how many of those are also in the age.bed ranges. These are
+#   needed for age calculations. nranges is the number of ranges in the BED
+#   file, before they are merged.
+def get_BED_stats(ranges, ageranges):
+    merged = merge_ranges(ranges)
+    return (int((merged[:,1] - merged[:,0]).sum()),
+            range_overlap(merged, ageranges), len(ranges))
+
+# Procedure: store_BED_stats
+# Purpose: record a kit's coverage statistics in bedstats
+# Input:
+#   dbo, a database object
+#   pid, a database person ID
+#   ranges, a (minaddr,maxaddr) int array, e.g. KitData.ranges
+#   ageranges (optional), the result of get_age_ranges
+# Returns: the (coverage1, coverage2, nranges) that were stored, as
+#   calculated by get_BED_stats
+def store_BED_stats(dbo, pid, ranges, ageranges=None):
+    if ageranges is None:
+        ageranges = get_age_ranges(dbo)
+    stats = get_BED_stats(ranges, ageranges)
+    dbo.execute('''insert or replace into bedstats(pID,coverage1,coverage2,nranges)
+                   values(?,?,?,?)''', (pid,) + stats)
+    return stats
+
+# actions a call_filter rule can take; see config.yaml
+FILTER_ACTIONS = ('keep', 'count', 'drop')
+FILTER_KEEP, FILTER_COUNT, FILTER_DROP = range(len(FILTER_ACTIONS))
+
+# Procedure: filter_calls
+# Purpose: decide which of a kit's calls to keep, count or drop
+# Input:
+#   kit, a KitData object with the parsed VCF calls
+#   refpos (optional), positions of reference-positive variants
+#   policy (optional), a list of rules; config call_filter by default
+# Returns:
+#   an array with the FILTER_ACTIONS index for each call
+# Info:
+#   The rules are evaluated on all of the calls at once. Calls at refpos
+#   positions are always kept.
+def filter_calls(kit, refpos=(), policy=None):
+    if policy is None:
+        policy = config.get('call_filter') or []
+    calls = unpack_calls(kit.callinfo)
+    ops = {'<': np.less, '<=': np.less_equal,
+           '>': np.greater, '>=': np.greater_equal}
+    action = np.full(len(kit.pos), -1, dtype=np.int8)
+    for rule in policy:
+        match = action < 0
+        for field, val in rule.items():
+            if field == 'action':
+                continue
+            elif field == 'passfail':
+                match &= calls['passfail'] == (val == 'PASS')
+            elif field == 'gt':
+                match &= calls['gt'] == gt_code(str(val))
+            elif field in ('ref', 'alt'):
+                codes = getattr(kit, field)
+                if val in kit.alleles:
+                    match &= codes == kit.alleles.index(val)
+                else:
+                    match[:] = False
+            elif field in ('q1', 'q2', 'nreads', 'passrate'):
+                op, num = str(val).split()
+                match &= ops[op](calls[field], float(num))
+            else:
+                raise ValueError('unknown call_filter condition {}'.format(field))
+        action[match] = FILTER_ACTIONS.index(rule['action'])
+    action[action < 0] = FILTER_KEEP
+    action[np.isin(kit.pos, refpos)] = FILTER_KEEP
+    return action
+
+# Procedure: store_VCF_stats
+# Purpose: record the counts of a kit's calls in vcfstats
+# Input:
+#   dbo, a database object
+#   pid, a person ID
+#   kit, a KitData object with the parsed VCF calls
+#   action, the filter_calls result for the kit
+# Info:
+#   ny, nv, ns and ni count the calls that were kept or counted: all of them,
+#   those that PASS, and of those the SNPs and the indels.
+def store_VCF_stats(dbo, pid, kit, action):
+    counts = np.bincount(action, minlength=len(FILTER_ACTIONS))
+    counted = action != FILTER_DROP
+    passed = counted & (unpack_calls(kit.callinfo)['passfail'] == 1)
+    alleles = kit.alleles or ['.']
+    onebase = np.array([len(a) == 1 and a != '.' for a in alleles])
+    derived = np.array([a != '.' for a in alleles])
+    snp = onebase[kit.ref] & onebase[kit.alt]
+    variant = passed & derived[kit.alt]
+    dbo.execute('delete from vcfstats where pID=?', (pid,))
+    dbo.execute('''insert into vcfstats(pID,ny,nv,ns,ni,nr,nc,nd)
+                   values(?,?,?,?,?,?,?,?)''',
+                (pid, int(counted.sum()), int(passed.sum()),
+                 int((variant & snp).sum()), int((variant & ~snp).sum()),
+                 int(counts[FILTER_KEEP]), int(counts[FILTER_COUNT]),
+                 int(counts[FILTER_DROP])))
+    return
+
+# Procedure: store_VCF_calls
+# Purpose: store the calls of a kit, along with new variants and alleles
+# Input:
+#   dbo, a database object
+#   bid, a build ID
+#   pid, a person ID
+#   kit, a KitData object with the parsed VCF calls
+#   refpos (optional), positions of reference-positive variants
+#   resolver (optional), an IDResolver shared across kits
+# Returns: the number of calls stored
+# Info:
+#   refpos is looked up in the database if it's not passed in
+#   Which calls are stored is decided by filter_calls, and the counts are
+#   written to vcfstats. The calls are also added to the call store, if it's
+#   turned on.
+def store_VCF_calls(dbo, bid, pid, kit, refpos=None, resolver=None):
+    if refpos is None:
+        refpos = [p for (p,) in dbo.execute('''select v.pos from variants v
+                                        inner join refpos r on r.vid=v.id''')]
+    if not resolver:
+        resolver = IDResolver(dbo)
+
+    # by default, clear reference calls are not inserted unless they are refpos
+    # FIXME - refpos test is not needed here because refpos variants do not
+    # show up in the .vcf with derived = "." (but this line is not harmful)
+    action = filter_calls(kit, refpos)
+    store_VCF_stats(dbo, pid, kit, action)
+    keep = action == FILTER_KEEP
+
+    # allele codes in the kit -> allele IDs in the database
+    aids = np.array(resolver.allele_ids(kit.alleles) or [0], dtype=np.int64)
+    vids = resolver.variant_ids(bid, kit.pos[keep].tolist(),
+                                aids[kit.ref[keep]].tolist(),
+                                aids[kit.alt[keep]].tolist())
+    trace(4,'VCF update variants at {}'.format(time.clock()))
+
+    # vcfcalls has one row per kit and variant: if the VCF has the same
+    # variant more than once, the last call is kept. The rows go in in vID
+    # order, the order of the table.
+    vids = np.array(vids, dtype=np.int64)
+    vids, last = np.unique(vids[::-1], return_index=True)
+    callinfo = kit.callinfo[keep][::-1][last]
+    dbo.executemany('insert into vcfcalls(pid,vid,callinfo) values(?,?,?)',
+                        zip(itertools.repeat(pid), vids.tolist(),
+                            callinfo.tolist()))
+    store = get_call_store(dbo)
+    if store:
+        store.append(pid, vids, callinfo)
+    trace(4,'VCF load for {} done at {}'.format(pid, time.clock()))
+    return len(vids)
+
+# Procedure: get_call_store
+# Purpose: get the call store, if it's turned on
+# Input:
+#   dbo, a database object
+# Returns: a CallStore for the configured call_store file, or None
+def get_call_store(dbo):
+    if not config.get('call_store'):
+        return None
+    return CallStore(dbo, data_path(config['call_store']))
+
+# Procedure: derived_calls
+# Purpose: find which of an array of calls are derived calls
+# Input:
+#   callinfo, an array of packed callinfo
+# Returns:
+#   a bool array, True for a PASS call that isn't 0/0 (as in has_derived)
+def derived_calls(callinfo):
+    calls = unpack_calls(callinfo)
+    return calls['passfail'] & (calls['gt'] != CALLINFO_GT['0/0'])
+
+# Procedure: get_kit_bitmaps
+# Purpose: get the index of derived and covered kits per variant, if it's on
+# Input:
+#   dbo, a database object
+# Returns: a KitBitmaps (see bitmaps.py), or None if kit_bitmaps is off
+def get_kit_bitmaps(dbo):
+    if not config.get('kit_bitmaps'):
+        return None
+    return KitBitmaps(dbo, lambda dbo, pid: merge_ranges(get_kit_ranges(dbo, pid)),
+                      derived_calls)
+
 # Procedure: populate_from_BED_file
 # Purpose: populate regions from a FTDNA BED file
 # Input:
@@ -744,93 +1643,126 @@ def populate_SNPs(dbo, maxage=config['max_snpdef_age']):
 #   pid, a database person ID
 #   fileobj, a file object from the open .bed file
 def populate_from_BED_file(dbo, pid, fileobj):
-    dc = dbo.cursor()
-    ranges = []
-    try:
-        for line in fileobj:
-            ychr, minr, maxr = line.split()
-            ranges.append((pid, int(minr), int(maxr)))
-    except:
-        trace(0, 'FAILED on file at {}'.format(fileobj.readline()))
-        return
-    trace(500, '{} ranges for pID {}'.format(len(ranges), pid))
-
-    dc.execute('drop table if exists tmpt')
-    dc.execute('create temporary table tmpt(a,b,c)')
-    dc.executemany('insert into tmpt values(?,?,?)', ranges)
-    dc.execute('''insert or ignore into bedranges(minaddr,maxaddr)
-                  select b,c from tmpt''')
-    dc.execute('''insert into bed(pID, bID)
-                  select t.a, br.id from bedranges br
-                  inner join tmpt t on
-                  t.b=br.minaddr and t.c=br.maxaddr''')
-    dc.close()
+    kit = KitData()
+    if kit.read_BED(fileobj):
+        if config['bed_storage'] == 'blob':
+            store_BED_blob(dbo, pid, kit.ranges)
+        else:
+            store_BED_ranges(dbo, pid, kit.ranges)
+        store_BED_stats(dbo, pid, kit.ranges)
     return
 
+# Packed callinfo layout
+# Info:
+#   vcfcalls.callinfo packs the quality information about a call into one
+#   integer. Each field is stored as an unsigned number of nbits bits starting
+#   at bit shift, after multiplying by scale and truncating to an integer.
+#   Values too large for the field are clamped to the field's maximum.
+#     field     shift  nbits  scale  meaning
+#     passfail     33      1      1  1 if the VCF FILTER was PASS
+#     gt           31      2      1  genotype code, see CALLINFO_GT
+#     q1           24      7      3  INFO BQ, base quality
+#     q2           17      7      2  INFO MQ, mapping quality
+#     nreads        8      9      1  DP, number of reads
+#     passrate      0      8    255  fraction of reads supporting the allele
+#   CALLINFO_DTYPE is the numpy record type of an unpacked callinfo.
+CALLINFO_LAYOUT = (('passfail', 33, 1, 1),
+                   ('gt', 31, 2, 1),
+                   ('q1', 24, 7, 3.),
+                   ('q2', 17, 7, 2.),
+                   ('nreads', 8, 9, 1),
+                   ('passrate', 0, 8, 255.))
+CALLINFO_DTYPE = np.dtype([('passfail', np.bool_),
+                           ('gt', np.uint8),
+                           ('q1', np.float64),
+                           ('q2', np.float64),
+                           ('nreads', np.uint16),
+                           ('passrate', np.float64)])
+CALLINFO_GT = {'0/0':0, '1/1':1, '0/2':2, '0/1':2, '1/2':3, '1/3':3, '2/2':3,
+               '0':0, '1':1, '2':3}
+
+# Procedure: gt_code
+# Purpose: get the CALLINFO_GT code of a genotype
+# Input:
+#   gt, a genotype as given by getVCFvariants, e.g. '0/1'
+# Returns: the code, 0 to 3
+# Info:
+#   A genotype that isn't in CALLINFO_GT is coded the way the ones that are
+#   in it are: 0 if all of its alleles are the reference, 1 if they're all
+#   the first alt, 2 if it has the reference and one alt, and 3 for any
+#   other mix, including a partial no-call such as ./1.
+def gt_code(gt):
+    if gt in CALLINFO_GT:
+        return CALLINFO_GT[gt]
+    alleles = set(gt.replace('|', '/').split('/'))
+    if alleles == {'0'}:
+        return 0
+    if alleles == {'1'}:
+        return 1
+    if len(alleles) == 2 and '0' in alleles and '.' not in alleles:
+        return 2
+    return 3
+
 # Procedure: pack_call
 # Purpose: pack call information into an integer
 # Info:
 #   this procedure exists to make vcfcalls table more compact
-#   stores: pos, anc, der, passfail, BQ, MQ, nreads, passrate, gt
+#   call_tup is (pos, anc, der, passfail, BQ, MQ, nreads, passrate, gt)
+#   stores: passfail, gt, BQ, MQ, nreads, passrate (see CALLINFO_LAYOUT)
 #   needs corresponding unpack_call
 def pack_call(call_tup):
-    maxshift = 33
-    ngbits = 2
-    nqbits = 7
-    ncbits = 9
-    npbits = 8
-    # pack in a pass/fail flag
-    bitfield = {'PASS': 1<<maxshift, 'FAIL': 0}[call_tup[3]]
-    maxshift -= 1
-    # pack in a genotype, [0,3]
-    gtdict = {'0/0':0, '1/1':1, '0/2':2, '0/1':2, '1/2':3, '1/3':3, '2/2':3}
-    bitfield |= (gtdict[call_tup[8]] << (maxshift - ngbits + 1))
-    maxshift -= ngbits
-    # pack in a unitless nqbits-number representing q1
-    qnum = int(float(call_tup[4]) * 3)
-    if qnum > (1<<nqbits) - 1:
-        qnum = (1<<nqbits)-1
-    bitfield |= (qnum << (maxshift - nqbits + 1))
-    maxshift -= nqbits
-    # pack in a unitless nqbits-number representing q2
-    qnum = int(float(call_tup[5]) * 2)
-    if qnum > (1<<nqbits) - 1:
-        qnum = (1<<nqbits) - 1
-    bitfield |= (qnum << (maxshift - nqbits + 1))
-    maxshift -= nqbits
-    # pack in a ncbits-bit number representing num reads
-    nreads = int(call_tup[6])
-    if nreads > (1<<ncbits) - 1:
-        nreads = (1<<ncbits) - 1
-    bitfield |= (nreads << (maxshift - ncbits + 1))
-    maxshift -= nqbits
-    # pack in a ncbits-bit number representing passrate
-    passrate = int(float(call_tup[7]) * ((1<<npbits) - 1))
-    if passrate > (1<<npbits) - 1:
-        passrate = (1<<npbits) - 1
-    bitfield |= passrate
+    vals = ({'PASS': 1, 'FAIL': 0}[call_tup[3]], gt_code(call_tup[8]),
+            float(call_tup[4]), float(call_tup[5]), int(call_tup[6]),
+            float(call_tup[7]))
+    bitfield = 0
+    for (field, shift, nbits, scale), val in zip(CALLINFO_LAYOUT, vals):
+        bitfield |= min(int(val * scale), (1<<nbits) - 1) << shift
     return bitfield
 
 # Procedure: unpack_call
 # Purpose: unpack callinfo (corresponds to pack_call)
+# Returns: passfail, gt, q1, q2, nreads, passrate
 # Info:
-#   if pack_call changes, this needs to change
+#   the fields and their scales come from CALLINFO_LAYOUT, as in pack_call
 def unpack_call(bitfield):
-    maxshift = 33
-    ngbits = 2
-    nqbits = 7
-    ncbits = 9
-    npbits = 8
-    passrate = float(bitfield & (1<<npbits) - 1) / ((1<<npbits) - 1)
-    calls = (bitfield>>npbits) & ((1<<ncbits) - 1)
-    q2 = float((bitfield>>(npbits+ncbits)) & ((1<<nqbits) - 1)) / 2.
-    q1 = float((bitfield>>(npbits+ncbits+nqbits)) & ((1<<nqbits) - 1)) /3.
-    gt = (bitfield>>(npbits+ncbits+nqbits*2)) & ((1<<ngbits) - 1)
-    if (1<<maxshift) & bitfield:
-        passfail = True
-    else:
-        passfail = False
-    return passfail, gt, q1, q2, calls, passrate
+    vals = []
+    for field, shift, nbits, scale in CALLINFO_LAYOUT:
+        val = (bitfield >> shift) & ((1<<nbits) - 1)
+        vals.append(val if scale == 1 else val / float(scale))
+    passfail, gt, q1, q2, calls, passrate = vals
+    return (bool(passfail), gt, q1, q2, calls, passrate)
+
+# Procedure: pack_calls
+# Purpose: pack an array of call information into callinfo integers
+# Input:
+#   calls, a numpy structured array with the fields of CALLINFO_DTYPE
+# Returns:
+#   an int64 array of callinfo, the same as pack_call gives for each call
+def pack_calls(calls):
+    bitfield = np.zeros(len(calls), dtype=np.int64)
+    for field, shift, nbits, scale in CALLINFO_LAYOUT:
+        val = (calls[field].astype(np.float64) * scale).astype(np.int64)
+        bitfield |= np.minimum(val, (1<<nbits) - 1) << shift
+    return bitfield
+
+# Procedure: unpack_calls
+# Purpose: unpack an array of callinfo integers (corresponds to pack_calls)
+# Input:
+#   bitfield, an array (or list) of callinfo integers
+# Returns:
+#   a numpy structured array of CALLINFO_DTYPE, one record per callinfo
+# Info:
+#   the whole column is decoded with a few vectorized operations per field
+def unpack_calls(bitfield):
+    bitfield = np.asarray(bitfield, dtype=np.int64)
+    calls = np.zeros(len(bitfield), dtype=CALLINFO_DTYPE)
+    for field, shift, nbits, scale in CALLINFO_LAYOUT:
+        val = (bitfield >> shift) & ((1<<nbits) - 1)
+        if scale == 1:
+            calls[field] = val
+        else:
+            calls[field] = val / scale
+    return calls
 
 # Procedure: populate_from_VCF_file
 # Purpose: populate calls, quality, and variants from a VCF file
@@ -842,97 +1774,591 @@ def unpack_call(bitfield):
 # Returns: nothing, only updates database tables
 # Info:
 #   depends on refpos table, which should already be populated
+#   A gVCF has the kit's coverage too, which is stored as with a BED file.
 def populate_from_VCF_file(dbo, bid, pid, fileobj):
     dc = dbo.cursor()
     b = dc.execute('select buildNm from build where id=?', (bid,)).fetchone()[0]
     if b != 'hg38':
         trace(0, 'ERROR: currently unable to parse build {}'.format(b))
         return
-    # parse output of getVCFvariants(fname)
-    parsed = getVCFvariants(fileobj)
-    tups = []
-    for line in parsed.splitlines():
-        # pos, anc, der, passfail, q1, q2, nreads, passrate, gt
-        tups.append(line.split())
-    trace(5, 'parsed vcf: {}...'.format(tups[:3]))
-
-    # filter down to the calls we want to store
-    try:
-        #passes = [t for t in tups if t[2] != '.' and (t[3] == 'PASS' or
-        #          (int(t[6]) < 4 and float(t[7]) > .75))]
-        passes = [t for t in tups]
-    except ValueError:
-        trace(0, 'parsing VCF failed on {}'.format(t))
-
-    # save the distinct alleles - check performance
-    alleles = set([x[1] for x in passes] + [x[2] for x in passes])
-    dc.executemany('insert or ignore into alleles(allele) values(?)',
-                       [(x,) for x in alleles])
-
-    # save the call quality info - experimental
-    call_info = [t + [pack_call(t)] for t in passes]
-
-    # execute sql on results to save in vcfcalls
-    dc.execute('drop table if exists tmpt')
-    # bid, pos, ref, alt, pid, passfail, gt, packcall
-    dc.execute('''create temporary table tmpt(a integer, b integer, c text,
-                  d text, e integer, f text, g text, h integer)''')
-    dc.executemany('insert into tmpt values(?,?,?,?,?,?,?,?)',
-                    [[bid]+v[0:3]+[pid]+[v[3]]+v[-2:] for v in call_info])
-
-    # don't insert clear reference calls unless they are refpos
-    # FIXME - refpos test is not needed here because refpos variants do not
-    # show up in the .vcf with derived = "." (but this line is not harmful)
-    dc.execute('''delete from tmpt where g='0/0' and d='.' and f='PASS'
-                  and b not in (select v.pos from variants v
-                    inner join refpos r on r.vid=v.id)''')
-
-    dc.execute('''insert or ignore into variants(buildID, pos, anc, der)
-                  select a, b, an.id, dr.id from tmpt
-                  inner join alleles an on an.allele = c
-                  inner join alleles dr on dr.allele = d''')
-
+    # FIXME - filter down to the calls we want to store? e.g.
+    #   t[2] != '.' and (t[3] == 'PASS' or (t[6] < 4 and t[7] > .75))
+    kit = KitData()
+    kit.read_VCF(fileobj)
+    if len(kit.ranges):
+        store_kit(dbo, pid, bid, kit)
+    else:
+        store_VCF_calls(dbo, bid, pid, kit)
+    return
 
-    # fixme - performance?
-    trace(4,'VCF update variants at {}'.format(time.clock()))
+# Procedure: scan_VCF_targets
+# Purpose: quickly check an open VCF file for a derived call at any target
+# Input:
+#   fileobj, a file object for the open VCF file
+#   targets, a dictionary of position -> set of derived alleles
+# Returns: True as soon as a derived call at a target is found
+# Info:
+#   Only the position of each line is looked at, until it's a target; those
+#   lines are parsed by getVCFvariants. A derived call is a PASS call of a
+#   derived allele that isn't 0/0.
+def scan_VCF_targets(fileobj, targets):
+    for line in fileobj:
+        fields = line.split(None, 2)
+        try:
+            if int(fields[1]) not in targets:
+                continue
+        except (IndexError, ValueError):
+            continue
+        for t in getVCFvariants([line]):
+            if t[3] == 'PASS' and t[8] != '0/0' and t[2] in targets[t[0]]:
+                return True
+    return False
 
-    dc.execute('''insert into vcfcalls (pid,vid,callinfo)
-                  select e, v.id, h from tmpt
-                  inner join alleles an on an.allele = c
-                  inner join alleles dr on dr.allele = d
-                  inner join variants v on v.buildID = a and v.pos = b
-                  and v.anc=an.id and v.der=dr.id''')
+# Procedure: get_load_selection
+# Purpose: get the load_select criteria that decide which kits are loaded
+# Input:
+#   dbo, a database object
+# Returns:
+#   None if every kit is to be loaded, or else a dictionary with:
+#     key: the criteria as a string, recorded in the journal of excluded kits
+#     pids: the set of DNAIDs that match approxHg and build, or None
+#     targets: position -> set of derived alleles of the snps, or None
+# Info:
+#   approxHg and build are decided from the dataset table, before a kit's
+#   zip is opened. The snps are decided by scan_VCF_targets, before the kit
+#   is parsed.
+def get_load_selection(dbo):
+    sel = dict([(k,v) for (k,v) in (config.get('load_select') or {}).items()
+                    if v])
+    if not sel:
+        return None
+    selection = {'key': json.dumps(sel, sort_keys=True), 'pids': None,
+                 'targets': None}
+    where, args = [], []
+    if sel.get('approxHg'):
+        where.append('approxHg like ?')
+        args.append(sel['approxHg'])
+    if sel.get('build'):
+        where.append('buildID=?')
+        args.append(get_build_byname(dbo, sel['build']))
+    if where:
+        selection['pids'] = set([p for (p,) in dbo.execute(
+            'select DNAID from dataset where ' + ' and '.join(where), args)])
+    if sel.get('snps'):
+        found, unresolved = resolve_names(dbo, 'snp', sel['snps'], 'hg38')
+        if unresolved:
+            trace(0, 'load_select snps not found: {}'.format(unresolved))
+        targets = collections.defaultdict(set)
+        for vid in [v for vids in found.values() for v in vids]:
+            for pos, der in dbo.execute('''select v.pos, a.allele from variants v
+                                           inner join alleles a on a.id=v.der
+                                           where v.id=?''', (vid,)):
+                targets[pos].add(der)
+        selection['targets'] = dict(targets)
+    trace(1, 'load only kits matching {}'.format(selection['key']))
+    return selection
+
+# Procedure: kit_cache_path
+# Purpose: where the parsed arrays of a kit zip file are cached
+# Input:
+#   filehash, the md5 of the zip file
+# Returns:
+#   the path of the .npz file under the configured kit_cache directory, or
+#   None if the cache is turned off
+# Info:
+#   The cache is keyed by the zip's contents and KIT_PARSER_VERSION, so a
+#   changed zip or parser never reads a stale entry. Nothing is ever removed
+#   from the cache; delete the directory to clear it.
+def kit_cache_path(filehash):
+    if not config.get('kit_cache'):
+        return None
+    cachedir = data_path(config['kit_cache'])
+    os.makedirs(cachedir, exist_ok=True)
+    return os.path.join(cachedir, '{}-v{}.npz'.format(filehash,
+                                                      KIT_PARSER_VERSION))
+
+# Kit parser registry
+# Info:
+#   A kit parser opens the data of one kit in a KitArchive. It returns a pair
+#   (bed, vcf) of iterables of lines: the BED file, or None if the coverage
+#   comes from a gVCF, and the VCF header and chrY records. It returns None if
+#   the archive doesn't have the data it needs. read_kit_zip parses what it
+#   returns into a KitData, the same for every parser.
+#
+#   Parsers are registered for a lab, test type and build, as named in the
+#   lab, testtype and build tables. The lab and test type are fnmatch
+#   patterns, and None matches anything. find_kit_parser picks the parser
+#   that matches the most of a kit's lab, test type and build.
+KIT_PARSERS = []
+
+# Procedure: register_kit_parser
+# Purpose: a decorator that adds a kit parser to the registry
+# Examples:
+#   @register_kit_parser(lab='YSEQ', testtype='WGS*', build='hg38')
+#   def open_yseq_kit(ka): ...
+def register_kit_parser(lab=None, testtype=None, build=None):
+    def register(parser):
+        KIT_PARSERS.append(((lab, testtype, build), parser))
+        return parser
+    return register
+
+# Procedure: find_kit_parser
+# Purpose: find the kit parser for a lab, test type and build
+# Returns: the parser function, or None if no parser matches
+def find_kit_parser(lab, testtype, build):
+    best, bestscore = None, -1
+    for key, parser in KIT_PARSERS:
+        score = 0
+        for pattern, name in zip(key, (lab, testtype, build)):
+            if pattern is None:
+                continue
+            if not name or not fnmatch.fnmatch(name.lower(), pattern.lower()):
+                break
+            score += 1
+        else:
+            if score > bestscore:
+                best, bestscore = parser, score
+    return best
+
+# Procedure: index_offset
+# Purpose: find where a sequence's records start in a bgzip-compressed file
+# Input:
+#   index, the contents of the file's tabix (.tbi) or CSI (.csi) index
+#   names, the names the sequence might have, e.g. ('chrY', 'Y')
+# Returns:
+#   the BGZF virtual offset of the sequence's first record, or None if the
+#   sequence isn't in the index
+# Info:
+#   This is the smallest start of any chunk of the sequence's bins; the
+#   pseudo-bin, which holds statistics, is left out. See the SAMtools
+#   tabix and CSI specifications.
+def index_offset(index, names):
+    data = gzip.decompress(index)
+    if data[:4] == b'TBI\1':
+        nref, = struct.unpack_from('<i', data, 4)
+        lnm, = struct.unpack_from('<i', data, 32)
+        refnames = data[36:36+lnm].split(b'\0')[:nref]
+        off = 36 + lnm
+        pseudo, csi = 37450, False
+    elif data[:4] == b'CSI\1':
+        minshift, depth, laux = struct.unpack_from('<3i', data, 4)
+        lnm, = struct.unpack_from('<i', data, 16+24)
+        refnames = data[16+28:16+28+lnm].split(b'\0')
+        off = 16 + laux
+        nref, = struct.unpack_from('<i', data, off)
+        off += 4
+        pseudo, csi = ((1 << ((depth+1)*3)) - 1) // 7 + 1, True
+    else:
+        return None
+    for ii in range(nref):
+        voff = None
+        nbin, = struct.unpack_from('<i', data, off)
+        off += 4
+        for jj in range(nbin):
+            binno, = struct.unpack_from('<I', data, off)
+            off += 12 if csi else 4
+            nchunk, = struct.unpack_from('<i', data, off)
+            off += 4
+            chunks = struct.unpack_from('<{}Q'.format(2*nchunk), data, off)
+            off += 16 * nchunk
+            if binno != pseudo and nchunk:
+                voff = min(chunks[0::2] + ((voff,) if voff is not None else ()))
+        if not csi:
+            nintv, = struct.unpack_from('<i', data, off)
+            off += 4 + 8 * nintv
+        if refnames[ii].decode() in names:
+            return voff
+    return None
+
+# names of the Y chromosome in the VCF files of various labs
+CHRY_NAMES = ('chrY', 'Y')
+
+# Procedure: read_chrY
+# Purpose: read the header and the chrY records of a VCF in an archive
+# Input:
+#   member, a (ZipFile, ZipInfo) pair for the VCF, plain or bgzip-compressed
+#   index (optional), the contents of the VCF's tabix or CSI index
+# Returns:
+#   a generator of the header lines, then the chrY lines
+# Info:
+#   With an index, reading skips to the first chrY record, so the BGZF
+#   blocks before it are never gunzipped or split into lines. Only that
+#   layer is skipped: if the zip member itself is deflated, seeking in it
+#   still inflates everything before the offset; a stored member is
+#   skipped outright. Without an index, the other records are skipped by
+#   looking at the start of each line. Either way, reading stops at the end
+#   of chrY, since a VCF is sorted.
+def read_chrY(member, index=None):
+    prefixes = tuple([n.encode() + b'\t' for n in CHRY_NAMES])
+    compressed = member[1].filename.lower().endswith('.gz')
+    voff = compressed and index and index_offset(index, CHRY_NAMES)
+    with member[0].open(member[1]) as f:
+        lines = gzip.GzipFile(fileobj=f) if compressed else f
+        if voff:
+            for line in lines:
+                if not line.startswith(b'#'):
+                    break
+                yield line
+            f.seek(voff >> 16)
+            lines = gzip.GzipFile(fileobj=f)
+            lines.read(voff & 0xffff)
+        seen = False
+        for line in lines:
+            if line.startswith(prefixes):
+                seen = True
+                yield line
+            elif seen:
+                break
+            elif line.startswith(b'#'):
+                yield line
+
+# Procedure: open_ftdna_kit
+# Purpose: kit parser for FTDNA Big Y zips, and others laid out like them
+# Info:
+#   The BED and VCF are found by their FTDNA names. A zip with a gVCF
+#   instead doesn't need a BED.
+@register_kit_parser(build='hg38')
+def open_ftdna_kit(ka):
+    if (not ka.vcf) or not (ka.bed or ka.gvcf):
+        return None
+    return (None if ka.gvcf else ka.open_bed()), ka.open_vcf()
+
+# file names of the VCF files of whole-genome tests
+wgs_vcf_re = re.compile(r'\.vcf(?:\.gz)?$', re.IGNORECASE)
+
+# Procedure: open_wgs_kit
+# Purpose: kit parser for whole-genome VCF and gVCF files
+# Info:
+#   Only the chrY records are read (see read_chrY), using the VCF's index if
+#   the zip has one next to it. A BED file in the zip is used for coverage;
+#   without one, a plain VCF gives no coverage and a gVCF gives its own.
+#   The kit's data hash is taken from the zip's CRC-32 and size of the files
+#   (KitArchive.quick_hash), so the whole genome isn't read just for that.
+@register_kit_parser(testtype='*WGS*', build='hg38')
+@register_kit_parser(testtype='*whole genome*', build='hg38')
+def open_wgs_kit(ka):
+    member = ka.vcf or ka.find(wgs_vcf_re)
+    if not member:
+        return None
+    ka.vcf = member
+    ka.quick_hash = True
+    index = None
+    for ext in ('.tbi', '.csi'):
+        imember = ka.find(re.compile(re.escape(
+            os.path.basename(member[1].filename) + ext) + '$'))
+        if imember:
+            with imember[0].open(imember[1]) as f:
+                index = f.read()
+            break
+    return (ka.open_bed() if ka.bed else None), read_chrY(member, index)
 
-    trace(4,'VCF load for {} done at {}'.format(pid, time.clock()))
-    dc.execute('drop table tmpt')
-    dc.close()
+# Procedure: read_kit_zip
+# Purpose: open a kit's zip file and parse the BED and VCF files in it
+# Input:
+#   task, a tuple (zipf, buildid, pid, parser), where zipf is the zip file
+#     path and parser is its kit parser (see find_kit_parser)
+#   targets (optional), load_select SNPs, see get_load_selection
+#   fasta (optional), reference FASTA file for normalizing indels
+# Returns:
+#   the task tuple with a KitData appended; the KitData is None if the zip
+#   could not be read or does not have the data the parser needs
+# Info:
+#   This does not use the database, so it can run in a worker process.
+#   The BED and VCF may also be inside a zip in the zip (see KitArchive).
+#   A zip that was parsed before is read from the kit cache instead.
+#   With targets, a kit without a derived call at any of them is not parsed,
+#   and its KitData is marked as not selected.
+#   With fasta, the indels are normalized after the kit is parsed or read
+#   from the cache, so the cache always has the calls as the VCF has them.
+def read_kit_zip(task, targets=None, fasta=None):
+    zipf = task[0]
+    kit = None
+    try:
+        # use what was parsed from this zip before, if it's in the cache
+        filehash = file_md5(zipf)
+        cachef = kit_cache_path(filehash)
+        if cachef and os.path.exists(cachef):
+            kit = KitData()
+            st = os.stat(zipf)
+            kit.filesize, kit.filemtime = st.st_size, st.st_mtime
+            kit.filehash = filehash
+            try:
+                kit.load(cachef)
+                trace(3, 'cached {}'.format(os.path.basename(cachef)))
+                if targets is not None and not kit.has_derived(targets):
+                    kit = KitData()
+                    kit.filesize, kit.filemtime = st.st_size, st.st_mtime
+                    kit.filehash = filehash
+                    kit.selected = False
+                elif fasta:
+                    kit.normalize_indels(fasta)
+                return task + (kit,)
+            except Exception:
+                trace(0, 'bad cache file {} - parse the zip'.format(cachef))
+        # open the zip file and pull out the BED and VCF
+        parser = task[3]
+        with KitArchive(zipf) as ka:
+            files = parser(ka)
+            if not files:
+                trace(0, 'FAIL: missing data:{} (not loaded)'.format(zipf))
+                return task + (None,)
+            kit = KitData()
+            st = os.stat(zipf)
+            kit.filesize, kit.filemtime = st.st_size, st.st_mtime
+            kit.filehash = filehash
+            if targets is not None:
+                if not scan_VCF_targets(files[1], targets):
+                    kit.selected = False
+                    return task + (kit,)
+                files = parser(ka)
+            trace(3, 'parse {} with {}'.format(zipf, parser.__name__))
+            kit.datahash = ka.data_md5()
+            if files[0]:
+                kit.read_BED(files[0])
+            kit.read_VCF(files[1])
+    except Exception:
+        trace(0, 'FAIL on file {} (not loaded)'.format(zipf))
+        return task + (None,)
+    if cachef:
+        try:
+            kit.save(cachef)
+        except OSError:
+            trace(0, 'unable to write cache file {}'.format(cachef))
+    if fasta:
+        kit.normalize_indels(fasta)
+    return task + (kit,)
+
+# Procedure: read_kit_zips
+# Purpose: parse a list of kit zip files, optionally in parallel
+# Input:
+#   tasks, a list of (zipf, buildid, pid) tuples
+#   jobs (optional), the number of worker processes to use
+#   targets (optional), load_select SNPs, passed on to read_kit_zip
+#   fasta (optional), reference FASTA file, passed on to read_kit_zip
+# Returns:
+#   a generator of read_kit_zip results, in the same order as tasks
+# Info:
+#   With jobs > 1, a pool of processes unzips and parses the kits while the
+#   caller stores them. No more than 2*jobs parsed kits are kept waiting for
+#   the caller, which bounds memory use.
+def read_kit_zips(tasks, jobs=1, targets=None, fasta=None):
+    if jobs <= 1:
+        for task in tasks:
+            yield read_kit_zip(task, targets, fasta)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(read_kit_zip, (task, targets, fasta)))
+            if len(pending) >= 2*jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+# Procedure: store_kit
+# Purpose: store everything that was parsed from a kit
+# Input:
+#   dbo, a database object
+#   pid, a person ID
+#   buildid, a build ID
+#   kit, a KitData object
+#   refpos (optional), positions of reference-positive variants
+#   resolver (optional), an IDResolver shared across kits
+#   ageranges (optional), the age.bed ranges from get_age_ranges
+# Returns: the number of ranges and the number of calls stored
+# Info:
+#   ranges go to bed or bedblob according to the bed_storage config setting
+def store_kit(dbo, pid, buildid, kit, refpos=None, resolver=None,
+              ageranges=None):
+    if not resolver:
+        resolver = IDResolver(dbo)
+    if config['bed_storage'] == 'blob':
+        nranges = store_BED_blob(dbo, pid, kit.ranges)
+    else:
+        nranges = store_BED_ranges(dbo, pid, kit.ranges)
+    store_BED_stats(dbo, pid, kit.ranges, ageranges)
+    ncalls = store_VCF_calls(dbo, buildid, pid, kit, refpos, resolver)
+    return nranges, ncalls
 
-    trace(500, '{} vcf calls: {}...'.format(len(passes), passes[:5]))
+# Procedure: journal_kit
+# Purpose: record the outcome of loading a kit in the load journal
+# Input:
+#   dbo, a database object
+#   pid, a person ID
+#   zipf, the zip file the kit was loaded from
+#   kit, the KitData that was parsed from zipf, or None if parsing failed
+#   status, 'loaded', 'duplicate', 'excluded' or 'failed'
+#   counts (optional), the number of ranges and calls that were stored
+#   copyof (optional), for a duplicate, the pID that has the same data
+#   selection (optional), for an excluded kit, the load_select key
+def journal_kit(dbo, pid, zipf, kit, status, counts=(None,None), copyof=None,
+                selection=None):
+    if kit:
+        size, mtime, hash = kit.filesize, kit.filemtime, kit.filehash
+        datahash = kit.datahash
+    else:
+        st = os.stat(zipf)
+        size, mtime, hash, datahash = st.st_size, st.st_mtime, None, None
+    dbo.execute('''insert or replace into loadjournal(pID, fileNm, fileSize,
+                       fileMtime, hash, parserVer, nranges, ncalls, status,
+                       loadDt, dataHash, copyOf, selection)
+                   values(?,?,?,?,?,?,?,?,?,datetime('now'),?,?,?)''',
+                   (pid, os.path.basename(zipf), size, mtime, hash,
+                    KIT_PARSER_VERSION, counts[0], counts[1], status,
+                    datahash, copyof, selection))
     return
 
+# Procedure: kit_is_stored
+# Purpose: find out if a kit has calls or ranges in the database
+# Input:
+#   dbo, a database object
+#   pid, a person ID
+# Returns: True if vcfcalls or bed has rows for the kit
+# Info:
+#   Kits loaded before there was a load journal have data but no journal
+#   row; the data has to be removed before the kit is loaded again.
+def kit_is_stored(dbo, pid):
+    return dbo.execute('''select 1 from vcfcalls where pID=?
+                          union all
+                          select 1 from bed where pID=?
+                          limit 1''', (pid, pid)).fetchone() is not None
+
+# Procedure: clear_kit
+# Purpose: remove what was loaded for a kit, before it's loaded again
+# Input:
+#   dbo, a database object
+#   pid, a person ID
+# Info:
+#   The rows go in the caller's transaction, so they're only gone once the
+#   kit's new data (or its new journal row) is committed with them.
+def clear_kit(dbo, pid):
+    for tbl in ('vcfcalls', 'bed', 'bedblob', 'vcfstats', 'bedstats',
+                'callstore', 'kitbitmapkits', 'loadjournal'):
+        dbo.execute('delete from {} where pID=?'.format(tbl), (pid,))
+
+# chrY lengths of the builds, for telling them apart in a VCF header
+CHRY_LENGTHS = {57227415: 'hg38', 59373566: 'hg19'}
+
+# Procedure: vcf_build
+# Purpose: work out the reference build of a VCF from its header
+# Input:
+#   lines, the lines of the VCF; only the header is read
+# Returns: 'hg38' or 'hg19', or None if the header doesn't say
+# Info:
+#   The length of the chrY contig is different in each build. Failing that,
+#   the ##reference line is checked for the name of a build.
+def vcf_build(lines):
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if not line.startswith('##'):
+            break
+        m = re.match(r'##contig=<ID=(?:chr)?Y,(?:.*,)?length=(\d+)', line)
+        if m and int(m.group(1)) in CHRY_LENGTHS:
+            return CHRY_LENGTHS[int(m.group(1))]
+        if line.startswith('##reference='):
+            if re.search('hg38|grch38|b38', line, re.IGNORECASE):
+                return 'hg38'
+            if re.search('hg19|grch37|b37|hs37', line, re.IGNORECASE):
+                return 'hg19'
+    return None
+
 # Procedure: populate_from_zip_file
-# Purpose: unpack any zip from FTDNA that has the bed file and vcf file
+# Purpose: load a kit zip that isn't in the Haplogroup-R catalog
+# Input:
+#   dbo, a database object
+#   fname, path to the zip file
+#   lab (optional), name of the testing lab, used to pick the kit parser
+#   testtype (optional), name of the test, used to pick the kit parser
+# Returns: the DNAID the kit was loaded as, or None if it wasn't loaded
 # Info:
-#   INCOMPLETE
-#   future: to permit import of .zip that isn't in Hap-R repository
-def populate_from_zip_file(dbo, fname):
-    # stub work in progress Jef
-    # unpack bed and vcf to a temporary unzip dir
-    # use the surname-kitID of unzip file as the kit name in the dataset table
-    # create dataset entry if needed
-    # pid = get_person_id
-    # auto-determine build name for FTDNA to get build id (parsed from first lines)
-    # bid = get_build_byname()
-    # fname = unpacked vcf from unzip dir
-    # populate_from_VCF_file
-    # populate_from_BED_file
-    return
+#   The zip's name, e.g. Treece-N4826.zip as from unpack-zip-files, is used
+#   as the kitId, and the part before the last - as the surname. A dataset
+#   entry is created if there isn't one. The build comes from the VCF
+#   header, and is assumed to be hg38 if the header doesn't say. Anything
+#   loaded for the kit before is replaced.
+def populate_from_zip_file(dbo, fname, lab=None, testtype=None):
+    kitid = os.path.splitext(os.path.basename(fname))[0]
+    surname = kitid.rpartition('-')[0] or 'Unknown'
+    with KitArchive(fname) as ka:
+        member = ka.vcf or ka.find(wgs_vcf_re)
+        if not member:
+            trace(0, 'FAIL: no VCF in {} (not loaded)'.format(fname))
+            return None
+        build = vcf_build(read_chrY(member))
+    if not build:
+        trace(1, 'no build in the VCF header of {} - using hg38'.format(fname))
+        build = 'hg38'
+    parser = find_kit_parser(lab, testtype, build)
+    if not parser:
+        trace(0, 'ERROR: no kit parser for {}, {}, {} for {}'.format(
+            lab, testtype, build, fname))
+        return None
+    bid = get_build_byname(dbo, build)
+
+    # add what's needed to the lookup tables and dataset
+    dc = dbo.cursor()
+    labid = ttid = None
+    if lab:
+        dc.execute('insert or ignore into lab(labNm) values(?)', (lab,))
+        labid, = dc.execute('select id from lab where labNm=?', (lab,)).fetchone()
+    if testtype:
+        row = dc.execute('select id from testtype where testNm=?',
+                         (testtype,)).fetchone()
+        if not row:
+            dc.execute('insert into testtype(testNm,isNGS) values(?,1)',
+                       (testtype,))
+            row = (dc.lastrowid,)
+        ttid = row[0]
+    # as in update_metadata, (surname+kitId+build) goes into person
+    dc.execute('''insert or ignore into person(surname,firstName,middleName)
+                  values(?,?,?)''', (surname, kitid, build))
+    dnaid, = dc.execute('''select id from person where surname=? and
+                          firstName=? and middleName=?''',
+                       (surname, kitid, build)).fetchone()
+    dc.execute('''insert or ignore into dataset(kitId,fileNm,origFileNm,buildID,
+                      labID,testTypeID,DNAID)
+                  values(?,?,?,?,?,?,?)''', (kitid, os.path.basename(fname),
+                  fname, bid, labid, ttid, dnaid))
+    pid, = dc.execute('select DNAID from dataset where kitId=?',
+                      (kitid,)).fetchone()
+
+    zipf, bid, pid, parser, kit = read_kit_zip((fname, bid, pid, parser),
+                                               fasta=indel_fasta())
+    clear_kit(dbo, pid)
+    if not kit:
+        journal_kit(dbo, pid, fname, kit, 'failed')
+        dbo.commit()
+        return None
+    counts = store_kit(dbo, pid, bid, kit)
+    journal_kit(dbo, pid, fname, kit, 'loaded', counts)
+    bitmaps = get_kit_bitmaps(dbo)
+    if bitmaps:
+        bitmaps.update()
+    dbo.commit()
+    trace(1, 'loaded {} as {}: {} ranges, {} calls'.format(kitid, pid, *counts))
+    return pid
+
+# Procedure: indel_fasta
+# Purpose: get the reference FASTA for normalizing indels
+# Returns:
+#   the uncompressed FASTA file, or None if normalize_indels is turned off or
+#   the file can't be had
+def indel_fasta():
+    if not config['normalize_indels']:
+        return None
+    try:
+        return get_FASTA_fromweb(config['ref_fasta_hg38'])
+    except Exception:
+        trace(0, 'failed to get the reference FASTA; indels not normalized')
+        return None
 
 # Procedure: populate_from_dataset
 # Purpose:
 #   unpack all zip files that can be handled from the HaplogroupR catalog.
 # Input:
 #   dbo, a database object
+#   jobs (optional), number of processes used to parse the zip files
 #   uses any zip files already downloaded into the data directory
 # Info:
 #   Uses previously-populated dataset table to find these files.
@@ -940,105 +2366,440 @@ def populate_from_zip_file(dbo, fname):
 #   already downloaded some zip files.
 #
 #   Loop over kit metadata in dataset table; if zip file exists locally:
-#     if already loaded (calls exist in the db), skip this file
-#     read the BED and VCF file from it in place, without landing on disk
+#     if already loaded from the same zip (per loadjournal), skip this file
+#     if loaded from a different zip, or it failed, or it has data but no
+#       journal row, remove it and reload
+#     read the BED and VCF file from it in place, without landing on disk,
+#       with the kit parser for the kit's lab, test type and build
 #     store the VCF data in vcfcalls
 #     store the BED ranges
 #
+#   Reading and parsing the zip files is done by read_kit_zips, in a pool of
+#   worker processes if jobs > 1. This process is the only database writer;
+#   it commits after every kits_per_commit kits, and a kit that fails to
+#   store is rolled back by itself. IDs of alleles, variants and ranges come
+#   from one IDResolver that lives for the whole load.
+#
+#   With load_select criteria (see get_load_selection), kits that don't
+#   match are not loaded, and are journaled as 'excluded' so they aren't
+#   looked at again while the criteria stay the same. Kits that were already
+#   loaded are kept, as they are, with their journal rows. The same goes for
+#   a kit that has no kit parser: what was loaded before is only removed
+#   once the kit is queued to be loaded again, and it's removed in the same
+#   transaction as the new data, so kits past the kitlimit keep theirs.
+#
+#   The load journal records the zip file's size, mtime and md5 hash, the
+#   parser version, and row counts for every kit. A kit is unchanged if the
+#   size and mtime match; if they don't, the hash is compared. The journal
+#   row is written in the same transaction as the kit's data, so after a
+#   crash, a re-run picks up with the kits that were not committed.
+#
 # Future:
 #   also download files?
-def populate_from_dataset(dbo):
-    trace(1, 'populate from dataset with kit limit {}'.format(
-        config['kitlimit']))
+def populate_from_dataset(dbo, jobs=1):
+    trace(1, 'populate from dataset with kit limit {}, {} jobs'.format(
+        config['kitlimit'], jobs))
     dc = dbo.cursor()
-    bed_re = re.compile(r'(\b(?:\w*[^_/])?regions(?:\[\d\])?\.bed)')
-    vcf_re = re.compile(r'(\b(?:\w*[^_/])?variants(?:\[\d\])?\.vcf)')
     # Query to get all known kits, with analysis_kits prioritized.
     # Prioritizing analysis_kits means they're loaded first, and we don't need
     # to load thousands of kits to get the ones we're interested in.
     # NB: adding a kit to exclude_kits does not prevent it from loading
-    dc.execute('''select fileNm,buildID,DNAID,1 from dataset
+    # The lab, test type and build names choose the kit parser.
+    dc.execute('''select fileNm,buildID,DNAID,labNm,testNm,buildNm,1
+                  from dataset d
                   inner join analysis_kits on pID=DNAID
+                  left join lab l on l.ID=d.labID
+                  left join testtype t on t.ID=d.testTypeID
+                  left join build b on b.ID=d.buildID
                         union
-                  select fileNm,buildID,DNAID,2 from dataset
-                  order by 4''')
-    allsets = list([(t[0],t[1],t[2]) for t in dc])
-    pc = dbo.cursor()
-    pl = pc.execute('select distinct pid from vcfcalls')
-    pexists = [p[0] for p in pl]
+                  select fileNm,buildID,DNAID,labNm,testNm,buildNm,2
+                  from dataset d
+                  left join lab l on l.ID=d.labID
+                  left join testtype t on t.ID=d.testTypeID
+                  left join build b on b.ID=d.buildID
+                  order by 7''')
+    allsets = list([t[:6] for t in dc])
+    journal = dict([(t[0],t[1:]) for t in dc.execute('''select pID,fileSize,
+                       fileMtime,hash,parserVer,status,copyOf,selection
+                       from loadjournal''')])
     trace(5,'allsets: {}'.format(allsets[:config['kitlimit']]))
-    nkits = 0
-
-    # FIXME - hack - better index handling might be desirable.
-    # Here we drop indexes while updating because inserts are faster.
-    # Later, we re-create these indexes after all of the updates are done.
-    trace(3, 'drop indexes at {}'.format(time.clock()))
-    dc.execute('drop index if exists bedidx')
-    dc.execute('drop index if exists vcfidx')
-    dc.execute('drop index if exists vcfpidx')
-    trace(3, 'done at {}'.format(time.clock()))
-
-    for (fn,buildid,pid) in allsets:
-
-        # begin work so we can roll back this kit if it fails
-        trace(3, 'committing work')
-        dbo.commit()
-
-        # Loop over the kits we know about.
-        # If there are already calls for this person, skip the load.
-        if (not config['drop_tables']) and pid in pexists:
-            trace(3, 'calls exist - skip {}'.format(fn[:50]))
+    refpos = [p for (p,) in dc.execute('''select v.pos from variants v
+                                    inner join refpos r on r.vid=v.id''')]
+    ageranges = get_age_ranges(dbo)
+    selection = get_load_selection(dbo)
+    selkey = selection and selection['key']
+    fasta = indel_fasta()
+    # kits with stats rows; kit_is_stored also looks at vcfcalls and bed
+    stored = set([p for (p,) in dc.execute('''select pID from vcfstats
+                                              union select pID from bedstats
+                                              union select pID from bedblob
+                                              union select pID from callstore''')])
+
+    # Loop over the kits we know about to decide which ones to load.
+    # An analysis kit is listed twice by the query above; load it once.
+    tasks = []
+    stale = set()
+    loaded = set()
+    excluded = []
+    skipped = {}
+    seen = set()
+    for (fn,buildid,pid,lab,testtype,build) in allsets:
+        if pid in seen:
             continue
+        seen.add(pid)
         zipf = os.path.join(data_path('HaplogroupR'), fn)
         if not os.path.exists(zipf):
             trace(10, 'not present: {}'.format(zipf))
             continue
-        try:
-            # open the zip file and pull out the BED and VCF
-            with zipfile.ZipFile(zipf) as zf:
-                trace(1, '{}-{}'.format(nkits,zf.filename[:70]))
-                listfiles = zf.namelist()
-                bedfile = vcffile = None
-                for ff in listfiles:
-                    dirname, basename = os.path.split(ff)
-                    if bed_re.search(basename):
-                        bedfile = ff
-                    elif vcf_re.search(basename):
-                        vcffile = ff
-                if (not bedfile) or (not vcffile):
-                    trace(0, 'FAIL: missing data:{} (not loaded)'.format(zipf))
+        parser = find_kit_parser(lab, testtype, build)
+        # If this person was already loaded from the same zip, skip the load.
+        if (not config['drop_tables']) and pid in journal:
+            size, mtime, hash, ver, status, copyof, jselkey = journal[pid]
+            done = status in ('loaded','duplicate') or \
+                       (status == 'excluded' and jselkey == selkey)
+            if done and ver == KIT_PARSER_VERSION:
+                st = os.stat(zipf)
+                if (size, mtime) == (st.st_size, st.st_mtime):
+                    trace(3, 'already loaded - skip {}'.format(fn[:50]))
+                    skipped[pid] = (zipf, buildid, pid, parser)
                     continue
-                with zf.open(bedfile,'r') as bedf:
-                    trace(3, 'populate from bed {}'.format(bedfile))
-                    populate_from_BED_file(dbo, pid, bedf)
-                with zf.open(vcffile,'r') as vcff:
-                    trace(3, 'populate from vcf {}'.format(vcffile))
-                    populate_from_VCF_file(dbo, buildid, pid, vcff)
-            nkits += 1
-        except:
-            # something failed while loading this file - roll back changes
-            trace(0, 'FAIL on file {} (not fully loaded)'.format(zipf))
-            trace(0, 'roll-back this file load and continue')
-            dbo.rollback()
-
-        if nkits >= config['kitlimit']:
-            break
+                if hash == file_md5(zipf):
+                    trace(3, 'unchanged - skip {}'.format(fn[:50]))
+                    dc.execute('''update loadjournal set fileSize=?, fileMtime=?
+                                  where pID=?''', (st.st_size, st.st_mtime, pid))
+                    skipped[pid] = (zipf, buildid, pid, parser)
+                    continue
+            trace(2, 'reload {} ({})'.format(fn[:50], status))
+            if status in ('loaded','duplicate'):
+                loaded.add(pid)
+        elif (not config['drop_tables']) and \
+                 (pid in stored or kit_is_stored(dbo, pid)):
+            trace(2, 'reload {} (not in the load journal)'.format(fn[:50]))
+            loaded.add(pid)
+        # what was loaded before is only removed if the kit is loaded again
+        if selection and selection['pids'] is not None and \
+               pid not in selection['pids']:
+            trace(3, 'not selected - skip {}'.format(fn[:50]))
+            if pid not in loaded:
+                excluded.append((zipf, pid))
+            continue
+        if not parser:
+            trace(0, 'ERROR: no kit parser for {}, {}, {} for {}'.format(
+                lab, testtype, build, fn[:50]))
+            continue
+        if pid in loaded or pid in journal:
+            stale.add(pid)
+        tasks.append((zipf, buildid, pid, parser))
+    nkits = 0
 
-    # re-create indexes we dropped above
-    trace(3, 're-create indexes at {}'.format(time.clock()))
+    # a duplicate of a kit that's being reloaded has to be checked again
+    for pid in list(skipped):
+        if journal[pid][5] in stale:
+            trace(2, 'reload duplicate {}'.format(pid))
+            stale.add(pid)
+            tasks.append(skipped.pop(pid))
+
+    # one kit's data for each BED+VCF hash already loaded
+    byhash = dict(dc.execute('''select dataHash, min(pID) from loadjournal
+                               where status='loaded' and dataHash is not null
+                               group by dataHash''').fetchall())
+    byhash = dict([(h,p) for (h,p) in byhash.items() if p not in stale])
+
+    # what was loaded before for a reload is removed in the same transaction
+    # as the kit's new data, so a kit that isn't reached (kitlimit) keeps it
+    trace(1, '{} kits to load, {} of them reloads'.format(len(tasks),
+                                                           len(stale)))
+    # a store file that no kit is in is left over from an older database
+    store = get_call_store(dbo)
+    if store and not dc.execute('select 1 from callstore limit 1').fetchone():
+        store.rebuild()
+    for (zipf,pid) in excluded:
+        journal_kit(dbo, pid, zipf, None, 'excluded', (0,0), selection=selkey)
+    if excluded:
+        trace(1, '{} kits excluded by load_select'.format(len(excluded)))
     dbo.commit()
-    dc.execute('create index bedidx on bed(pID,bID)')
-    dc.execute('create index vcfidx on vcfcalls(vID)')
-    dc.execute('create index vcfpidx on vcfcalls(pID)')
+
+    resolver = IDResolver(dbo)
+
+    # older versions of this loader left these behind as duplicates of the
+    # schema's own indexes
+    for idx in ('bedidx', 'vcfidx', 'vcfpidx'):
+        dc.execute('drop index if exists {}'.format(idx))
+
+    # indexes on the loaded tables are dropped while loading and re-created
+    # at the end of the with block
+    with dbo.bulk_load(('bed', 'bedblob', 'vcfcalls', 'variants',
+                        'alleles', 'loadjournal')):
+        targets = selection and selection['targets']
+        kits = read_kit_zips(tasks, jobs, targets, fasta)
+        # kits (of any outcome) written since the last commit
+        pending = 0
+        for (zipf,buildid,pid,parser,kit) in kits:
+            if pending >= config['kits_per_commit']:
+                trace(3, 'committing work')
+                dbo.commit()
+                pending = 0
+            if not dbo.in_transaction:
+                dc.execute('begin')
+            pending += 1
+            if kit and not kit.selected:
+                trace(3, 'no load_select snps - skip {}'.format(zipf))
+                if pid not in loaded:
+                    journal_kit(dbo, pid, zipf, kit, 'excluded', (0,0),
+                                selection=selkey)
+                continue
+            if pid in stale:
+                clear_kit(dbo, pid)
+            if not kit:
+                journal_kit(dbo, pid, zipf, kit, 'failed')
+                continue
+            trace(1, '{}-{}'.format(nkits,os.path.basename(zipf)[:70]))
+            # the same data was already stored for another kit
+            if byhash.get(kit.datahash, pid) != pid:
+                trace(0, 'kit {} has the same data as kit {} - not stored '
+                      'again'.format(pid, byhash[kit.datahash]))
+                journal_kit(dbo, pid, zipf, kit, 'duplicate', (0,0),
+                            copyof=byhash[kit.datahash])
+                continue
+            # store this kit under a savepoint so we can roll back just this kit
+            dc.execute('savepoint kit')
+            try:
+                counts = store_kit(dbo, pid, buildid, kit, refpos, resolver,
+                                   ageranges)
+                journal_kit(dbo, pid, zipf, kit, 'loaded', counts)
+                dc.execute('release kit')
+                if kit.datahash:
+                    byhash[kit.datahash] = pid
+                resolver.release()
+                nkits += 1
+            except:
+                # something failed while loading this file - roll back changes
+                trace(0, 'FAIL on file {} (not fully loaded)'.format(zipf))
+                trace(0, 'roll-back this file load and continue')
+                dc.execute('rollback to kit')
+                dc.execute('release kit')
+                resolver.rollback()
+                journal_kit(dbo, pid, zipf, kit, 'failed')
+
+            if nkits >= config['kitlimit']:
+                break
+    # the new kits are added to the bitmap index after the indexes are back
+    bitmaps = get_kit_bitmaps(dbo)
+    if bitmaps:
+        trace(1, '{} kits added to the kit bitmaps'.format(bitmaps.update()))
+        dbo.commit()
+    ndups = len(get_duplicate_kits(dbo))
+    if ndups:
+        trace(0, '{} kits are duplicates of other kits; see loadjournal'.format(
+            ndups))
     dc.close()
     trace(3, 'done at {}'.format(time.clock()))
     return
 
+# Procedure: table_layout
+# Purpose: describe the layout of a table, to compare it with schema.sql's
+# Input:
+#   dbo, a database connection
+#   tbl, the table name
+# Returns:
+#   (columns, keys, without rowid), or None if there's no such table;
+#   columns are (name, type, not null, default, primary key) tuples, and
+#   keys are the columns of each UNIQUE or PRIMARY KEY constraint
+# Info:
+#   This is read back with pragmas rather than taken from the CREATE TABLE
+#   text, which has the comments in it and is rewritten by a rename.
+def table_layout(dbo, tbl):
+    row = dbo.execute('''select sql from sqlite_master
+                         where type='table' and name=? collate nocase''',
+                      (tbl,)).fetchone()
+    if not row:
+        return None
+    cols = tuple([(name.lower(), ctype.upper(), notnull, dflt, pk)
+                  for (cid, name, ctype, notnull, dflt, pk)
+                  in dbo.execute('pragma table_info("{}")'.format(tbl))])
+    keys = []
+    for (seq, name, unique, origin, partial) in dbo.execute(
+            'pragma index_list("{}")'.format(tbl)).fetchall():
+        if origin in ('u', 'pk'):
+            keys.append(tuple([col.lower() for (seqno, cid, col) in dbo.execute(
+                'pragma index_info("{}")'.format(name))]))
+    norowid = re.search(r'(?i)without\s+rowid', row[0]) is not None
+    return cols, tuple(sorted(keys)), norowid
+
+# Procedure: index_layout
+# Purpose: describe an index, to compare it with schema.sql's
+# Returns: (table, unique, columns), or None if there's no such index
+def index_layout(dbo, idx):
+    row = dbo.execute('''select tbl_name, sql from sqlite_master
+                         where type='index' and name=? collate nocase''',
+                      (idx,)).fetchone()
+    if not row:
+        return None
+    cols = tuple([col and col.lower() for (seqno, cid, col) in dbo.execute(
+                      'pragma index_info("{}")'.format(idx))])
+    unique = re.match(r'(?i)\s*create\s+unique', row[1] or '') is not None
+    return row[0].lower(), unique, cols
+
+# the layout of the tables that schema.sql creates, kept in meta
+SCHEMA_VERSION = 2
+
+# Procedure: get_schema_version
+# Purpose: find out which table layout a database has
+# Input:
+#   dbo, a database object
+# Returns:
+#   the schema_version in meta; 1 if it isn't there, and 0 if the database
+#   has no tables at all
+def get_schema_version(dbo):
+    if not table_layout(dbo, 'meta'):
+        tables = dbo.execute('''select count(*) from sqlite_master
+                                where type='table' ''').fetchone()[0]
+        return 1 if tables else 0
+    row = dbo.execute('''select val from meta
+                         where descr='schema_version' ''').fetchone()
+    return int(row[0]) if row else 1
+
+# Procedure: check_schema_version
+# Purpose: stop the program if the database isn't the layout of schema.sql
+# Input:
+#   dbo, a database object
+# Info:
+#   Loading kits and the maintenance commands use tables that older
+#   databases don't have. This is checked before they start, so the user is
+#   told to run redux.py --migrate (or --create for a new database) instead
+#   of the work failing part way through.
+def check_schema_version(dbo):
+    version = get_schema_version(dbo)
+    if version == SCHEMA_VERSION:
+        return
+    if version == 0:
+        trace(0, 'ERROR: the database {} has no tables; run redux.py '
+              '--create first'.format(dbo.dbfname))
+    elif version < SCHEMA_VERSION:
+        trace(0, 'ERROR: the database {} is schema version {} and version {} '
+              'is needed; run redux.py --migrate first'.format(
+                  dbo.dbfname, version, SCHEMA_VERSION))
+    else:
+        trace(0, 'ERROR: the database {} is schema version {}, which is newer '
+              'than this program ({})'.format(dbo.dbfname, version,
+                                              SCHEMA_VERSION))
+    sys.exit(1)
+
+# Procedure: migrate_schema
+# Purpose: change an existing database to the table layout of schema.sql
+# Input:
+#   dbo, a database object
+#   chunksize (optional), how many rows to copy in each transaction
+# Returns: the schema version the database had before
+# Info:
+#   A database without a schema_version in meta is version 1 (see
+#   get_schema_version). The definitions come from schema.sql, which is run
+#   in an in-memory database to read them back. Every table of schema.sql
+#   is compared with the database's by table_layout: missing tables are
+#   created, and a table
+#   that is laid out differently is copied into a new table and takes its
+#   place, e.g. version 2 makes vcfcalls and bed WITHOUT ROWID tables, adds
+#   columns to vcfstats, and makes pID the primary key of bedstats.
+#
+#   The columns the old and new tables have in common are copied, in rowid
+#   order, a chunk of rowids at a time, committing after each chunk, so the
+#   work doesn't have to fit in memory or in one transaction. Rows are
+#   copied with "insert or replace", so where a new key has duplicates, the
+#   last row stays. A version 1 bed gets its range ends from bedranges.
+#   Then the old table is dropped, the new one is renamed to take its
+#   place, and the table's indexes are made. Indexes of schema.sql that are
+#   missing or different are made too. If the migration is interrupted, it
+#   can be run again; the table it was on is started over.
+def migrate_schema(dbo, chunksize=1<<20):
+    dc = dbo.cursor()
+    version = get_schema_version(dbo)
+    mem = sqlite3.connect(':memory:')
+    mem.executescript(open(os.path.join(config['REDUX_SQL'],
+                                        'schema.sql')).read())
+    tables = [(name, sql, table_layout(mem, name)) for (name, sql) in
+              mem.execute('''select name, sql from sqlite_master
+                             where type='table' and name not like 'sqlite_%' ''')]
+    indexes = [(name, tname, sql, index_layout(mem, name))
+               for (name, tname, sql) in mem.execute(
+                   '''select name, tbl_name, sql from sqlite_master
+                      where type='index' and sql is not null''')]
+    mem.close()
+    nchanged = 0
+    bedranges = False
+    for (tbl, sql, layout) in tables:
+        # a copy left by an interrupted migration is started over
+        new = '{}_v{}'.format(tbl, SCHEMA_VERSION)
+        dc.execute('drop table if exists {}'.format(new))
+        old = table_layout(dbo, tbl)
+        if old == layout:
+            continue
+        nchanged += 1
+        if old is None:
+            trace(1, 'create table {}'.format(tbl))
+            dc.execute(sql)
+            continue
+        trace(1, 'migrate {} to schema version {}'.format(tbl, SCHEMA_VERSION))
+        dc.execute(re.sub(r'(?i)^(create table )'+tbl+r'\b', r'\g<1>'+new, sql))
+        dbo.commit()
+        oldcols = [c[0] for c in old[0]]
+        if tbl.lower() == 'bed' and 'bid' in oldcols:
+            # version 1: the kit's ranges are in bedranges
+            copy = '''insert or replace into {}(pID,minaddr,maxaddr)
+                      select bed.pID, r.minaddr, r.maxaddr from bed
+                      inner join bedranges r on r.ID=bed.bID'''
+            bedranges = True
+        else:
+            cols = ','.join([c[0] for c in layout[0] if c[0] in oldcols])
+            copy = '''insert or replace into {{}}({0})
+                      select {0} from {1}'''.format(cols, tbl)
+        if old[2]:
+            # no rowids to go by; it's copied in one go
+            dc.execute(copy.format(new))
+            dbo.commit()
+        else:
+            copy += ' where {0}.rowid between ? and ? order by {0}.rowid'.format(tbl)
+            lo, hi = dc.execute('select min(rowid), max(rowid) from {}'.format(
+                tbl)).fetchone()
+            for start in range(lo or 0, (hi or -1) + 1, chunksize):
+                dc.execute(copy.format(new), (start, start + chunksize - 1))
+                dbo.commit()
+                trace(2, '{}: copied rowids up to {} of {}'.format(
+                    tbl, min(start + chunksize - 1, hi), hi))
+        # the old table's indexes go with it, and the new ones get their names
+        dc.execute('begin')
+        dc.execute('drop table {}'.format(tbl))
+        dc.execute('alter table {} rename to {}'.format(new, tbl))
+        for (name, tname, isql, ilayout) in indexes:
+            if tname.lower() == tbl.lower():
+                dc.execute(isql)
+        dc.execute('analyze {}'.format(tbl))
+        dbo.commit()
+    for (name, tname, sql, layout) in indexes:
+        if index_layout(dbo, name) != layout:
+            trace(1, 'create index {}'.format(name))
+            dc.execute('drop index if exists {}'.format(name))
+            dc.execute(sql)
+            nchanged += 1
+    # kit ranges are no longer in bedranges, only those of age.bed
+    if bedranges:
+        dc.execute('''delete from bedranges
+                      where ID not in (select bID from agebed)''')
+    dc.execute("delete from meta where descr='schema_version'")
+    dc.execute("insert into meta(descr,val) values('schema_version',?)",
+               (str(SCHEMA_VERSION),))
+    dbo.commit()
+    if nchanged:
+        trace(1, 'database migrated from schema version {} to {}'.format(
+            version, SCHEMA_VERSION))
+    else:
+        trace(1, 'database is already schema version {}'.format(version))
+    return version
+
 # Procedure: db_creation
 # Purpose: a high-level routine that can be called for initial database
 #   creation and table loads
 def db_creation():
-    db = DB(drop=config['drop_tables'])
+    db = db_manager().writer(drop=config['drop_tables'])
     if config['drop_tables']:
         db.create_schema()
         populate_fileinfo(db, fromweb=config['use_web_api'])
@@ -1049,6 +2810,10 @@ def db_creation():
         populate_refpos(db)
         populate_analysis_kits(db)
         populate_excludes(db)
+    else:
+        check_schema_version(db)
+        # pick up any changes to the SNP definitions
+        populate_SNPs(db)
     return db
 
 
@@ -1066,5 +2831,5 @@ if __name__=='__main__':
     t(100, 'this message should not be seen')
     t = savet
     t(0, 'another message that should be seen')
-    db = DB(drop=False)
+    db = db_manager().writer()
     populate_refpos(db)
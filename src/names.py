@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Copyright (c) 2018 the Authors
+#
+# Purpose: look up kits, builds and variants by name in the database
+#
+# Usage:
+#   import as a library
+#
+# Info:
+#   These lookups are used by the loader and by the utilities in bin. This
+#   module doesn't depend on config.yaml, numpy or the rest of the loader,
+#   so bin/info.py can use it with only a database connection.
+#
+#   The lists of names and IDs are passed to the queries as JSON, so the
+#   sqlite library must have the JSON1 functions (json_each, json_extract).
+#   They are built in since sqlite 3.38, and most builds of earlier versions
+#   have them as well.
+#
+
+import collections, json
+
+
+# Procedure: json_list
+# Purpose: pass a list of IDs (or of rows) to a query as one parameter
+# Input:
+#   values, a list of values such as IDs, or of tuples of values
+# Returns: a JSON array to bind to json_each(?) in the query
+# Info:
+#   This takes the place of a scratch table. The query joins with
+#   json_each(?), whose value column has each of the values, so nothing is
+#   written to the database, not even to the temp schema, and the query
+#   works on a read-only connection. For rows, the columns are
+#   json_extract(value,'$[0]') and so on. Numpy integers are converted.
+# Examples:
+#   dbo.execute('''select v.pos from variants v
+#                  inner join json_each(?) t on t.value=v.id''', (json_list(vids),))
+def json_list(values):
+    return json.dumps(list(values), default=int)
+
+# Procedure: get_build_byname
+# Purpose: get build identifier by its name; creates new entry if needed
+# Input:
+#   db, a database object
+#   buildname, optional name of build, e.g. 'hg38'
+# Info:
+#   known aliases are reduced to one entry
+def get_build_byname(db, buildname='hg38'):
+    if buildname.lower().strip() in ('hg19', 'grch37', 'b19', 'b37'):
+        buildname = 'hg19'
+    elif buildname.lower().strip() in ('hg38', 'grch38', 'b38'):
+        buildname = 'hg38'
+    dc = db.cursor()
+    dc.execute('select id from build where buildNm=?', (buildname,))
+    bid = None
+    for bid, in dc:
+        continue
+    if not bid:
+        dc.execute('insert into build(buildNm) values (?)', (buildname,))
+        bid = dc.lastrowid
+    return bid
+
+# Procedure: resolve_names
+# Purpose: look up a list of kit IDs or variant names all at once
+# Input:
+#   dbo, a database object
+#   kind, one of 'kit', 'snp' or 'variant'
+#   names, a list of names to look up
+#   build (optional), build name to look in; any build if not given
+#   insert_notfound (optional), add pos.ref.alt variants that don't exist
+# Returns:
+#   a dictionary of name -> list of IDs for the names that were found
+#   a list of the names that were not found, in the order given
+# Info:
+#   The names of one kind are resolved with a single join against the list
+#   of names, passed in as JSON (json_list), rather than with a query per
+#   name. Nothing is written unless insert_notfound is set.
+#   kit: names are matched to dataset.kitId with "like", as in kits.txt;
+#     IDs are DNAIDs
+#   snp: names are matched to snpnames as given or in upper case
+#   variant: names are pos.ref.alt or SNP names, as in excludes.csv
+#   insert_notfound requires a build, and only adds variants whose ref and alt
+#   are already in the alleles table.
+def resolve_names(dbo, kind, names, build=None, insert_notfound=False):
+    names = list(names)
+    bid = build and get_build_byname(dbo, build)
+    dc = dbo.cursor()
+    # the names to look up, as a table in each query
+    tmpnames = '''with tmpnames(name, lookup, pos, ref, alt) as (
+                    select json_extract(value,'$[0]'), json_extract(value,'$[1]'),
+                           json_extract(value,'$[2]'), json_extract(value,'$[3]'),
+                           json_extract(value,'$[4]') from json_each(?))'''
+    rows = []
+    if kind == 'kit':
+        lookups = json_list([(n,n,None,None,None) for n in set(names)])
+        rows += dc.execute(tmpnames + '''
+                              select t.name, d.DNAID from tmpnames t
+                              inner join dataset d on d.kitID like t.lookup
+                           ''', (lookups,)).fetchall()
+    else:
+        snps = set()
+        posrefalt = set()
+        for n in names:
+            parts = n.split('.')
+            if kind == 'variant' and len(parts) == 3 and parts[0].isdigit():
+                posrefalt.add((n, None, int(parts[0]), parts[1], parts[2]))
+            else:
+                snps.add((n,n,None,None,None))
+                snps.add((n,n.upper(),None,None,None))
+        lookups = json_list(snps | posrefalt)
+        if insert_notfound and bid:
+            dc.execute(tmpnames + '''
+                          insert or ignore into variants(buildID,pos,anc,der)
+                          select ?, t.pos, a.id, b.id from tmpnames t
+                          inner join alleles a on a.allele=t.ref
+                          inner join alleles b on b.allele=t.alt''',
+                       (lookups, bid))
+        rows += dc.execute(tmpnames + '''
+                              select t.name, v.id from tmpnames t
+                              inner join snpnames s on s.snpname=t.lookup
+                              inner join variants v on v.id=s.vID
+                              where v.buildID=? or ? is null
+                                  union
+                              select t.name, v.id from tmpnames t
+                              inner join alleles a on a.allele=t.ref
+                              inner join alleles b on b.allele=t.alt
+                              inner join variants v on v.pos=t.pos and
+                                  v.anc=a.id and v.der=b.id
+                              where v.buildID=? or ? is null''',
+                           (lookups, bid, bid, bid, bid)).fetchall()
+    found = collections.defaultdict(list)
+    for name, iid in rows:
+        if iid not in found[name]:
+            found[name].append(iid)
+    unresolved = [n for n in names if n not in found]
+    return dict(found), unresolved
+
+# Procedure: get_duplicate_kits
+# Purpose: list the kits whose data is the same as another kit's
+# Input:
+#   dbo, a database object
+# Returns:
+#   a list of (kitId, pID, copy of kitId, copy of pID) tuples
+# Info:
+#   A duplicate's data is only stored once, under the pID it is a copy of,
+#   so the duplicate has no calls or ranges of its own.
+def get_duplicate_kits(dbo):
+    return dbo.execute('''select d.kitId, j.pID, c.kitId, j.copyOf
+                          from loadjournal j
+                          inner join dataset d on d.DNAID=j.pID
+                          inner join dataset c on c.DNAID=j.copyOf
+                          where j.status='duplicate'
+                          order by j.copyOf, j.pID''').fetchall()
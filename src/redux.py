@@ -17,7 +17,7 @@ import yaml
 import os
 import time
 from lib import *
-from db import DB
+from db import db_manager
 from array_api import *
 from sort import *
 
@@ -63,6 +63,7 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-a', '--all', help='perform all possible steps (prob best not to use for now)', action='store_true')
 parser.add_argument('-c', '--create', help='clean start with a new database', action='store_true')
 parser.add_argument('-l', '--loadkits', help='load all of the kits', action='store_true')
+parser.add_argument('-j', '--jobs', help='number of processes for parsing kits with --loadkits (0 = all cores)', type=int, default=1)
 parser.add_argument('-k', '--kits', help='update list of the kits from kits.txt', action='store_true')
 parser.add_argument('-t', '--testdrive', help='runs some unit tests', action='store_true')
 
@@ -103,6 +104,9 @@ parser.add_argument('rest', nargs=argparse.REMAINDER)
 
 # maintenance
 parser.add_argument('-b', '--backup', help='do a "backup"', action='store_true')
+parser.add_argument('-cs', '--callstore', help='rebuild the call store from vcfcalls', action='store_true')
+parser.add_argument('-kb', '--bitmaps', help='rebuild the kit bitmaps of the variants', action='store_true')
+parser.add_argument('-mg', '--migrate', help='change an existing database to the current table layout', action='store_true')
 
 # output
 
@@ -111,6 +115,11 @@ args = parser.parse_args()
 
 # main program
 
+# rebuild the tables of an older database in the current layout
+if args.migrate:
+    db = db_manager().writer()
+    migrate_schema(db)
+
 # drop database and have a clean start
 if args.create:
     db = db_creation()
@@ -118,13 +127,35 @@ if args.create:
 
 # load kits that were found in H-R web API and in zipdirs
 if args.loadkits:
-    db = DB(drop=False, fastload=True)
-    populate_from_dataset(db)
+    db = db_manager().writer(fastload=True)
+    check_schema_version(db)
+    populate_from_dataset(db, jobs=args.jobs or os.cpu_count())
     db.commit()
 
+# write the call store again from what's in vcfcalls
+if args.callstore:
+    db = db_manager().writer()
+    check_schema_version(db)
+    store = get_call_store(db)
+    if store:
+        trace(1, 'call store has {} kits'.format(store.rebuild()))
+    else:
+        trace(0, 'call_store is not set in config.yaml')
+
+# make the derived and covered kit bitmaps again for all of the loaded kits
+if args.bitmaps:
+    db = db_manager().writer()
+    check_schema_version(db)
+    bitmaps = get_kit_bitmaps(db)
+    if bitmaps:
+        trace(1, 'kit bitmaps have {} kits'.format(bitmaps.rebuild()))
+    else:
+        trace(0, 'kit_bitmaps is not set in config.yaml')
+
 # load kits that were found in H-R web API and in zipdirs
 if args.kits:
-    db = DB(drop=False)
+    db = db_manager().writer()
+    check_schema_version(db)
     populate_fileinfo(db, fromweb=config['use_web_api'])
     populate_analysis_kits(db)
     populate_excludes(db)
@@ -15,7 +15,7 @@ from beautifultable import BeautifulTable
 from collections import OrderedDict
 import pandas as pd
 from array_api import *
-from db import DB
+from db import db_manager
 from lib import Trace, md5, data_path
 import shelve
 from profile import profile
@@ -297,7 +297,7 @@ class VKcalls(object):
 # Purpose: container and methods for sorting variants and kits
 class Sort(object):
     def __init__(self):
-        self.dbo = DB(drop=False)
+        self.dbo = db_manager().writer()
         self.KITS = None
         self.VARIANTS = None
         self.identcallDATA = {}
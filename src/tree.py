@@ -894,8 +894,8 @@ node [fontname="Helvetica" fillcolor=white shape=none margin="0,0"];
 
 # test framework
 if __name__=='__main__':
-    from db import DB
-    dbo = DB(drop=False)
+    from db import db_manager
+    dbo = db_manager().writer()
 
     if False:
         trace(0, 'leaf nodes: {}'.format(tree_get_leaf_nodes(dbo, 1)))
@@ -0,0 +1,75 @@
+import io, os, unittest, zipfile
+import context
+from archive import *
+
+class TestKitArchive(unittest.TestCase):
+
+    bed = b'chrY\t100\t2000\nchrY\t3000\t4000\n'
+    vcf = context.vcf_text([(150, 'A', 'G', 'PASS', '1', '0,30')]).encode()
+
+    def setUp(self):
+        self.tmp = context.tempdir(self)
+
+    def bigy_zip(self, compression=zipfile.ZIP_DEFLATED):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', compression) as zf:
+            zf.writestr('Treece-N4826/', b'')
+            zf.writestr('Treece-N4826/regions.bed', self.bed)
+            zf.writestr('Treece-N4826/variants.vcf', self.vcf)
+        return buf.getvalue()
+
+    def write_zip(self, name, files):
+        fname = os.path.join(self.tmp, name)
+        with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for member, data in files:
+                zf.writestr(member, data)
+        return fname
+
+    def read(self, fname):
+        with KitArchive(fname) as ka:
+            with ka.open_bed() as f:
+                bed = f.read()
+            with ka.open_vcf() as f:
+                vcf = f.read()
+            return (ka.bed[1].filename, ka.vcf[1].filename, bed, vcf,
+                    ka.data_md5(), ka.nested())
+
+    def test_nested(self):
+        top = self.write_zip('top.zip', [('regions.bed', self.bed),
+                                         ('variants.vcf', self.vcf)])
+        nested = self.write_zip('nested.zip',
+                                [('README.txt', b'Big Y results'),
+                                 ('notazip.zip', b'not a zip file'),
+                                 ('bigy-Treece-N4826.zip',
+                                  self.bigy_zip(zipfile.ZIP_STORED))])
+        top = self.read(top)
+        nested = self.read(nested)
+        self.assertEqual(top[:2], ('regions.bed', 'variants.vcf'))
+        self.assertEqual(nested[:2], ('Treece-N4826/regions.bed',
+                                      'Treece-N4826/variants.vcf'))
+        self.assertEqual(nested[2:5], top[2:5])
+        self.assertEqual(nested[2:4], (self.bed, self.vcf))
+        self.assertEqual((top[5], nested[5]), (False, True))
+
+    def test_walk_zip(self):
+        inner = self.write_zip('inner.zip', [('variants.vcf', self.vcf)])
+        fname = self.write_zip('outer.zip',
+                               [('a.zip', open(inner, 'rb').read()),
+                                ('b.zip', self.bigy_zip()),
+                                ('regions.bed', self.bed)])
+        with zipfile.ZipFile(fname) as zf:
+            names = [info.filename for (z, info) in walk_zip(zf)]
+            self.assertEqual(names, ['regions.bed', 'variants.vcf',
+                                     'Treece-N4826/regions.bed',
+                                     'Treece-N4826/variants.vcf'])
+            self.assertEqual([info.filename for (z, info)
+                              in walk_zip(zf, maxdepth=0)], ['regions.bed'])
+        # the first BED and VCF are used, shallower files first
+        with KitArchive(fname) as ka:
+            self.assertIs(ka.bed[0], ka.zf)
+            self.assertEqual(ka.vcf[1].filename, 'variants.vcf')
+            self.assertTrue(ka.nested())
+
+
+if __name__ == '__main__':
+    unittest.main()
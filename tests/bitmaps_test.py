@@ -0,0 +1,133 @@
+import os, sqlite3, unittest
+import context
+import numpy as np
+from bitmaps import *
+
+class TestKitSet(unittest.TestCase):
+
+    def sets(self, seed):
+        rng = np.random.RandomState(seed)
+        return [set(rng.randint(0, n, rng.randint(0, 60)).tolist())
+                for n in (70, 300, 1000)]
+
+    def test_operators(self):
+        for seed in range(20):
+            for a in self.sets(seed):
+                for b in self.sets(seed + 100):
+                    ka, kb = KitSet.from_pids(sorted(a)), KitSet.from_pids(list(b))
+                    self.assertEqual(list(ka & kb), sorted(a & b))
+                    self.assertEqual(list(ka | kb), sorted(a | b))
+                    self.assertEqual(list(ka ^ kb), sorted(a ^ b))
+                    self.assertEqual(list(ka - kb), sorted(a - b))
+                    self.assertEqual(ka <= kb, a <= b)
+                    self.assertEqual(ka >= kb, a >= b)
+                    self.assertEqual(ka == kb, a == b)
+                    self.assertEqual(ka != kb, a != b)
+                    self.assertEqual(ka.issubset(kb), a.issubset(b))
+                    self.assertEqual(ka.issuperset(kb), a.issuperset(b))
+                    self.assertEqual(ka.isdisjoint(kb), a.isdisjoint(b))
+                    self.assertEqual(len(ka), len(a))
+                    self.assertEqual(bool(ka), bool(a))
+                    for pid in (0, 63, 64, 299, 5000):
+                        self.assertEqual(pid in ka, pid in a)
+
+    def test_lengths(self):
+        # the same set, with and without trailing zero words
+        a = KitSet.from_pids([1, 64], nwords=10)
+        b = KitSet.from_pids([1, 64])
+        self.assertEqual(len(a.words), 10)
+        self.assertTrue(a == b and a <= b and b <= a)
+        self.assertEqual(len(a - KitSet()), 2)
+        self.assertEqual(len(KitSet() - a), 0)
+        self.assertEqual(list(KitSet()), [])
+
+    def test_bytes(self):
+        for pids in ([], [0], [5, 64, 65, 10000], list(range(0, 4096, 3))):
+            kits = KitSet.from_pids(pids, nwords=200)
+            data = kits.to_bytes()
+            self.assertEqual(list(KitSet.from_bytes(data)), pids)
+            self.assertEqual(KitSet.from_bytes(data), kits)
+        self.assertEqual(list(KitSet.from_bytes(None)), [])
+
+
+class TestCoveredMask(unittest.TestCase):
+
+    def test_covered_mask(self):
+        ranges = np.array([(0, 20), (30, 40), (41, 42), (45, 50)])
+        pos = np.array([1, 20, 21, 30, 31, 40, 42, 47, 48, 52])
+        span = np.array([20, 1, 1, 1, 10, 1, 1, 4, 4, 1])
+        self.assertEqual(covered_mask(ranges, pos, span).tolist(),
+                         [True, True, False, False, True, True, True, True,
+                          False, False])
+        self.assertEqual(covered_mask(np.zeros((0, 2)), pos, span).tolist(),
+                         [False] * len(pos))
+        # against the positions each range covers, one by one
+        rng = np.random.RandomState(3)
+        lo = np.sort(rng.choice(1000, 40, replace=False)) * 10
+        ranges = np.stack([lo, lo + rng.randint(1, 10, 40)], axis=1)
+        covered = set([p for (a, b) in ranges.tolist() for p in range(a+1, b+1)])
+        pos = rng.randint(0, 10000, 2000)
+        span = rng.randint(1, 4, 2000)
+        expect = [all([p in covered for p in range(a, a+s)])
+                  for (a, s) in zip(pos.tolist(), span.tolist())]
+        self.assertEqual(covered_mask(ranges, pos, span).tolist(), expect)
+
+
+class TestKitBitmaps(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.addCleanup(self.db.close)
+        self.db.executescript(open(os.path.join('..', 'sql',
+                                                'schema.sql')).read())
+        self.db.executemany('insert into alleles(ID,allele) values(?,?)',
+                            [(1, 'A'), (2, 'G'), (3, 'AT')])
+        self.db.executemany('''insert into variants(ID,buildID,pos,anc,der)
+                               values(?,1,?,?,?)''',
+                            [(1, 10, 1, 2), (2, 20, 1, 2), (3, 30, 3, 1),
+                             (4, 40, 2, 1)])
+        self.ranges = {1: np.array([(0, 25)]), 2: np.array([(15, 35)]),
+                       70: np.array([(25, 45)])}
+        self.bitmaps = KitBitmaps(self.db, lambda dbo, pid: self.ranges[pid],
+                                  lambda callinfo: callinfo > 0)
+
+    def load(self, pid, calls):
+        self.db.execute('insert into vcfstats(pID) values(?)', (pid,))
+        self.db.executemany('insert into vcfcalls(pID,vID,callinfo) values(?,?,?)',
+                            [(pid, v, c) for (v, c) in calls])
+
+    def check(self, expect):
+        for vid, (derived, covered) in expect.items():
+            d, c = self.bitmaps.get(vid)
+            self.assertEqual((list(d), list(c)), (derived, covered))
+
+    def test_update(self):
+        self.load(1, [(1, 1), (2, 0)])
+        self.load(2, [(2, 1), (3, 1)])
+        self.assertEqual(self.bitmaps.update(chunksize=2), 2)
+        self.check({1: ([1], [1]), 2: ([2], [1, 2]), 3: ([2], [2]),
+                    4: ([], [])})
+        self.assertEqual(self.bitmaps.update(), 0)
+        # a new kit, and a new variant that kits in the index have
+        self.db.execute('''insert into variants(ID,buildID,pos,anc,der)
+                           values(5,1,18,1,2)''')
+        self.db.execute('insert into vcfcalls values(1,5,1)')
+        self.load(70, [(4, 1)])
+        self.assertEqual(self.bitmaps.update(chunksize=3), 1)
+        self.check({1: ([1], [1]), 3: ([2], [2, 70]), 4: ([70], [70]),
+                    5: ([1], [1, 2])})
+        self.assertEqual(list(self.bitmaps.kits()), [1, 2, 70])
+        # a kit that is taken out is left out of the bitmaps
+        self.db.execute('delete from vcfstats where pID=2')
+        self.assertEqual(list(self.bitmaps.get(3)[0]), [2])
+        self.db.execute('delete from kitbitmapkits where pID=2')
+        self.check({2: ([], [1]), 3: ([], [70])})
+        self.assertEqual(self.bitmaps.update(), 0)
+        self.check({2: ([], [1]), 3: ([], [70])})
+        self.assertEqual(self.bitmaps.rebuild(), 2)
+        self.check({1: ([1], [1]), 2: ([], [1]), 3: ([], [70]),
+                    5: ([1], [1])})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#
+# Copyright (c) 2018 the Authors
+#
+# Purpose: set up the tests to import the modules in src
+#
+# Usage:
+#   import context first in each test module, then the modules under test
+#   run the tests with: python3 -m unittest discover -s tests -p '*_test.py'
+#
+# Info:
+#   The paths in config.yaml are relative to src, and db.py reads
+#   config.yaml from the current directory, so the tests run from src, as
+#   redux.py does. A test that writes files makes its own temporary
+#   directory for them (see tempdir).
+#
+import os, sys, tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+SRC_DIR = os.path.normpath(SRC_DIR)
+sys.path.insert(0, SRC_DIR)
+os.environ.setdefault('REDUX_PATH', SRC_DIR)
+os.chdir(SRC_DIR)
+
+# Procedure: tempdir
+# Purpose: a temporary directory that is removed when the test is done
+# Input:
+#   testcase, the unittest.TestCase that uses the directory
+# Returns: the directory's path
+def tempdir(testcase):
+    tmp = tempfile.TemporaryDirectory()
+    testcase.addCleanup(tmp.cleanup)
+    return tmp.name
+
+# header of the VCF files written by vcf_text
+VCF_HEADER = '''##fileformat=VCFv4.2
+##contig=<ID=chrY,length=57227415>
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE
+'''
+
+# Procedure: vcf_text
+# Purpose: make the text of a small chrY VCF file for a test
+# Input:
+#   calls, a list of (pos, ref, alt, filter, gt, ad) tuples, where ad is the
+#     AD field, e.g. '2,30'; DP is the sum of the AD values
+#   header (optional), the header lines
+# Returns: the VCF file as a string
+def vcf_text(calls, header=VCF_HEADER):
+    lines = [header]
+    for pos, ref, alt, filt, gt, ad in calls:
+        dp = sum([int(x) for x in ad.split(',')])
+        lines.append('chrY\t{}\t.\t{}\t{}\t100\t{}\tBQ=30.5;MQ=60\t'
+                     'GT:AD:DP\t{}:{}:{}\n'.format(pos, ref, alt, filt, gt,
+                                                   ad, dp))
+    return ''.join(lines)
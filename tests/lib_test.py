@@ -0,0 +1,673 @@
+import gzip, io, json, os, struct, unittest, zipfile
+from unittest import mock
+import context
+import numpy as np
+import lib
+from lib import *
+from db import DB
+
+class TestCallinfo(unittest.TestCase):
+
+    calls = [(2834775, 'T', 'A', 'PASS', 33.5, 60, 27, 0.963, '1/1'),
+             (2852267, 'AG', 'G', 'FAIL', 0, 0, 1, 1.0, '0/1'),
+             (2900000, 'C', 'G', 'PASS', 99, 99, 1000, 0.1, '0/0')]
+
+    def test_pack_call(self):
+        for call in self.calls:
+            passfail, gt, q1, q2, nreads, passrate = \
+                unpack_call(pack_call(call))
+            self.assertEqual(passfail, call[3] == 'PASS')
+            self.assertEqual(gt, CALLINFO_GT[call[8]])
+            self.assertAlmostEqual(q1, min(call[4], 127/3.), delta=1/3.)
+            self.assertAlmostEqual(q2, min(call[5], 127/2.), delta=1/2.)
+            self.assertEqual(nreads, min(call[6], 511))
+            self.assertAlmostEqual(passrate, call[7], delta=1/255.)
+
+    def test_pack_calls(self):
+        packed = [pack_call(call) for call in self.calls]
+        unpacked = unpack_calls(packed)
+        self.assertEqual(unpacked.dtype, CALLINFO_DTYPE)
+        for bitfield, rec in zip(packed, unpacked):
+            self.assertEqual(tuple(rec.tolist()), unpack_call(bitfield))
+        self.assertEqual(pack_calls(unpacked).tolist(), packed)
+
+    def test_layout(self):
+        # unpack_call follows the scales of the layout, not fixed divisors
+        layout = lib.CALLINFO_LAYOUT
+        self.addCleanup(setattr, lib, 'CALLINFO_LAYOUT', layout)
+        lib.CALLINFO_LAYOUT = tuple([(f, s, n, 2. if f == 'q1' else c)
+                                     for (f, s, n, c) in layout])
+        self.assertAlmostEqual(unpack_call(pack_call(self.calls[0]))[2], 33.5)
+        self.assertAlmostEqual(unpack_calls([pack_call(self.calls[0])])['q1'][0],
+                               33.5)
+
+class TestSNPdefs(unittest.TestCase):
+
+    def write_defs(self, fname, defs):
+        with open(fname, 'w') as f:
+            f.write('Name,start,allele_anc,allele_der\n')
+            for d in defs:
+                f.write(','.join(d) + '\n')
+        return fname
+
+    def test_diff_SNPdefs(self):
+        tmp = context.tempdir(self)
+        old = self.write_defs(os.path.join(tmp, 'old.csv'),
+                              [('U106', '8502236', 'G', 'A'),
+                               ('P312', '20901962', 'C', 'A'),
+                               ('Z381', '9999', 'A', 'G'),
+                               ('U106', '8502236', 'G', 'A')])
+        new = self.write_defs(os.path.join(tmp, 'new.csv'),
+                              [('P312', '20901962', 'C', 'A'),
+                               ('Z381x', '9999', 'A', 'G'),
+                               ('Z8', '12345', 'T', 'C'),
+                               ('ÉT1', '12345', 'T', 'C')])
+        self.assertEqual(sort_SNPdefs(old, old + '.sorted'), 3)
+        self.assertEqual(sort_SNPdefs(new, new + '.sorted'), 4)
+        diff = sorted([(op, d['Name'], d['start'], d['allele_anc'],
+                        d['allele_der'])
+                       for op, d in diff_SNPdefs(old + '.sorted',
+                                                 new + '.sorted')])
+        self.assertEqual(diff, [('+', 'Z381x', '9999', 'A', 'G'),
+                                ('+', 'Z8', '12345', 'T', 'C'),
+                                ('+', 'ÉT1', '12345', 'T', 'C'),
+                                ('-', 'U106', '8502236', 'G', 'A'),
+                                ('-', 'Z381', '9999', 'A', 'G')])
+        # no changes
+        self.assertEqual(list(diff_SNPdefs(new + '.sorted', new + '.sorted')),
+                         [])
+
+class TestJSONRecords(unittest.TestCase):
+
+    records = [{'kitId': 'N4826', 'surname': 'Treece', 'lat': 51.5},
+               {'kitId': 'B{}'.format('x'*100), 'otherInfo': 'a, b ] c'},
+               {'nested': [1, [2, 3], {'a': None}]},
+               12345678, 'text', []]
+
+    def test_iter_json_records(self):
+        text = ' \n' + json.dumps(self.records, indent=1)
+        for chunksize in (1, 2, 7, 1<<16):
+            recs = list(iter_json_records(io.StringIO(text),
+                                          chunksize=chunksize))
+            self.assertEqual(recs, self.records)
+        self.assertEqual(list(iter_json_records(io.StringIO('[]'))), [])
+
+    def test_object_hook(self):
+        recs = iter_json_records(io.StringIO(json.dumps(self.records[:2])),
+                                 object_hook=lambda d: d.get('kitId'),
+                                 chunksize=3)
+        self.assertEqual(list(recs), ['N4826', 'B'+'x'*100])
+
+    def test_bad_json(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_records(io.StringIO('{"a": 1}')))
+        text = json.dumps(self.records)[:-20]
+        with self.assertRaises(ValueError):
+            list(iter_json_records(io.StringIO(text), chunksize=5))
+
+class TestRanges(unittest.TestCase):
+
+    def covered(self, ranges):
+        return set([p for (lo, hi) in ranges for p in range(lo, hi)])
+
+    def test_merge_ranges(self):
+        self.assertEqual(merge_ranges([]).shape, (0, 2))
+        self.assertEqual(merge_ranges([(5,9), (1,5), (2,3), (8,12)]).tolist(),
+                         [[1,5], [5,12]])
+        rng = np.random.RandomState(1)
+        for ii in range(50):
+            lo = rng.randint(0, 1000, 40)
+            ranges = np.stack([lo, lo + rng.randint(1, 50, 40)], axis=1)
+            merged = merge_ranges(ranges)
+            self.assertEqual(merged.dtype, np.int32)
+            self.assertTrue(np.all(merged[1:,0] >= merged[:-1,1]))
+            self.assertEqual(self.covered(merged.tolist()),
+                             self.covered(ranges.tolist()))
+
+    def test_range_overlap(self):
+        self.assertEqual(range_overlap([], [(1,5)]), 0)
+        self.assertEqual(range_overlap([(0,10), (20,30)], [(5,25)]), 10)
+        rng = np.random.RandomState(2)
+        for ii in range(50):
+            r1, r2 = [merge_ranges(np.stack([lo, lo + rng.randint(1, 30, 20)],
+                                            axis=1))
+                      for lo in rng.randint(0, 500, (2, 20))]
+            self.assertEqual(range_overlap(r1, r2),
+                             len(self.covered(r1) & self.covered(r2)))
+
+class TestCallFilter(unittest.TestCase):
+
+    calls = [(1000, 'A', 'G', 'PASS', '1/1', '0,30'),
+             (1001, 'C', '.', 'PASS', '0/0', '25'),
+             (1002, 'T', 'C', 'FAIL', '1/1', '1,9'),
+             (1003, 'TA', 'T', 'PASS', '0/1', '12,8'),
+             (1004, 'G', '.', 'PASS', '0/0', '12')]
+
+    def kit(self):
+        kit = KitData()
+        kit.read_VCF(io.StringIO(context.vcf_text(self.calls)))
+        return kit
+
+    def test_default_policy(self):
+        # the config.yaml policy drops clear reference calls
+        policy = [{'action': 'drop', 'passfail': 'PASS', 'gt': '0/0',
+                   'alt': '.'}]
+        action = filter_calls(self.kit(), policy=policy)
+        self.assertEqual([FILTER_ACTIONS[a] for a in action],
+                         ['keep', 'drop', 'keep', 'keep', 'drop'])
+
+    def test_policy(self):
+        policy = [{'action': 'keep', 'nreads': '>= 30'},
+                  {'action': 'count', 'passfail': 'FAIL'},
+                  {'action': 'drop', 'passrate': '< 0.5'},
+                  {'action': 'count', 'alt': '.'},
+                  {'action': 'drop', 'ref': 'NOSUCHALLELE'}]
+        action = filter_calls(self.kit(), policy=policy)
+        self.assertEqual([FILTER_ACTIONS[a] for a in action],
+                         ['keep', 'count', 'count', 'drop', 'count'])
+        # refpos calls are kept whatever the rules say
+        action = filter_calls(self.kit(), refpos=[1003, 1004], policy=policy)
+        self.assertEqual([FILTER_ACTIONS[a] for a in action],
+                         ['keep', 'count', 'count', 'keep', 'keep'])
+        self.assertTrue(np.all(filter_calls(self.kit(), policy=[]) ==
+                               FILTER_KEEP))
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            filter_calls(self.kit(), policy=[{'action': 'drop', 'qual': 10}])
+
+class TestIndels(unittest.TestCase):
+
+    # positions 1-24 of a made-up reference, with a CA repeat at 4-11
+    seq = 'TTGCACACACAGTTTTAGGANNAC'
+
+    def apply(self, pos, ref, alt):
+        # the sequence with the variant applied
+        self.assertEqual(self.seq[pos-1:pos-1+len(ref)], ref)
+        return self.seq[:pos-1] + alt + self.seq[pos-1+len(ref):]
+
+    def normalize(self, pos, ref, alt):
+        return normalize_indel(pos, ref, alt, self.seq[:pos-1])
+
+    def test_normalize_indel(self):
+        # every way of writing the deletion of one CA is the same variant
+        forms = [(3, 'GCA', 'G'), (4, 'CAC', 'C'), (5, 'ACA', 'A'),
+                 (6, 'CAC', 'C'), (7, 'ACA', 'A'), (8, 'CACA', 'CA'),
+                 (9, 'ACAG', 'AG'), (10, 'CAG', 'G'), (7, 'ACAC', 'AC')]
+        for pos, ref, alt in forms:
+            norm = self.normalize(pos, ref, alt)
+            self.assertEqual(norm, (3, 'GCA', 'G'))
+            self.assertEqual(self.apply(*norm), self.apply(pos, ref, alt))
+        # insertions
+        self.assertEqual(self.normalize(12, 'G', 'CAG'), (3, 'G', 'GCA'))
+        self.assertEqual(self.normalize(15, 'T', 'TT'), (12, 'G', 'GT'))
+        # nothing to do for a SNP-like change or one already left-aligned
+        self.assertEqual(self.normalize(17, 'AG', 'TC'), (17, 'AG', 'TC'))
+        self.assertEqual(self.normalize(3, 'GCA', 'G'), (3, 'GCA', 'G'))
+        # more context is needed, or the context has an N
+        self.assertIsNone(normalize_indel(7, 'ACA', 'A', self.seq[4:6]))
+        self.assertEqual(self.normalize(24, 'C', 'AC'), (24, 'C', 'AC'))
+
+    def test_normalize_indels(self):
+        tmp = context.tempdir(self)
+        fasta = os.path.join(tmp, 'chrY.fa')
+        with open(fasta, 'w') as f:
+            f.write('>chrY\n')
+            for ii in range(0, len(self.seq), 5):
+                f.write(self.seq[ii:ii+5].lower() + '\n')
+        self.assertEqual(fasta_bases(fasta, [1, 5, 6, 24, 25, 0]).tobytes(),
+                         b'TACC\0\0')
+        kit = KitData()
+        kit.read_VCF(io.StringIO(context.vcf_text(
+            [(7, 'ACA', 'A', 'PASS', '1/1', '0,20'),
+             (5, 'ACA', 'A', 'PASS', '1/1', '0,20'),
+             (18, 'G', 'A', 'PASS', '1/1', '0,20'),
+             (12, 'G', 'CAG', 'PASS', '1/1', '0,20')])))
+        self.assertEqual(kit.normalize_indels(fasta, window=2), 3)
+        self.assertEqual([(int(p), kit.alleles[r], kit.alleles[a])
+                          for (p, r, a) in zip(kit.pos, kit.ref, kit.alt)],
+                         [(3, 'GCA', 'G'), (3, 'GCA', 'G'), (18, 'G', 'A'),
+                          (3, 'G', 'GCA')])
+
+class TestVCF(unittest.TestCase):
+
+    def test_genotypes(self):
+        calls = [(1000, 'A', 'G', 'PASS', '1/1', '0,30'),
+                 (1001, 'A', 'G', 'PASS', '1/0', '10,10'),
+                 (1002, 'A', 'G,T', 'PASS', '0/3', '10,10,10'),
+                 (1003, 'A', 'G', 'PASS', './.', '0,30'),
+                 (1004, 'A', 'G', 'PASS', '.', '0,30'),
+                 (1005, 'A', 'G', 'PASS', '1|0', '10,10'),
+                 (1006, 'A', 'G', 'PASS', './1', '0,30'),
+                 (1007, 'A', 'G', 'PASS', '2', '0,30'),
+                 (1008, 'A', 'G', 'FAIL', '1', '0,30')]
+        gts = [(t[0], t[8]) for t in
+               getVCFvariants(io.StringIO(context.vcf_text(calls)))]
+        self.assertEqual(gts, [(1000, '1/1'), (1001, '0/1'), (1002, '0/3'),
+                               (1002, '0/3'), (1005, '0/1'), (1006, '1/.'),
+                               (1007, '2'), (1008, '1')])
+        # the kit is read, with a code for every genotype
+        kit = KitData()
+        kit.read_VCF(io.StringIO(context.vcf_text(calls)))
+        self.assertEqual(unpack_calls(kit.callinfo)['gt'].tolist(),
+                         [1, 2, 2, 2, 2, 3, 3, 1])
+
+    def test_gt_code(self):
+        for gt, code in CALLINFO_GT.items():
+            self.assertEqual(gt_code(gt), code)
+        for gt, code in (('0/3', 2), ('1|0', 2), ('3/3', 3), ('0/0/0', 0),
+                         ('1/.', 3), ('.', 3), ('2/3', 3)):
+            self.assertEqual(gt_code(gt), code)
+
+    def test_gvcf(self):
+        fmt = 'chrY\t{}\t.\t{}\t{}\t.\t{}\t{}\tGT:AD:DP:GQ\t{}\n'
+        text = context.VCF_HEADER.replace('##contig',
+            '##ALT=<ID=NON_REF,Description="any other allele">\n##contig')
+        text += ''.join([fmt.format(*rec) for rec in
+            [(100, 'A', '<NON_REF>', 'PASS', 'END=150', '0/0:20:20:30'),
+             (151, 'C', '<NON_REF>', '.', 'END=160', '0/0:20:20:99'),
+             (170, 'T', '<NON_REF>', 'PASS', 'END=180', '0/0:3:3:5'),
+             (181, 'G', 'A,<NON_REF>', '.', 'BQ=30', '1/1:0,20,0:20:60'),
+             (182, 'G', 'T,<NON_REF>', 'LowQual', 'BQ=30', '1/1:0,20,0:20:60'),
+             (190, 'TAA', 'T,<NON_REF>', 'PASS', 'MQ=50', '0/1:9,9,0:18:40'),
+             (200, 'A', '<*>', '.', 'END=300', '0/0:20:20:30')]])
+        ranges = []
+        calls = list(getVCFvariants(io.StringIO(text), ranges=ranges))
+        self.assertEqual(ranges, [[99, 160], [180, 181], [189, 192],
+                                  [199, 300]])
+        self.assertEqual([t[:4] + t[8:] for t in calls],
+                         [(181, 'G', 'A', 'PASS', '1/1'),
+                          (182, 'G', 'T', 'FAIL', '1/1'),
+                          (190, 'TAA', 'T', 'PASS', '0/1')])
+        # the coverage of a gVCF goes in the kit's ranges
+        kit = KitData()
+        kit.read_VCF(io.StringIO(text))
+        self.assertEqual(kit.ranges.tolist(), ranges)
+
+class TestKitParsers(unittest.TestCase):
+
+    chr1 = ['chr1\t{}\t.\tA\tG\t100\tPASS\t.\tGT:AD:DP\t1/1:0,9:9\n'.format(p)
+            for p in (10, 20, 30)]
+    chrY = ['chrY\t{}\t.\tA\tG\t100\tPASS\t.\tGT:AD:DP\t1/1:0,9:9\n'.format(p)
+            for p in (100, 200, 300)]
+
+    def bgzf(self):
+        # blocks: the header, then chr1 with the start of chrY, then chrY;
+        # returns the data and the virtual offset of each chrY record
+        blocks = [context.VCF_HEADER, ''.join(self.chr1 + self.chrY[:1]),
+                  ''.join(self.chrY[1:])]
+        data, voffs = b'', []
+        for block in blocks:
+            for line in block.splitlines(True):
+                if line.startswith('chrY'):
+                    voffs.append(len(data) << 16 | block.index(line))
+            data += gzip.compress(block.encode())
+        return data, voffs
+
+    def index(self, kind, names, bins, depth=5):
+        # a tabix or CSI index; bins is a list of {bin: [chunk starts]}
+        lnames = b''.join([n.encode() + b'\0' for n in names])
+        aux = struct.pack('<6i', 2, 1, 2, 0, ord('#'), 0) + \
+                  struct.pack('<i', len(lnames)) + lnames
+        if kind == 'tbi':
+            data = b'TBI\1' + struct.pack('<i', len(names)) + aux
+        else:
+            data = b'CSI\1' + struct.pack('<3i', 14, depth, len(aux)) + aux + \
+                       struct.pack('<i', len(names))
+        for refbins in bins:
+            data += struct.pack('<i', len(refbins))
+            for binno, starts in refbins.items():
+                data += struct.pack('<I', binno)
+                if kind == 'csi':
+                    data += struct.pack('<Q', 0)
+                data += struct.pack('<i', len(starts))
+                for start in starts:
+                    data += struct.pack('<2Q', start, start + 100)
+            if kind == 'tbi':
+                data += struct.pack('<iQ', 1, 0)
+        return gzip.compress(data)
+
+    def test_index_offset(self):
+        for kind, pseudo in (('tbi', 37450), ('csi', 299594)):
+            bins = [{4681: [1<<16]},
+                    {pseudo: [2<<16], 4682: [9<<16|5, 3<<16|7], 4683: []}]
+            index = self.index(kind, ['chr1', 'chrY'], bins, depth=6)
+            self.assertEqual(index_offset(index, CHRY_NAMES), 3<<16|7)
+            self.assertEqual(index_offset(index, ('chr1',)), 1<<16)
+            self.assertIsNone(index_offset(index, ('chrX',)))
+        self.assertIsNone(index_offset(gzip.compress(b'BAI\1'), CHRY_NAMES))
+
+    def wgs_zip(self, fname, index=None, compression=zipfile.ZIP_STORED):
+        data, voffs = self.bgzf()
+        with zipfile.ZipFile(fname, 'w', compression) as zf:
+            zf.writestr('genome.vcf.gz', data)
+            if index is not None:
+                zf.writestr('genome.vcf.gz.tbi', index)
+        return voffs
+
+    def read_wgs(self, fname):
+        with KitArchive(fname) as ka:
+            bed, vcf = open_wgs_kit(ka)
+            return [l.decode() for l in vcf]
+
+    def test_read_chrY(self):
+        tmp = context.tempdir(self)
+        header = context.VCF_HEADER.splitlines(True)
+        fname = os.path.join(tmp, 'wgs.zip')
+        self.wgs_zip(fname)
+        self.assertEqual(self.read_wgs(fname), header + self.chrY)
+        # with an index, reading starts where the index says chrY does
+        voffs = self.wgs_zip(fname)
+        for ii, voff in enumerate(voffs):
+            for kind in ('tbi', 'csi'):
+                index = self.index(kind, ['chr1', 'chrY'],
+                                   [{4681: [0]}, {4681: [voff]}])
+                self.wgs_zip(fname, index, zipfile.ZIP_DEFLATED)
+                self.assertEqual(self.read_wgs(fname), header + self.chrY[ii:])
+
+    def test_wgs_data_md5(self):
+        tmp = context.tempdir(self)
+        hashes = []
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            fname = os.path.join(tmp, 'wgs{}.zip'.format(compression))
+            self.wgs_zip(fname, compression=compression)
+            with KitArchive(fname) as ka:
+                open_wgs_kit(ka)
+                self.assertTrue(ka.quick_hash)
+                # the hash comes from the zip directory, not the data
+                ka.open_vcf = None
+                hashes.append(ka.data_md5())
+        self.assertEqual(hashes[0], hashes[1])
+        self.chrY = self.chrY[:2]
+        self.wgs_zip(fname)
+        with KitArchive(fname) as ka:
+            open_wgs_kit(ka)
+            self.assertNotEqual(ka.data_md5(), hashes[0])
+
+    def test_find_kit_parser(self):
+        self.assertIs(find_kit_parser('FTDNA', 'BigY', 'hg38'), open_ftdna_kit)
+        self.assertIs(find_kit_parser('YSEQ', 'WGS 30x', 'hg38'), open_wgs_kit)
+        self.assertIs(find_kit_parser(None, 'Whole Genome', 'hg38'),
+                      open_wgs_kit)
+        self.assertIsNone(find_kit_parser('FTDNA', 'BigY', 'hg19'))
+
+
+class KitDBTestCase(unittest.TestCase):
+
+    calls = [(150, 'A', 'G', 'PASS', '1', '0,30'),
+             (300, 'C', 'T', 'PASS', '1', '0,25'),
+             (2500, 'G', 'A', 'PASS', '1', '1,20')]
+
+    def setUp(self):
+        tmp = context.tempdir(self)
+        patch = mock.patch.dict(lib.config, {'REDUX_DATA': tmp,
+                                             'normalize_indels': False,
+                                             'kit_cache': None,
+                                             'call_store': None,
+                                             'load_select': None,
+                                             'drop_tables': False})
+        patch.start()
+        self.addCleanup(patch.stop)
+        os.makedirs(data_path('HaplogroupR'))
+        self.dbo = DB(data_path('test.db'))
+        self.addCleanup(self.dbo.close)
+        self.dbo.create_schema()
+
+    def kit_zip(self, kitid, ncalls=3):
+        fname = os.path.join(data_path('HaplogroupR'), kitid + '.zip')
+        with zipfile.ZipFile(fname, 'w') as zf:
+            zf.writestr('regions.bed', 'chrY\t100\t2000\n')
+            zf.writestr('variants.vcf', context.vcf_text(self.calls[:ncalls]))
+        return fname
+
+    def counts(self, pid):
+        return [self.dbo.execute('select count(*) from {} where pID=?'.format(
+                    tbl), (pid,)).fetchone()[0]
+                for tbl in ('vcfcalls', 'bed', 'vcfstats', 'bedstats',
+                            'loadjournal')]
+
+    def journal(self, pid):
+        return self.dbo.execute('''select status, parserVer from loadjournal
+                                   where pID=?''', (pid,)).fetchone()
+
+class TestLoadKits(KitDBTestCase):
+
+    def test_reload(self):
+        pid = populate_from_zip_file(self.dbo, self.kit_zip('Smith-B1'))
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        populate_from_dataset(self.dbo)
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        # loaded before there was a load journal
+        self.dbo.execute('delete from loadjournal')
+        self.dbo.commit()
+        populate_from_dataset(self.dbo)
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        self.assertEqual(self.journal(pid), ('loaded', KIT_PARSER_VERSION))
+
+    def test_kitlimit(self):
+        pids = [populate_from_zip_file(self.dbo, self.kit_zip('Smith-B1')),
+                populate_from_zip_file(self.dbo, self.kit_zip('Jones-B2', 2))]
+        self.kit_zip('Smith-B1', 2)
+        self.kit_zip('Jones-B2', 1)
+        # the kit that isn't reached keeps what it had
+        lib.config['kitlimit'] = 1
+        populate_from_dataset(self.dbo)
+        # either kit may be the one that's reloaded
+        counts = sorted([self.counts(pid) for pid in pids])
+        self.assertIn(counts, ([[2, 1, 1, 1, 1], [2, 1, 1, 1, 1]],
+                               [[1, 1, 1, 1, 1], [3, 1, 1, 1, 1]]))
+        lib.config['kitlimit'] = 100
+        populate_from_dataset(self.dbo)
+        self.assertEqual([self.counts(pid) for pid in pids],
+                         [[2, 1, 1, 1, 1], [1, 1, 1, 1, 1]])
+
+    def test_kit_coverage(self):
+        import array_api
+        pid = populate_from_zip_file(self.dbo, self.kit_zip('Smith-B1'))
+        stats = self.dbo.execute('''select coverage1, coverage2 from bedstats
+                                    where pID=?''', (pid,)).fetchone()
+        self.assertEqual(stats, (1900, 0))
+        # without a bedstats row, it's calculated, even read-only
+        self.dbo.execute('delete from bedstats')
+        self.dbo.commit()
+        ro = DB(self.dbo.dbfname, readonly=True)
+        self.addCleanup(ro.close)
+        self.assertEqual(array_api.get_kit_coverage(ro, pid), stats)
+        self.assertEqual(self.counts(pid), [3, 1, 1, 0, 1])
+
+    def test_kits_per_commit(self):
+        # kits that fail to store are committed in batches too
+        commits = []
+        def count_commits(nkits):
+            for ii in range(len(commits), nkits):
+                self.kit_zip('Smith-B{}'.format(ii))
+                self.dbo.execute('''insert into dataset(kitId,fileNm,buildID,
+                                        DNAID) values(?,?,?,?)''',
+                                 (ii, 'Smith-B{}.zip'.format(ii),
+                                  get_build_byname(self.dbo), 100+ii))
+                commits.append(None)
+            self.dbo.execute('delete from loadjournal')
+            self.dbo.commit()
+            with mock.patch.object(lib, 'store_kit', side_effect=ValueError), \
+                 mock.patch.object(self.dbo, 'commit',
+                                   wraps=self.dbo.commit) as commit:
+                populate_from_dataset(self.dbo)
+            self.assertEqual(self.dbo.execute('''select count(*) from loadjournal
+                                                 where status='failed' '''
+                                              ).fetchone()[0], nkits)
+            return commit.call_count
+        self.assertEqual(count_commits(2), count_commits(8))
+
+    def test_not_reloaded(self):
+        pid = populate_from_zip_file(self.dbo, self.kit_zip('Smith-B1'))
+        pid2 = populate_from_zip_file(self.dbo, self.kit_zip('Jones-B2', 2))
+        for tbl in ('vcfcalls', 'bed', 'vcfstats', 'bedstats', 'loadjournal'):
+            self.dbo.execute('delete from {} where pID=?'.format(tbl), (pid2,))
+        self.dbo.execute('update loadjournal set parserVer=0')
+        self.dbo.commit()
+        # not selected: a loaded kit stays as it is, journal and all, and one
+        # that isn't loaded is excluded
+        lib.config['load_select'] = {'approxHg': 'R-%'}
+        populate_from_dataset(self.dbo)
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        self.assertEqual(self.journal(pid), ('loaded', 0))
+        self.assertEqual(self.journal(pid2), ('excluded', KIT_PARSER_VERSION))
+        # no kit parser
+        lib.config['load_select'] = None
+        with mock.patch.object(lib, 'find_kit_parser', return_value=None):
+            populate_from_dataset(self.dbo)
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        self.assertEqual(self.journal(pid), ('loaded', 0))
+        # both are loaded once they can be
+        populate_from_dataset(self.dbo)
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        self.assertEqual(self.counts(pid2), [2, 1, 1, 1, 1])
+        self.assertEqual(self.journal(pid), ('loaded', KIT_PARSER_VERSION))
+        self.assertEqual(self.journal(pid2), ('loaded', KIT_PARSER_VERSION))
+
+
+class TestCallStore(KitDBTestCase):
+
+    def variant_arrays(self, pids):
+        # from the store, and from vcfcalls
+        import array_api
+        arrays = []
+        for fname in ('calls.bin', None):
+            with mock.patch.dict(lib.config, {'call_store': fname}):
+                arr, ppl, var = array_api.get_variant_array(self.dbo, pids)
+            arrays.append((dict([(p, dict(a)) for (p, a) in arr.items()]),
+                           sorted(var)))
+        self.assertEqual(arrays[0], arrays[1])
+        return arrays[0]
+
+    def check_store(self, store, pids):
+        for pid in pids:
+            vids, callinfo = store.calls(pid)
+            rows = self.dbo.execute('''select vID, callinfo from vcfcalls
+                                       where pID=? order by vID''',
+                                    (pid,)).fetchall()
+            self.assertEqual(list(zip(vids.tolist(), callinfo.tolist())), rows)
+        self.assertIsNotNone(store.rows(pids))
+
+    def test_call_store(self):
+        lib.config['call_store'] = 'calls.bin'
+        store = get_call_store(self.dbo)
+        pids = [populate_from_zip_file(self.dbo, self.kit_zip('Smith-B1')),
+                populate_from_zip_file(self.dbo, self.kit_zip('Jones-B2', 2))]
+        self.check_store(store, pids)
+        self.dbo.execute('insert into exclude_variants(vID) values(2)')
+        arr, var = self.variant_arrays(pids)
+        self.assertEqual(sorted([len(a) for a in arr.values()]), [1, 2])
+        self.assertEqual(len(var), 2)
+        # a reload appends a block, and a rebuild drops the old ones
+        self.kit_zip('Smith-B1', 1)
+        size = os.path.getsize(store.fname)
+        populate_from_dataset(self.dbo)
+        self.assertGreater(os.path.getsize(store.fname), size)
+        self.check_store(store, pids)
+        self.assertEqual(list(self.variant_arrays(pids)[0][pids[0]]), [1])
+        self.assertEqual(store.rebuild(), 2)
+        self.assertLess(os.path.getsize(store.fname), size)
+        self.check_store(store, pids)
+        self.assertEqual(list(self.variant_arrays(pids)[0][pids[0]]), [1])
+        # without a store block, vcfcalls is used
+        self.dbo.execute('delete from callstore where pID=?', (pids[1],))
+        self.assertIsNone(store.rows(pids))
+        self.variant_arrays(pids)
+
+
+class TestMigrate(KitDBTestCase):
+
+    # the kit tables of schema version 1, and a missing index
+    v1_tables = '''
+        drop table bed;
+        create table bed(
+            pID INTEGER REFERENCES dataset(ID),
+            bID INTEGER REFERENCES bedranges(ID)
+            );
+        create index bedidx1 on bed(pID);
+        create index bedidx2 on bed(bID);
+        drop table vcfcalls;
+        create table vcfcalls(
+            pID INTEGER REFERENCES dataset(ID),
+            vID INTEGER REFERENCES variants(ID),
+            callinfo INTEGER
+            );
+        create index vcfidx1 on vcfcalls(vID);
+        create index vcfpid2 on vcfcalls(pID);
+        drop table vcfstats;
+        create table vcfstats(pID INTEGER, ny INTEGER, nv INTEGER,
+            ns INTEGER, ni INTEGER, nr INTEGER);
+        drop table bedstats;
+        create table bedstats(pID INTEGER, coverage1 INTEGER,
+            coverage2 INTEGER, nranges INTEGER);
+        drop table bedblob;
+        drop table callstore;
+        drop table kitbitmaps;
+        drop table kitbitmapkits;
+        drop table loadjournal;
+        drop table snpsnapshot;
+        drop index rangeuniq;
+        delete from meta;
+        insert into bedranges values(1,100,200), (2,300,400), (3,5,10);
+        insert into agebed(bID) values(3);
+        insert into bed values(7,1), (7,2), (8,2);
+        insert into vcfcalls values(7,1,10), (7,2,20), (7,1,11), (8,2,30);
+        insert into vcfstats values(7,4,4,4,0,3);
+        insert into bedstats values(7,1,0,2), (7,200,0,2), (8,100,0,1);
+        '''
+
+    def test_migrate(self):
+        self.dbo.executescript(self.v1_tables)
+        self.assertEqual(migrate_schema(self.dbo, chunksize=2), 1)
+        self.assertEqual(self.dbo.execute('''select * from vcfcalls
+                                             order by pID, vID''').fetchall(),
+                         [(7,1,11), (7,2,20), (8,2,30)])
+        self.assertEqual(self.dbo.execute('select * from bed').fetchall(),
+                         [(7,100,200), (7,300,400), (8,300,400)])
+        self.assertEqual(self.dbo.execute('select * from bedranges').fetchall(),
+                         [(3,5,10)])
+        self.assertEqual(self.dbo.execute('select * from vcfstats').fetchall(),
+                         [(7,4,4,4,0,3,None,None)])
+        self.assertEqual(self.dbo.execute('select * from bedstats').fetchall(),
+                         [(7,200,0,2), (8,100,0,1)])
+        # it's laid out as schema.sql makes it, and a second run has
+        # nothing to do
+        mem = DB(':memory:')
+        self.addCleanup(mem.close)
+        mem.create_schema()
+        for (tbl,) in mem.execute('''select name from sqlite_master
+                                     where type='table' '''):
+            self.assertEqual(table_layout(self.dbo, tbl),
+                             table_layout(mem, tbl))
+        for (idx,) in mem.execute('''select name from sqlite_master
+                                     where type='index' and sql is not null'''):
+            self.assertEqual(index_layout(self.dbo, idx),
+                             index_layout(mem, idx))
+        self.assertIsNone(index_layout(self.dbo, 'vcfpid2'))
+        self.assertEqual(migrate_schema(self.dbo), SCHEMA_VERSION)
+        # and kits load into it
+        pid = populate_from_zip_file(self.dbo, self.kit_zip('Smith-B1'))
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        populate_from_dataset(self.dbo)
+        self.assertEqual(self.counts(pid), [3, 1, 1, 1, 1])
+        self.assertEqual(self.counts(7), [2, 2, 1, 1, 0])
+
+    def test_schema_version(self):
+        self.assertEqual(get_schema_version(self.dbo), SCHEMA_VERSION)
+        check_schema_version(self.dbo)
+        self.dbo.executescript(self.v1_tables)
+        self.assertEqual(get_schema_version(self.dbo), 1)
+        with self.assertRaises(SystemExit):
+            check_schema_version(self.dbo)
+        migrate_schema(self.dbo)
+        check_schema_version(self.dbo)
+        empty = DB(data_path('empty.db'))
+        self.addCleanup(empty.close)
+        self.assertEqual(get_schema_version(empty), 0)
+        with self.assertRaises(SystemExit):
+            check_schema_version(empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
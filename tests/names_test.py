@@ -0,0 +1,93 @@
+import os, unittest
+import context
+import numpy as np
+from db import DB
+from names import *
+
+class TestResolveNames(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = os.path.join(context.tempdir(self), 'names.db')
+        self.dbo = DB(self.fname)
+        self.addCleanup(self.dbo.close)
+        self.dbo.create_schema()
+        self.hg38 = get_build_byname(self.dbo, 'GRCh38')
+        self.hg19 = get_build_byname(self.dbo, 'hg19')
+        self.dbo.executemany('insert into dataset(kitId,DNAID) values(?,?)',
+                             [('B1234', 11), ('B1235', 12), ('N4826', 13)])
+        self.dbo.executemany('insert into alleles(ID,allele) values(?,?)',
+                             [(1, 'A'), (2, 'G'), (3, 'T')])
+        self.dbo.executemany('''insert into variants(ID,buildID,pos,anc,der)
+                                values(?,?,?,?,?)''',
+                             [(1, self.hg38, 100, 1, 2),
+                              (2, self.hg38, 200, 2, 3),
+                              (3, self.hg19, 150, 1, 2)])
+        self.dbo.executemany('insert into snpnames(vID,snpname) values(?,?)',
+                             [(1, 'U106'), (2, 'Z381'), (3, 'U106'),
+                              (2, 'S263')])
+        self.dbo.commit()
+
+    def test_kits(self):
+        found, unresolved = resolve_names(self.dbo, 'kit',
+                                          ['N4826', 'B123%', 'X1'])
+        self.assertEqual(sorted(found['B123%']), [11, 12])
+        self.assertEqual(found['N4826'], [13])
+        self.assertEqual(unresolved, ['X1'])
+
+    def test_snps(self):
+        found, unresolved = resolve_names(self.dbo, 'snp',
+                                          ['u106', 'Z381', '100.A.G', 'Z8'])
+        self.assertEqual(sorted(found['u106']), [1, 3])
+        self.assertEqual(found['Z381'], [2])
+        self.assertEqual(unresolved, ['100.A.G', 'Z8'])
+        found, unresolved = resolve_names(self.dbo, 'snp', ['U106'], 'hg38')
+        self.assertEqual(found, {'U106': [1]})
+
+    def test_variants(self):
+        names = ['100.A.G', '200.G.T', 'S263', '150.A.G', '300.A.G', '7.C.A']
+        found, unresolved = resolve_names(self.dbo, 'variant', names, 'hg38')
+        self.assertEqual(found, {'100.A.G': [1], '200.G.T': [2], 'S263': [2]})
+        self.assertEqual(unresolved, ['150.A.G', '300.A.G', '7.C.A'])
+        found, unresolved = resolve_names(self.dbo, 'variant', names)
+        self.assertEqual(found['150.A.G'], [3])
+        self.assertEqual(unresolved, ['300.A.G', '7.C.A'])
+
+    def test_insert_notfound(self):
+        names = ['100.A.G', '300.A.G', '7.C.A', 'Z8']
+        # a build is needed to add variants
+        resolve_names(self.dbo, 'variant', names, insert_notfound=True)
+        self.assertEqual(self.dbo.execute('select count(*) from variants'
+                                          ).fetchone()[0], 3)
+        found, unresolved = resolve_names(self.dbo, 'variant', names, 'hg38',
+                                          insert_notfound=True)
+        self.assertEqual(sorted(found), ['100.A.G', '300.A.G'])
+        self.assertEqual(found['100.A.G'], [1])
+        self.assertEqual(self.dbo.execute('''select buildID, pos, anc, der
+                                             from variants where id=?''',
+                                          found['300.A.G']).fetchone(),
+                         (self.hg38, 300, 1, 2))
+        # C isn't a known allele
+        self.assertEqual(unresolved, ['7.C.A', 'Z8'])
+
+    def test_readonly(self):
+        # the names are passed as JSON, so nothing is written, not even to
+        # the temp schema, and there's no limit on how many there are
+        names = ['{}.A.G'.format(p) for p in range(5000)] + ['U106']
+        ro = DB(self.fname, readonly=True)
+        self.addCleanup(ro.close)
+        found, unresolved = resolve_names(ro, 'variant', names, 'hg38')
+        self.assertEqual(found, {'100.A.G': [1], 'U106': [1]})
+        self.assertEqual(len(unresolved), 4999)
+        self.assertEqual(ro.execute('select count(*) from sqlite_temp_master'
+                                    ).fetchone()[0], 0)
+
+    def test_json_list(self):
+        self.assertEqual(json_list(np.array([1, 2], dtype=np.int64)), '[1, 2]')
+        self.assertEqual(self.dbo.execute(
+            '''select group_concat(v.pos) from variants v
+               inner join json_each(?) t on t.value=v.id''',
+            (json_list(np.arange(1, 3)),)).fetchone()[0], '100,200')
+
+
+if __name__ == '__main__':
+    unittest.main()